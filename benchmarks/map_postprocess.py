@@ -0,0 +1,98 @@
+r"""Benchmarks humanav.map_postprocess against the implementations it replaced
+(label loop hole filling, disk footprint dilation and relabelling for the
+largest component) on real maps, and checks that both give the same
+traversible. The maps are read from the map cache (see humanav/map_cache.py),
+so the buildings need to have been loaded once:
+  python benchmarks/map_postprocess.py --data_dir /PATH/TO/sbpd_data_dir
+"""
+import os, glob, time, argparse, warnings
+import numpy as np, scipy.ndimage
+from skimage import morphology
+from humanav import map_cache, map_postprocess
+
+def _fill_holes(img, thresh):
+  l, n = scipy.ndimage.label(np.logical_not(img))
+  img_ = img == True
+  cnts = np.bincount(l.reshape(-1))
+  for i, cnt in enumerate(cnts):
+    if cnt < thresh:
+      l[l == i] = -1
+  img_[l == -1] = True
+  return img_
+
+def _pick_largest_cc(traversible):
+  out = scipy.ndimage.label(traversible)[0]
+  cnt = np.bincount(out.reshape(-1))[1:]
+  return out == np.argmax(cnt) + 1
+
+def _get_traversible(map, radius, num_point_threshold, fill_holes, dilate, largest_cc):
+  obstacle_free = dilate(fill_holes(map.num_obstcale_points > num_point_threshold, 20),
+                         radius) != True
+  valid_space = fill_holes(map.num_points > num_point_threshold, 20)
+  traversible = np.logical_and(obstacle_free, valid_space)
+  return largest_cc(traversible) if np.any(traversible) else traversible
+
+def _time(fn, *args):
+  t = time.time()
+  out = fn(*args)
+  return out, time.time() - t
+
+def benchmark_map(map, robot_radius, num_point_threshold):
+  radius = robot_radius / map.resolution
+  obstacles = _fill_holes(map.num_obstcale_points > num_point_threshold, 20)
+  traversible = np.logical_and(obstacles != True, map.num_points > num_point_threshold)
+  with warnings.catch_warnings():
+    # binary_dilation is deprecated in recent skimage
+    warnings.simplefilter('ignore')
+    steps = [
+      ('fill_holes', _fill_holes, map_postprocess.fill_holes,
+       (map.num_obstcale_points > num_point_threshold, 20)),
+      ('dilate', lambda x, r: morphology.binary_dilation(x, morphology.disk(r)),
+       map_postprocess.dilate_disk, (obstacles, radius)),
+      ('largest_cc', _pick_largest_cc, map_postprocess.largest_component, (traversible,)),
+      ('traversible',
+       lambda m: _get_traversible(m, radius, num_point_threshold, _fill_holes,
+                                  lambda x, r: morphology.binary_dilation(x, morphology.disk(r)),
+                                  _pick_largest_cc),
+       lambda m: _get_traversible(m, radius, num_point_threshold, map_postprocess.fill_holes,
+                                  map_postprocess.dilate_disk,
+                                  map_postprocess.largest_component),
+       (map,))]
+    if not np.any(traversible):
+      steps = [x for x in steps if x[0] != 'largest_cc']
+    results = []
+    for name, old_fn, new_fn, args in steps:
+      old, old_time = _time(old_fn, *args)
+      new, new_time = _time(new_fn, *args)
+      results.append((name, old_time, new_time, np.array_equal(old, new)))
+  return results
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Benchmark the map post-processing.')
+  parser.add_argument('--data_dir', default=None,
+                      help='SBPD data directory, benchmarks all cached maps in it.')
+  parser.add_argument('--map_dirs', nargs='*', default=[], help='Map cache directories.')
+  parser.add_argument('--robot_radius', type=float, default=18.,
+                      help='Robot radius (in cm, see renderer_params).')
+  parser.add_argument('--num_point_threshold', type=float, default=2.)
+  args = parser.parse_args(argv)
+
+  map_dirs = list(args.map_dirs)
+  if args.data_dir is not None:
+    map_dirs += sorted(glob.glob(os.path.join(args.data_dir, 'cache', '*', 'map_*')))
+  assert len(map_dirs) > 0, 'No cached maps found, load the buildings once to cache them.'
+
+  print('{:40s} {:12s} {:>10s} {:>10s} {:>8s} {:>6s}'.format(
+    'map', 'step', 'old (s)', 'new (s)', 'speedup', 'same'))
+  for map_dir in map_dirs:
+    map = map_cache.load_map(map_dir)
+    if map is None or not hasattr(map, 'num_points'):
+      continue
+    name = os.path.join(os.path.basename(os.path.dirname(map_dir)), os.path.basename(map_dir)[:12])
+    for step, old_time, new_time, same in benchmark_map(map, args.robot_radius,
+                                                        args.num_point_threshold):
+      print('{:40s} {:12s} {:10.4f} {:10.4f} {:8.1f} {:>6s}'.format(
+        name, step, old_time, new_time, old_time / max(new_time, 1e-9), str(same)))
+
+if __name__ == '__main__':
+  main()
@@ -76,11 +76,13 @@ def render_rgb_and_depth(r, camera_pos_13, dx_m, human_visible=True):
     # Convert from real world units to grid world units
     camera_grid_world_pos_12 = camera_pos_13[:, :2]/dx_m
 
-    # Render RGB and Depth Images. The shape of the resulting
+    # Render RGB and Depth Images in a single pass over the scene. The shape of the resulting
     # image is (1 (batch), m (width), k (height), c (number channels))
-    rgb_image_1mk3 = r._get_rgb_image(camera_grid_world_pos_12, camera_pos_13[:, 2:3], human_visible=True)
+    imgs = r._get_rgb_and_disparity_image(camera_grid_world_pos_12, camera_pos_13[:, 2:3], human_visible=True)
+    rgb_image_1mk3 = imgs['rgb']
 
-    depth_image_1mk1, _, _ = r._get_depth_image(camera_grid_world_pos_12, camera_pos_13[:, 2:3], xy_resolution=.05, map_size=1500, pos_3=camera_pos_13[0, :3], human_visible=True)
+    depth_image_1mk1, _, _ = r._get_depth_image(camera_grid_world_pos_12, camera_pos_13[:, 2:3], xy_resolution=.05, map_size=1500, pos_3=camera_pos_13[0, :3], human_visible=True,
+                                                disparity_imgs_cm=imgs['disparity'])
 
     return rgb_image_1mk3, depth_image_1mk1
 
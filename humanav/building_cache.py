@@ -0,0 +1,201 @@
+r"""Preprocessed building cache. Stores the meshes (vertices, faces and
+texture coordinates) and the decoded, resized textures of a building as .npy
+files which are memory mapped when the building is loaded, so that loading a
+building neither parses its .obj file with pyassimp nor decodes its textures.
+
+Buildings are cached once (flipped and unflipped) with:
+  python -m humanav.building_cache --data_dir /PATH/TO/sbpd_data_dir
+
+With --tile_size the meshes are also split into square XY tiles (by the
+centroid of their faces) that can be streamed in and out of the renderer
+(see tile_streamer.py). Every tile is cached as one shape.
+"""
+import os, sys, argparse, logging, pickle
+import numpy as np
+
+# Py27 vs Py3 imports
+if sys.version_info[0] == 2:
+    from render import swiftshader_renderer as renderer
+    import utils
+else:
+    from humanav.render import swiftshader_renderer as renderer
+    from humanav import utils
+
+CACHE_VERSION = 1
+ARRAY_NAMES = ['vertices', 'faces', 'uvs', 'textures']
+
+def get_cache_dir(building, materials_scale, flip, tile_size=None):
+  """Returns the cache directory of building (as returned by
+  Loader.load_building) for materials_scale, flip and tile_size."""
+  name = 'scale{:.3f}_flip{:d}'.format(materials_scale, int(flip))
+  if tile_size is not None:
+    name = name + '_tile{:.3f}'.format(tile_size)
+  return os.path.join(building['data_dir'], 'cache', building['name'], name)
+
+def split_into_tiles(shapess, tile_size):
+  """Splits the meshes of shapess into square XY tiles of tile_size meters,
+  assigning every face to the tile of its centroid. Returns one
+  renderer.ArrayShape per non empty tile, sorted by tile, with its (i, j)
+  tile index as attribute tile."""
+  tiles = {}
+  for shapes in shapess:
+    imgs = {}
+    for m, (file_name, img) in zip(shapes.meshes, shapes.iter_materials(dedup=True)):
+      if img is not None:
+        imgs[file_name] = img
+      vertices, faces = np.asarray(m.vertices), np.asarray(m.faces)
+      uvs = np.asarray(m.texturecoords[0,:,:2])
+      centroids = np.mean(vertices[faces, :2], axis=1)
+      tile_ij = np.floor(centroids / tile_size).astype(np.int64)
+      keys, inverse = np.unique(tile_ij, axis=0, return_inverse=True)
+      inverse = np.reshape(inverse, (-1))
+      order = np.argsort(inverse, kind='stable')
+      starts = np.concatenate([[0], np.cumsum(np.bincount(inverse, minlength=len(keys)))])
+      for k, key in enumerate(keys):
+        tile_faces = faces[order[starts[k]:starts[k+1]]]
+        used, local_faces = np.unique(tile_faces, return_inverse=True)
+        name = '{:s}_tile_{:d}_{:d}'.format(m.name, key[0], key[1])
+        mesh = renderer.ArrayShape.make_mesh(name, vertices[used],
+                                             np.reshape(local_faces, (-1, 3)), uvs[used])
+        meshes, materials = tiles.setdefault((int(key[0]), int(key[1])), ([], []))
+        meshes.append(mesh)
+        materials.append((file_name, imgs[file_name]))
+
+  tile_shapess = []
+  for key in sorted(tiles.keys()):
+    shapes = renderer.ArrayShape(*tiles[key])
+    shapes.tile = key
+    tile_shapess.append(shapes)
+  return tile_shapess
+
+def write_building_cache(shapess, cache_dir, materials_scale, flip, tile_size=None):
+  """Writes the meshes and materials of shapess to cache_dir. The header is
+  written last, a cache without header is incomplete and ignored. With
+  tile_size, shapess are the tiles returned by split_into_tiles."""
+  utils.mkdir_if_missing(cache_dir)
+  vertices, faces, uvs, textures = [], [], [], []
+  texture_ids = {}
+  header = {'version': CACHE_VERSION, 'materials_scale': materials_scale,
+            'flip': flip, 'shapes': [], 'textures': [], 'tile_size': tile_size,
+            'tiles': [getattr(shapes, 'tile', None) for shapes in shapess]}
+  num_vertices, num_faces, num_texture_bytes = 0, 0, 0
+  for shapes in shapess:
+    meshes = []
+    for m, (file_name, img) in zip(shapes.meshes, shapes.iter_materials(dedup=True)):
+      if file_name not in texture_ids:
+        texture_ids[file_name] = len(header['textures'])
+        header['textures'].append({'file_name': file_name, 'shape': img.shape,
+                                   'offset': num_texture_bytes})
+        textures.append(np.reshape(img, (-1)))
+        num_texture_bytes += img.size
+      meshes.append({'name': m.name, 'texture': texture_ids[file_name],
+                     'vertex_offset': num_vertices, 'num_vertices': m.vertices.shape[0],
+                     'face_offset': num_faces, 'num_faces': m.faces.shape[0]})
+      vertices.append(m.vertices)
+      faces.append(m.faces)
+      uvs.append(m.texturecoords[0,:,:2])
+      num_vertices += m.vertices.shape[0]
+      num_faces += m.faces.shape[0]
+    header['shapes'].append(meshes)
+
+  arrays = {'vertices': np.concatenate(vertices, axis=0),
+            'faces': np.concatenate(faces, axis=0),
+            'uvs': np.concatenate(uvs, axis=0),
+            'textures': np.concatenate(textures, axis=0)}
+  for name in ARRAY_NAMES:
+    np.save(os.path.join(cache_dir, name + '.npy'), arrays[name])
+
+  header_file = os.path.join(cache_dir, 'header.pkl')
+  with open(header_file + '.tmp', 'wb') as f:
+    pickle.dump(header, f, protocol=2)
+  os.rename(header_file + '.tmp', header_file)
+
+def load_building_cache(cache_dir, materials_scale, flip, tile_size=None):
+  """Returns the list of shapes (renderer.ArrayShape) cached in cache_dir,
+  backed by memory mapped arrays, or None if there is no valid cache for
+  materials_scale, flip and tile_size. Tiles have their tile index as
+  attribute tile."""
+  header_file = os.path.join(cache_dir, 'header.pkl')
+  if not os.path.exists(header_file):
+    return None
+  with open(header_file, 'rb') as f:
+    header = pickle.load(f)
+  if (header['version'] != CACHE_VERSION or header['materials_scale'] != materials_scale or
+      header['flip'] != flip or header.get('tile_size', None) != tile_size):
+    logging.warning('Ignoring building cache %s, it does not match.', cache_dir)
+    return None
+
+  arrays = {}
+  for name in ARRAY_NAMES:
+    arrays[name] = np.load(os.path.join(cache_dir, name + '.npy'), mmap_mode='r')
+
+  materials = []
+  for t in header['textures']:
+    size = int(np.prod(t['shape']))
+    img = arrays['textures'][t['offset']:t['offset']+size].reshape(t['shape'])
+    materials.append((t['file_name'], img))
+
+  shapess = []
+  tiles = header.get('tiles', [None]*len(header['shapes']))
+  for meshes, tile in zip(header['shapes'], tiles):
+    ms, mats = [], []
+    for m in meshes:
+      vs = slice(m['vertex_offset'], m['vertex_offset'] + m['num_vertices'])
+      fs = slice(m['face_offset'], m['face_offset'] + m['num_faces'])
+      ms.append(renderer.ArrayShape.make_mesh(m['name'], arrays['vertices'][vs],
+                                              arrays['faces'][fs], arrays['uvs'][vs]))
+      mats.append(materials[m['texture']])
+    shapes = renderer.ArrayShape(ms, mats)
+    if tile is not None:
+      shapes.tile = tuple(tile)
+    shapess.append(shapes)
+  return shapess
+
+def cache_building(dataset, name, materials_scale=1.0, overwrite=False, tile_size=None):
+  """Parses building name of dataset once and caches it flipped and
+  unflipped (split into tiles of tile_size meters if given)."""
+  building = dataset.load_building(name)
+  cache_dirs = [get_cache_dir(building, materials_scale, flip, tile_size) for flip in [False, True]]
+  if not overwrite and all([os.path.exists(os.path.join(x, 'header.pkl')) for x in cache_dirs]):
+    logging.info('Building %s is already cached.', name)
+    return
+  shapess = dataset.load_building_meshes(building, materials_scale=materials_scale,
+                                         use_cache=False)
+  # Decode the textures only once for both caches
+  for shapes in shapess:
+    shapes.materials = list(shapes.iter_materials())
+  for flip, cache_dir in zip([False, True], cache_dirs):
+    if flip:
+      for shapes in shapess:
+        shapes.flip_shape()
+    logging.info('Writing building cache %s.', cache_dir)
+    if tile_size is None:
+      write_building_cache(shapess, cache_dir, materials_scale, flip)
+    else:
+      write_building_cache(split_into_tiles(shapess, tile_size), cache_dir, materials_scale, flip,
+                           tile_size)
+
+def main(argv=None):
+  if sys.version_info[0] == 2:
+    import sbpd
+  else:
+    from humanav import sbpd
+  parser = argparse.ArgumentParser(description='Preprocess buildings into the binary building cache.')
+  parser.add_argument('--data_dir', required=True,
+                      help='SBPD data directory (see renderer_params.get_sbpd_data_dir).')
+  parser.add_argument('--buildings', nargs='*', default=None,
+                      help='Buildings to cache, defaults to all buildings.')
+  parser.add_argument('--materials_scale', type=float, default=1.0)
+  parser.add_argument('--tile_size', type=float, default=None,
+                      help='Also split the buildings into XY tiles of this size (in meters).')
+  parser.add_argument('--overwrite', action='store_true')
+  args = parser.parse_args(argv)
+  logging.getLogger().setLevel(logging.INFO)
+
+  dataset = sbpd.get_dataset('sbpd', 'all', data_dir=args.data_dir, surreal_params=None)
+  names = args.buildings if args.buildings else dataset.get_split()
+  for name in names:
+    cache_building(dataset, name, args.materials_scale, args.overwrite, args.tile_size)
+
+if __name__ == '__main__':
+  main()
@@ -15,11 +15,12 @@ def dataset_mpc(dataset, imset, seed=1, n=100, out_dir=None, crop_size=80):
   r_obj = sr.get_r_obj(camera_param)
  
   for name in ns:
+    # Load every building once, the flipped building is rendered from it
+    tt = d.load_data(name, False)
+    tt.set_r_obj(r_obj)
+    tt.load_building_into_scene()
     for flip in [True, False]:
- 
-      tt = d.load_data(name, flip)
-      tt.set_r_obj(r_obj)
-      tt.load_building_into_scene()
+      tt.set_flip(flip)
 
       traversible_cc, resolution = tt.traversible, tt.map.resolution
       traversible_map = tt.map.traversible*1.
@@ -36,7 +37,6 @@ def dataset_mpc(dataset, imset, seed=1, n=100, out_dir=None, crop_size=80):
       # Render out images for each location.
       nodes = np.concatenate([loc, theta/tt.robot.delta_theta], axis=1)
       imgs = tt.render_nodes(nodes)
-      r_obj.clear_scene()
       
       # Write the maps and the images in a directory.
       if out_dir is not None:
@@ -56,6 +56,7 @@ def dataset_mpc(dataset, imset, seed=1, n=100, out_dir=None, crop_size=80):
 
         output_file = os.path.join(out_dir_, 'vis.html')
         create_webpage(output_file, n)
+    r_obj.clear_scene()
 
 def create_webpage(output_file, n):
   from yattag import Doc, indent
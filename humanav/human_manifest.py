@@ -0,0 +1,234 @@
+r"""Manifest of the SURREAL human meshes and textures. Sampling a human used
+to list and parse the surreal data directories on every call, the manifest
+indexes them once and is saved (as compact numpy columns) next to the meshes:
+  data_dir/velocity_{:.3f}_m_s/pose_dir/body_shape_{:d}/gender/human_mesh_{:d}.obj
+  texture_dir/{train, test}/gender/*.jpg
+
+It is built on first use and rebuilt when the velocity directories or the
+modification time of any other directory it listed changed (i.e. meshes or
+textures were added or removed), or explicitly with:
+  python -m humanav.human_manifest --data_dir DATA_DIR --texture_dir TEXTURE_DIR
+"""
+import os, argparse, logging, pickle
+import numpy as np
+
+MANIFEST_VERSION = 2
+MANIFEST_FILE_NAME = 'human_manifest.npz'
+TEXTURE_MODES = ['train', 'test']
+
+class HumanManifest():
+  def __init__(self, columns):
+    for k, v in columns.items():
+      setattr(self, k, v)
+    self.columns = columns
+
+    # Lookup from (pose index, body shape, gender) to the group of frames
+    self.groups = {}
+    for g in range(len(self.group_pose)):
+      key = (int(self.group_pose[g]), int(self.group_body_shape[g]), str(self.group_gender[g]))
+      self.groups[key] = g
+    self.texture_groups = dict([(str(k), i) for i, k in enumerate(self.texture_keys)])
+
+  def get_closest_velocity(self, speed):
+    """Returns the index of the velocity bin closest to speed."""
+    return np.argmin(np.abs(self.velocities-speed))
+
+  def get_poses(self, velocity_idx):
+    """Returns the indices (into pose_names) of the poses of a velocity bin,
+    sorted by pose name."""
+    start = self.pose_start[velocity_idx]
+    return np.arange(start, start + self.pose_count[velocity_idx])
+
+  def get_frames(self, pose_idx, body_shape, gender):
+    """Returns the sorted frame numbers of a pose, body shape and gender and
+    the centering pose [x, y, theta] of each frame (nan if unknown)."""
+    key = (int(pose_idx), int(body_shape), str(gender))
+    assert key in self.groups, 'No human meshes for {:s}.'.format(str(key))
+    g = self.groups[key]
+    s = slice(self.group_frame_start[g], self.group_frame_start[g] + self.group_frame_count[g])
+    return self.frames[s], self.centering[s]
+
+  def get_texture_files(self, dataset_mode, gender):
+    """Returns the sorted texture file names for dataset_mode and gender."""
+    if dataset_mode not in TEXTURE_MODES:
+      raise NotImplementedError
+    i = self.texture_groups['{:s}/{:s}'.format(dataset_mode, gender)]
+    return [str(x) for x in
+            self.texture_files[self.texture_start[i]:self.texture_start[i] + self.texture_count[i]]]
+
+  def is_stale(self):
+    """Returns whether the velocity directories changed or any other
+    directory listed to build the manifest was modified (or removed) since.
+    data_dir itself is compared by its velocity directories as saving the
+    manifest there modifies it."""
+    data_dir = str(self.data_dir)
+    velocity_dirs = _list_velocity_dirs(data_dir) if os.path.isdir(data_dir) else []
+    if sorted(velocity_dirs) != sorted([str(x) for x in self.velocity_dirs]):
+      return True
+    return not np.array_equal(_get_mtimes([str(x) for x in self.listed_dirs]),
+                              self.listed_mtimes)
+
+  @staticmethod
+  def build(data_dir, texture_dir):
+    """Indexes the human meshes in data_dir and the textures in texture_dir
+    the same way (same filtering and sorting) as they used to be listed when
+    sampling a human. The modification times of the listed directories
+    (but data_dir) are stored to detect changes."""
+    listed_dirs, listed_mtimes = [], []
+    def listdir(path):
+      # The modification time is taken first, changes while listing
+      # make the manifest stale.
+      listed_dirs.append(path)
+      listed_mtimes.append(os.stat(path).st_mtime)
+      return os.listdir(path)
+
+    velocity_dirs = _list_velocity_dirs(data_dir)
+    velocities = [float(x.split('velocity_')[1].split('_m_s')[0]) for x in velocity_dirs]
+
+    pose_names, pose_start, pose_count = [], [], []
+    group_pose, group_body_shape, group_gender = [], [], []
+    group_frame_start, group_frame_count = [], []
+    frames, centering = [], []
+    for velocity_dir in velocity_dirs:
+      velocity_dir = os.path.join(data_dir, velocity_dir)
+      poses = [x for x in listdir(velocity_dir) if not x.startswith('.')]
+      poses.sort()
+      pose_start.append(len(pose_names))
+      pose_count.append(len(poses))
+      for pose in poses:
+        pose_idx = len(pose_names)
+        pose_names.append(pose)
+        pose_dir = os.path.join(velocity_dir, pose)
+        if not os.path.isdir(pose_dir):
+          continue
+        for body_shape_dir in sorted(listdir(pose_dir)):
+          if not body_shape_dir.startswith('body_shape_'):
+            continue
+          body_shape = int(body_shape_dir.split('body_shape_')[1])
+          body_shape_dir = os.path.join(pose_dir, body_shape_dir)
+          for gender in sorted(listdir(body_shape_dir)):
+            gender_dir = os.path.join(body_shape_dir, gender)
+            if not os.path.isdir(gender_dir):
+              continue
+            frame_files = list(filter(lambda x: 'obj' in x, listdir(gender_dir)))
+            frame_numbers = [int(x.strip('.obj').split('_')[-1]) for x in frame_files]
+            frame_numbers.sort()
+            group_pose.append(pose_idx)
+            group_body_shape.append(body_shape)
+            group_gender.append(gender)
+            group_frame_start.append(len(frames))
+            group_frame_count.append(len(frame_numbers))
+            for frame in frame_numbers:
+              frames.append(frame)
+              centering.append(HumanManifest._load_centering(gender_dir, frame))
+
+    texture_keys, texture_start, texture_count, texture_files = [], [], [], []
+    if os.path.isdir(texture_dir):
+      listdir(texture_dir)
+    for mode in TEXTURE_MODES:
+      mode_dir = os.path.join(texture_dir, mode)
+      if not os.path.isdir(mode_dir):
+        continue
+      for gender in sorted(listdir(mode_dir)):
+        gender_dir = os.path.join(mode_dir, gender)
+        if not os.path.isdir(gender_dir):
+          continue
+        file_names = list(filter(lambda x: 'jpg' in x and not x.startswith('.'), listdir(gender_dir)))
+        file_names.sort()
+        texture_keys.append('{:s}/{:s}'.format(mode, gender))
+        texture_start.append(len(texture_files))
+        texture_count.append(len(file_names))
+        texture_files += file_names
+
+    columns = {'version': np.array(MANIFEST_VERSION),
+               'data_dir': np.array(data_dir),
+               'texture_dir': np.array(texture_dir),
+               'velocity_dirs': np.array(velocity_dirs, dtype=str),
+               'velocities': np.array(velocities, dtype=np.float64),
+               'pose_names': np.array(pose_names, dtype=str),
+               'pose_start': np.array(pose_start, dtype=np.int64),
+               'pose_count': np.array(pose_count, dtype=np.int64),
+               'group_pose': np.array(group_pose, dtype=np.int64),
+               'group_body_shape': np.array(group_body_shape, dtype=np.int64),
+               'group_gender': np.array(group_gender, dtype=str),
+               'group_frame_start': np.array(group_frame_start, dtype=np.int64),
+               'group_frame_count': np.array(group_frame_count, dtype=np.int64),
+               'frames': np.array(frames, dtype=np.int64),
+               'centering': np.reshape(np.array(centering, dtype=np.float64), (-1, 3)),
+               'texture_keys': np.array(texture_keys, dtype=str),
+               'texture_start': np.array(texture_start, dtype=np.int64),
+               'texture_count': np.array(texture_count, dtype=np.int64),
+               'texture_files': np.array(texture_files, dtype=str),
+               'listed_dirs': np.array(listed_dirs, dtype=str),
+               'listed_mtimes': np.array(listed_mtimes, dtype=np.float64)}
+    return HumanManifest(columns)
+
+  @staticmethod
+  def _load_centering(gender_dir, frame):
+    centering_file = os.path.join(gender_dir, 'human_centering_info_{:d}.pkl'.format(frame))
+    if not os.path.exists(centering_file):
+      return [np.nan, np.nan, np.nan]
+    with open(centering_file, 'rb') as f:
+      centering_data = pickle.load(f)
+    return np.reshape(centering_data['human_pos_3'], (3))
+
+  def save(self, file_name):
+    tmp_file_name = file_name + '.tmp.npz'
+    np.savez(tmp_file_name, **self.columns)
+    os.rename(tmp_file_name, file_name)
+
+  @staticmethod
+  def load(file_name):
+    with np.load(file_name, allow_pickle=False) as data:
+      columns = dict([(k, data[k]) for k in data.files])
+    return HumanManifest(columns)
+
+def _list_velocity_dirs(data_dir):
+  return [x for x in os.listdir(data_dir) if os.path.isdir(os.path.join(data_dir, x))]
+
+def _get_mtimes(dirs):
+  """Returns the modification times of dirs, nan for missing ones."""
+  mtimes = []
+  for d in dirs:
+    try:
+      mtimes.append(os.stat(d).st_mtime)
+    except OSError:
+      mtimes.append(np.nan)
+  return np.array(mtimes, dtype=np.float64)
+
+def get_human_manifest(data_dir, texture_dir, manifest_file=None, rebuild=False):
+  """Returns the manifest of the humans in data_dir and texture_dir. It is
+  loaded from manifest_file (default data_dir/human_manifest.npz) if it
+  exists, matches and is not stale (see HumanManifest.is_stale), else built
+  and saved there (if possible)."""
+  if manifest_file is None:
+    manifest_file = os.path.join(data_dir, MANIFEST_FILE_NAME)
+  if not rebuild and os.path.exists(manifest_file):
+    manifest = HumanManifest.load(manifest_file)
+    if (int(manifest.version) == MANIFEST_VERSION and str(manifest.data_dir) == data_dir and
+        str(manifest.texture_dir) == texture_dir):
+      if not manifest.is_stale():
+        return manifest
+      logging.warning('Rebuilding human manifest %s, the humans changed.', manifest_file)
+    else:
+      logging.warning('Rebuilding human manifest %s, it does not match.', manifest_file)
+
+  logging.error('Building human manifest for %s.', data_dir)
+  manifest = HumanManifest.build(data_dir, texture_dir)
+  try:
+    manifest.save(manifest_file)
+  except (IOError, OSError) as e:
+    logging.warning('Could not save human manifest %s (%s), keeping it in memory.',
+                    manifest_file, e)
+  return manifest
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Build the manifest of the SURREAL human meshes.')
+  parser.add_argument('--data_dir', required=True, help='Human mesh directory (surreal.data_dir).')
+  parser.add_argument('--texture_dir', required=True, help='Human texture directory (surreal.texture_dir).')
+  parser.add_argument('--manifest_file', default=None)
+  args = parser.parse_args(argv)
+  get_human_manifest(args.data_dir, args.texture_dir, args.manifest_file, rebuild=True)
+
+if __name__ == '__main__':
+  main()
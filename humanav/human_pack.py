@@ -0,0 +1,154 @@
+r"""Packed human animation format. The surreal export writes one
+human_mesh_{frame}.obj (and one human_centering_info_{frame}.pkl) per frame,
+but all SMPL frames of a body shape and gender share the same faces and
+texture coordinates. The packed format stores
+  data_dir/packed_topology_body_shape_{:d}_{:s}.npz  (faces, uvs, mesh name)
+once per body shape and gender, and in every pose/body_shape/gender directory
+  packed_vertices.npy   (frames x V x 3, float32 or float16)
+  packed_frames.npy     (frame numbers)
+  packed_centering.npy  (frames x 3, centering pose of every frame)
+The vertices are memory mapped when a frame is loaded.
+
+The packed files are written from the existing obj tree with:
+  python -m humanav.human_pack --data_dir DATA_DIR [--float16]
+"""
+import os, sys, argparse, logging, pickle
+import numpy as np
+
+# Py27 vs Py3 imports
+if sys.version_info[0] == 2:
+    from render import swiftshader_renderer as renderer
+else:
+    from humanav.render import swiftshader_renderer as renderer
+
+VERTICES_FILE = 'packed_vertices.npy'
+FRAMES_FILE = 'packed_frames.npy'
+CENTERING_FILE = 'packed_centering.npy'
+
+def get_topology_file(data_dir, body_shape, gender):
+  # A file (not a directory) so that it is not mistaken for a velocity bin
+  return os.path.join(data_dir, 'packed_topology_body_shape_{:d}_{:s}.npz'.format(body_shape, gender))
+
+def _parse_mesh_dir(mesh_dir):
+  """Returns the data_dir, body shape and gender of a
+  data_dir/velocity_dir/pose_dir/body_shape_dir/gender mesh directory."""
+  body_shape_dir, gender = os.path.split(os.path.normpath(mesh_dir))
+  pose_dir, body_shape_str = os.path.split(body_shape_dir)
+  data_dir = os.path.dirname(os.path.dirname(pose_dir))
+  body_shape = int(body_shape_str.split('body_shape_')[1])
+  return data_dir, body_shape, gender
+
+class PackedHumanLoader():
+  """Loads frames of packed human sequences. The (small) topologies are kept
+  in memory, the vertices are memory mapped on every load."""
+  def __init__(self):
+    self.topologies = {}
+
+  def _get_topology(self, data_dir, body_shape, gender):
+    key = (data_dir, body_shape, gender)
+    if key not in self.topologies:
+      with np.load(get_topology_file(data_dir, body_shape, gender), allow_pickle=False) as data:
+        self.topologies[key] = (data['faces'], data['uvs'], str(data['name']))
+    return self.topologies[key]
+
+  def is_packed(self, mesh_dir):
+    return os.path.exists(os.path.join(mesh_dir, VERTICES_FILE))
+
+  def load_frame(self, mesh_dir, frame, human_materials, name_prefix=''):
+    """Returns the HumanShape-like renderer.ArrayShape of frame in mesh_dir
+    and its centering pose."""
+    data_dir, body_shape, gender = _parse_mesh_dir(mesh_dir)
+    faces, uvs, name = self._get_topology(data_dir, body_shape, gender)
+    frames = np.load(os.path.join(mesh_dir, FRAMES_FILE))
+    i = np.searchsorted(frames, frame)
+    assert i < len(frames) and frames[i] == frame, \
+        'Frame {:d} is not packed in {:s}.'.format(int(frame), mesh_dir)
+    vertices = np.load(os.path.join(mesh_dir, VERTICES_FILE), mmap_mode='r')
+    vertices = np.asarray(vertices[i], dtype=np.float32)
+    centering = np.load(os.path.join(mesh_dir, CENTERING_FILE))[i]
+    mesh = renderer.ArrayShape.make_mesh(name_prefix + name + '_{:05d}'.format(0), vertices,
+                                         faces, uvs)
+    return renderer.ArrayShape([mesh], human_materials), centering
+
+  def load_sequence(self, mesh_dir):
+    """Returns the frame numbers, the (frames x V x 3, float32) vertices and
+    the centering poses of all frames in mesh_dir and their shared faces,
+    uvs and mesh name."""
+    data_dir, body_shape, gender = _parse_mesh_dir(mesh_dir)
+    faces, uvs, name = self._get_topology(data_dir, body_shape, gender)
+    frames = np.load(os.path.join(mesh_dir, FRAMES_FILE))
+    vertices = np.load(os.path.join(mesh_dir, VERTICES_FILE), mmap_mode='r')
+    centering = np.load(os.path.join(mesh_dir, CENTERING_FILE))
+    return frames, np.asarray(vertices, dtype=np.float32), centering, faces, uvs, name
+
+def pack_sequence(mesh_dir, dtype=np.float32, overwrite=False):
+  """Packs the human_mesh_{:d}.obj frames in mesh_dir. Returns False (and
+  packs nothing) if the faces or texture coordinates of a frame differ from
+  those of the body shape and gender."""
+  if not overwrite and os.path.exists(os.path.join(mesh_dir, VERTICES_FILE)):
+    return True
+  data_dir, body_shape, gender = _parse_mesh_dir(mesh_dir)
+  frame_files = list(filter(lambda x: 'obj' in x, os.listdir(mesh_dir)))
+  frame_numbers = [int(x.strip('.obj').split('_')[-1]) for x in frame_files]
+  frame_numbers.sort()
+  if len(frame_numbers) == 0:
+    return False
+
+  topology_file = get_topology_file(data_dir, body_shape, gender)
+  topology = None
+  if os.path.exists(topology_file):
+    with np.load(topology_file, allow_pickle=False) as data:
+      topology = (data['faces'], data['uvs'], str(data['name']))
+
+  vertices, centering = [], []
+  for frame in frame_numbers:
+    human = renderer.HumanShape(os.path.join(mesh_dir, 'human_mesh_{:d}.obj'.format(frame)), None)
+    assert(human.get_number_of_meshes() == 1)
+    mesh = human.meshes[0]
+    # Mesh names are suffixed with their index, see HumanShape
+    name = mesh.name.rsplit('_', 1)[0]
+    faces, uvs = np.array(mesh.faces), np.array(mesh.texturecoords[0,:,:2])
+    if topology is None:
+      topology = (faces, uvs, name)
+    if not (np.array_equal(topology[0], faces) and np.array_equal(topology[1], uvs)):
+      logging.error('Topology of %s frame %d does not match, not packing it.', mesh_dir, frame)
+      return False
+    vertices.append(np.array(mesh.vertices, dtype=dtype))
+
+    centering_file = os.path.join(mesh_dir, 'human_centering_info_{:d}.pkl'.format(frame))
+    with open(centering_file, 'rb') as f:
+      centering.append(np.reshape(pickle.load(f)['human_pos_3'], (3)))
+
+  if not os.path.exists(topology_file):
+    np.savez(topology_file, faces=topology[0], uvs=topology[1], name=np.array(topology[2]))
+  np.save(os.path.join(mesh_dir, FRAMES_FILE), np.array(frame_numbers, dtype=np.int64))
+  np.save(os.path.join(mesh_dir, CENTERING_FILE), np.array(centering, dtype=np.float64))
+  # The vertices are written last, they mark the sequence as packed
+  tmp_file = os.path.join(mesh_dir, 'tmp_' + VERTICES_FILE)
+  np.save(tmp_file, np.stack(vertices, axis=0))
+  os.rename(tmp_file, os.path.join(mesh_dir, VERTICES_FILE))
+  return True
+
+def pack_human_meshes(data_dir, dtype=np.float32, overwrite=False):
+  """Packs every pose/body_shape/gender directory of data_dir."""
+  num_packed, num_failed = 0, 0
+  for dir_name, _, file_names in os.walk(data_dir):
+    if not any([x.startswith('human_mesh_') for x in file_names]):
+      continue
+    if pack_sequence(dir_name, dtype, overwrite):
+      num_packed += 1
+    else:
+      num_failed += 1
+  logging.info('Packed %d human sequences, %d could not be packed.', num_packed, num_failed)
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Pack the exported human meshes into per sequence arrays.')
+  parser.add_argument('--data_dir', required=True, help='Human mesh directory (surreal.data_dir).')
+  parser.add_argument('--float16', action='store_true', help='Store the vertices as float16.')
+  parser.add_argument('--overwrite', action='store_true')
+  args = parser.parse_args(argv)
+  logging.getLogger().setLevel(logging.INFO)
+  pack_human_meshes(args.data_dir, np.float16 if args.float16 else np.float32, args.overwrite)
+
+if __name__ == '__main__':
+  main()
@@ -19,10 +19,16 @@ class HumANavRenderer():
     def __init__(self, params):
         self.p = params
         self.human_texture = None
+        # Whether the building is currently flipped. Kept here rather than in
+        # self.p, the caller's params, which the caller may change before
+        # calling get_renderer again.
+        self._flip = params.flip
 
         if self.p.load_meshes:
             self.d = sbpd.get_dataset(self.p.dataset_name, 'all', data_dir=self.p.sbpd_data_dir, surreal_params=self.p.surreal)
-            self.building = self.d.load_data(self.p.building_name, self.p.robot_params, self.p.flip)
+            tile_size = self.p.building_tile_size if self.p.stream_building_tiles else None
+            self.building = self.d.load_data(self.p.building_name, self.p.robot_params, self.p.flip,
+                                             tile_size=tile_size, occupancy_mode=self.p.occupancy_mode)
             self.human_loaded = False
 
             # Instantiating a camera/ shader object is only needed
@@ -36,7 +42,10 @@ class HumANavRenderer():
 
                 r_obj = sr.get_r_obj(self.p.camera_params)
                 self.building.set_r_obj(r_obj)
-                self.building.load_building_into_scene()
+                # Stream the tiles within the far clipping plane of the camera
+                stream_radius = self.p.camera_params.z_far if self.p.stream_building_tiles else None
+                self.building.load_building_into_scene(compile_static=self.p.compile_static_scene,
+                                                       stream_radius=stream_radius)
             elif 'occupancy_grid' in self.p.camera_params.modalities:
                 # MP Env only allows for square top views to be generated currently
                 assert(self.p.camera_params.width == self.p.camera_params.height)
@@ -50,12 +59,14 @@ class HumANavRenderer():
     def get_renderer(cls, params):
         """
         Used to instantiate a renderer object. Ensures that only one renderer
-        object ever exists as they are very memory intensive.
+        object ever exists as they are very memory intensive. Flipped and
+        unflipped buildings are served by the same renderer (see set_flip).
         """
         r = cls.renderer
         if r is not None:
-            dn, bn, f, c = r.p.dataset_name, r.p.building_name, r.p.flip, r.p.modalities
-            if dn == params.dataset_name and bn == params.building_name and f == params.flip and c == params.modalities:
+            dn, bn, c = r.p.dataset_name, r.p.building_name, r.p.modalities
+            if dn == params.dataset_name and bn == params.building_name and c == params.modalities:
+                r.set_flip(params.flip)
                 return r
             else:
                 assert False, "Renderer settings are different than previously instantiated renderer"
@@ -63,6 +74,20 @@ class HumANavRenderer():
         cls.renderer = cls(params)
         return cls.renderer
 
+    def set_flip(self, flip):
+        """
+        Switches between the building and its mirror image
+        without reloading it. Any humans are removed.
+        """
+        if flip == self._flip:
+            return
+        if self.p.load_meshes:
+            self.remove_human()
+            self.building.set_flip(flip)
+            if hasattr(self, 'human_traversible'):
+                self.human_traversible = self.building.map._human_traversible
+        self._flip = flip
+
     def render_images(self, starts_n2, thetas_n1, crop_size=None, human_visible=True):
         """
         Render the corresponding image from
@@ -75,7 +100,9 @@ class HumANavRenderer():
                 crop_size = [p.width, p.height]
             imgs = self._get_topview(starts_n2, thetas_n1, crop_size=crop_size)
         elif 'rgb' in p.modalities:
-            imgs = self._get_rgb_image(starts_n2, thetas_n1, human_visible=human_visible)
+            # Render multiple poses in one tiled framebuffer
+            imgs = self._get_rgb_image(starts_n2, thetas_n1, human_visible=human_visible,
+                                       batched=len(starts_n2) > 1)
         elif 'disparity' in p.modalities:
             return
         else:
@@ -94,7 +121,8 @@ class HumANavRenderer():
                     'body_shape': body_shape}
         return identity
 
-    def add_human_with_known_identity_at_position_with_speed(self, pos_3, speed, mesh_rng, identity, allow_repeat_humans=False):
+    def add_human_with_known_identity_at_position_with_speed(self, pos_3, speed, mesh_rng, identity, allow_repeat_humans=False,
+                                                             human_id=0):
         human_gender = identity['human_gender']
         human_texture = identity['human_texture']
         body_shape = identity['body_shape']
@@ -106,14 +134,17 @@ class HumANavRenderer():
         self.building.load_human_into_scene(self.d, pos_3, speed,
                                             human_gender, human_texture,
                                             body_shape, mesh_rng,
-                                            allow_repeat_humans=allow_repeat_humans)
+                                            allow_repeat_humans=allow_repeat_humans,
+                                            human_id=human_id)
         human_mesh_params = self.building.human_mesh_info
         return human_mesh_params
 
-    def add_human_at_position_with_speed(self, pos_3, speed, identity_rng, mesh_rng, only_sample_human_identity=False):
+    def add_human_at_position_with_speed(self, pos_3, speed, identity_rng, mesh_rng, only_sample_human_identity=False,
+                                         human_id=0):
         """
         Inserts a human mesh at [x, y, theta]
-        specified by pos_3.
+        specified by pos_3. Several humans can be
+        added, each with a different human_id.
         """
         if self.p.load_meshes:
             # Sample a human gender, texture, body_shape
@@ -124,7 +155,8 @@ class HumANavRenderer():
                 # Load the human mesh into the scene
                 self.building.load_human_into_scene(self.d, pos_3, speed,
                                                     self.human_gender, self.human_texture,
-                                                    self.body_shape, mesh_rng)
+                                                    self.body_shape, mesh_rng,
+                                                    human_id=human_id)
 
                 # Log that there is a human in the environment
                 self.human_loaded = True
@@ -138,38 +170,55 @@ class HumANavRenderer():
                     self.human_radius = self.default_human_radius
                 self.human_mesh_params = self.building.human_mesh_info
 
-    def remove_human(self):
+    def remove_human(self, human_id=None):
         """
         If a human mesh has been loaded into the SBPD
-        environment, remove it.
+        environment, remove it. If human_id is None
+        all humans are removed.
         """
         if self.p.load_meshes:
             if self.human_loaded:
-                self.building.remove_human()
-                self.human_loaded = False
-                self.human_texture = None
+                self.building.remove_human(human_id)
+                self.human_loaded = len(self.building.humans) > 0
+                self.human_traversible = self.building.map._human_traversible
+                if not self.human_loaded:
+                    self.human_texture = None
 
-    def move_human_to_position_with_speed(self, pos_3, speed, mesh_rng):
+    def move_human_to_position_with_speed(self, pos_3, speed, mesh_rng, human_id=0):
         """
         Moves an existing human mesh to the pos_3 (
         [x, y, theta]) in the mesh.
         """
         if self.p.load_meshes:
-            self.building.move_human_to_position_with_speed(self.d, pos_3, speed, self.human_gender,
-                                                            self.human_texture, self.body_shape, mesh_rng)
+            human = self.building.humans[human_id]
+            self.building.move_human_to_position_with_speed(self.d, pos_3, speed, human['gender'],
+                                                            human['materials'], human['body_shape'],
+                                                            mesh_rng, human_id=human_id)
             self.human_traversible = self.building.map._human_traversible
 
-    def _get_rgb_image(self, starts_n2, thetas_n1, human_visible):
+    def move_humans(self, human_ids, poses_n3, speeds_n, mesh_rng):
+        """
+        Moves the existing humans human_ids to poses_n3
+        ([x, y, theta]) with speeds_n, all before the
+        next render.
+        """
+        if self.p.load_meshes:
+            self.building.move_humans(self.d, human_ids, poses_n3, speeds_n, mesh_rng)
+            self.human_traversible = self.building.map._human_traversible
+
+    def _get_rgb_image(self, starts_n2, thetas_n1, human_visible, batched=False):
         """
         Render rgb image(s) from the x, y, theta
-        location in starts and thetas.
+        location in starts and thetas. If batched is True
+        all images are rendered and read back in one pass.
         """
         if self.p.load_meshes:
             # Scale thetas by 1/delta_theta as the building object
             # internally scales theta by delta_theta
             nodes_n3 = np.concatenate([starts_n2*1.,
                                        thetas_n1 / self.building.robot.delta_theta], axis=1)
-            imgs_nmk3 = self.building.render_nodes(nodes_n3, modality='rgb', human_visible=human_visible)
+            imgs_nmk3 = self.building.render_nodes(nodes_n3, modality='rgb', human_visible=human_visible,
+                                                   batched=batched)
         else:
             width = self.p.camera_params.width
             height = self.p.camera_params.height
@@ -200,25 +249,50 @@ class HumANavRenderer():
 
         crops_nmk = mu.generate_egocentric_maps([traversible_map], [1.0], [crop_size[0]],
                                                 starts_n2, x_axis_n2, y_axis_n2, dst_theta=0.,
-                                                dst_loc=robot_loc_2)[0]
+                                                dst_loc=robot_loc_2, batched=True)[0]
 
         # Invert the crops so that 1.0 corresponds to occupied space
         # and 0.0 corresponds to free space
-        crops_nmk1 = [np.logical_not(crop_mk[:, :, None])*1.0 for crop_mk in crops_nmk]
-        return np.array(crops_nmk1)
+        return np.logical_not(crops_nmk[:, :, :, None])*1.0
+
+    def _get_rgb_and_disparity_image(self, starts_n2, thetas_n1, human_visible=True, batched=False):
+        """
+        Render rgb and disparity image(s) from the x, y, theta
+        location in starts and thetas using a single traversal
+        of the scene per location. Returns a dictionary with keys
+        'rgb' and 'disparity'.
+        """
+        if self.p.load_meshes:
+            nodes_n3 = np.concatenate([starts_n2*1.,
+                                       thetas_n1 / self.building.robot.delta_theta], axis=1)
+            imgs = self.building.render_nodes(nodes_n3, modality=['rgb', 'disparity'],
+                                              human_visible=human_visible, batched=batched)
+        else:
+            width = self.p.camera_params.width
+            height = self.p.camera_params.height
+            resize = self.p.camera_params.im_resize
+            width = int(width*resize)
+            height = int(height*resize)
+            n = len(starts_n2)
+            imgs = {'rgb': np.zeros((n, width, height, 3), dtype=np.float32),
+                    'disparity': np.zeros((n, width, height, 1), dtype=np.float32)}
+        return {'rgb': np.array(imgs['rgb']), 'disparity': np.array(imgs['disparity'])}
 
-    def _get_depth_image(self, starts_n2, thetas_n1, xy_resolution, map_size, pos_3, human_visible=True):
+    def _get_depth_image(self, starts_n2, thetas_n1, xy_resolution, map_size, pos_3, human_visible=True,
+                         disparity_imgs_cm=None):
         """
         Render analytically projected depth images at the locations in
         starts, thetas. Bin data inside bins in a resolution of xy_resolution along x and y axis and
-        z_bins in the z direction. Z Direction is the vertical z = 0 is floor. """
+        z_bins in the z direction. Z Direction is the vertical z = 0 is floor. If disparity_imgs_cm
+        is given (i.e. from _get_rgb_and_disparity_image) it is used instead of rendering again. """
         r_obj = self.building.r_obj
         robot = self.building.robot
         z_bins = [-10, robot.base, robot.base + robot.height]
 
-        nodes_n3 = np.concatenate([starts_n2*1., thetas_n1 / self.building.robot.delta_theta], axis=1)
-        # Disparity in centimeters
-        disparity_imgs_cm = np.array(self.building.render_nodes(nodes_n3, 'disparity', human_visible=human_visible))
+        if disparity_imgs_cm is None:
+            nodes_n3 = np.concatenate([starts_n2*1., thetas_n1 / self.building.robot.delta_theta], axis=1)
+            # Disparity in centimeters
+            disparity_imgs_cm = np.array(self.building.render_nodes(nodes_n3, 'disparity', human_visible=human_visible))
 
         depth_imgs_meters = 100. / disparity_imgs_cm[..., 0]
 
@@ -0,0 +1,79 @@
+r"""On disk cache of the map of a building (Building.map): its origin and size,
+the traversible and the grids it is computed from. Computing the
+traversibility samples points on every face of the building, a Building of a
+known configuration loads the cached map instead. The cache is keyed by a
+hash of the robot and env params, flip and the mesh file, and stored as .npy
+files (memory mapped when loaded) in
+  data_dir/cache/building_name/map_{key}/
+"""
+import os, sys, logging, pickle, hashlib
+import numpy as np
+
+# Py27 vs Py3 imports
+if sys.version_info[0] == 2:
+    import utils
+else:
+    from humanav import utils
+
+CACHE_VERSION = 1
+SCALAR_NAMES = ['origin', 'size', 'max', 'resolution', 'padding']
+ARRAY_NAMES = ['traversible', '_traversible', '_human_traversible', 'obstacle_free',
+               'valid_space', 'num_points', 'num_obstcale_points']
+
+# Params that do not change the map
+IGNORED_PARAMS = ['max_sample_bytes']
+
+def _get_items(params):
+  items = params.items() if isinstance(params, dict) else vars(params).items()
+  return sorted([(str(k), repr(v)) for k, v in items if k not in IGNORED_PARAMS])
+
+def get_map_key(robot, env, flip, mesh_file, restrict_to_largest_cc=True):
+  """Returns the hash of everything the map of a building depends on. The
+  mesh file is identified by its path, size and modification time."""
+  mesh_stat = None
+  if mesh_file is not None and os.path.exists(mesh_file):
+    stat = os.stat(mesh_file)
+    mesh_stat = (stat.st_size, int(stat.st_mtime))
+  key = [('version', CACHE_VERSION), ('robot', _get_items(robot)), ('env', _get_items(env)),
+         ('flip', bool(flip)), ('mesh_file', mesh_file, mesh_stat),
+         ('restrict_to_largest_cc', bool(restrict_to_largest_cc))]
+  return hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+def get_cache_dir(building, key):
+  """Returns the map cache directory of building (as returned by
+  Loader.load_building) for key (see get_map_key)."""
+  return os.path.join(building['data_dir'], 'cache', building['name'], 'map_' + key)
+
+def save_map(map, cache_dir):
+  """Writes map to cache_dir. The header is written last, a cache without
+  header is incomplete and ignored."""
+  utils.mkdir_if_missing(cache_dir)
+  header = {'version': CACHE_VERSION, 'arrays': []}
+  for name in SCALAR_NAMES:
+    header[name] = getattr(map, name)
+  for name in ARRAY_NAMES:
+    if hasattr(map, name):
+      np.save(os.path.join(cache_dir, name + '.npy'), np.asarray(getattr(map, name)))
+      header['arrays'].append(name)
+
+  header_file = os.path.join(cache_dir, 'header.pkl')
+  with open(header_file + '.tmp', 'wb') as f:
+    pickle.dump(header, f, protocol=2)
+  os.rename(header_file + '.tmp', header_file)
+
+def load_map(cache_dir):
+  """Returns the map cached in cache_dir, with memory mapped (read only)
+  arrays, or None if there is no valid cache."""
+  header_file = os.path.join(cache_dir, 'header.pkl')
+  if not os.path.exists(header_file):
+    return None
+  with open(header_file, 'rb') as f:
+    header = pickle.load(f)
+  if header['version'] != CACHE_VERSION:
+    logging.warning('Ignoring map cache %s, it does not match.', cache_dir)
+    return None
+
+  map = utils.Foo(**dict([(name, header[name]) for name in SCALAR_NAMES]))
+  for name in header['arrays']:
+    setattr(map, name, np.load(os.path.join(cache_dir, name + '.npy'), mmap_mode='r'))
+  return map
@@ -0,0 +1,43 @@
+r"""Post-processing of the map grids into the traversible: filling small holes,
+dilating obstacles by the robot radius and picking the largest connected
+component. The functions give the same results as the straightforward
+implementations (label loop, disk footprint, relabelling) they replace in
+map_utils, see benchmarks/map_postprocess.py:
+  python benchmarks/map_postprocess.py --data_dir /PATH/TO/sbpd_data_dir
+"""
+import numpy as np, scipy.ndimage
+from skimage import morphology
+
+def fill_holes(img, thresh):
+  """Fills holes less than thresh area (assumes 4 connectivity when computing
+  hole area). The holes are labelled once and filled through a lookup table
+  of the label sizes."""
+  labels, _ = scipy.ndimage.label(np.logical_not(img))
+  cnts = np.bincount(labels.reshape(-1))
+  # Label 0 are the pixels of img, they stay set
+  return np.logical_or(img == True, (cnts < thresh)[labels])
+
+# Radius (in pixels) from which dilating through the distance transform is
+# faster than with the disk footprint (on maps with many obstacles, on
+# sparse maps from much smaller radii)
+MIN_DISTANCE_TRANSFORM_RADIUS = 20
+
+def dilate_disk(img, radius):
+  """Returns morphology.binary_dilation(img, morphology.disk(radius)). For an
+  integral radius the disk is centered on a pixel and the dilation is a
+  threshold of the distance transform, whose cost does not grow with the
+  radius. Small radii, and other radii (which give an off center disk) are
+  dilated with the disk footprint."""
+  img = img == True
+  if radius != np.round(radius) or radius < MIN_DISTANCE_TRANSFORM_RADIUS:
+    return morphology.binary_dilation(img, morphology.disk(radius))
+  if not np.any(img):
+    return img
+  return scipy.ndimage.distance_transform_edt(np.logical_not(img)) <= radius
+
+def largest_component(img):
+  """Returns the largest connected component of img, labelled once and
+  picked from the label counts."""
+  labels, _ = scipy.ndimage.label(img)
+  cnt = np.bincount(labels.reshape(-1))[1:]
+  return labels == np.argmax(cnt) + 1
@@ -15,7 +15,8 @@
 
 """Various function to compute the ground truth map for training etc.
 """
-import copy
+import copy, collections, functools, multiprocessing
+from concurrent.futures import ThreadPoolExecutor
 from skimage import morphology
 import numpy as np, scipy.ndimage
 import PIL
@@ -23,8 +24,35 @@ import cv2
 import sys
 if sys.version_info[0] == 2:
     from . import utils
+    from . import map_postprocess
 else:
     from humanav import utils #py3
+    from humanav import map_postprocess
+
+# Upper bound on the memory used per point sampled on the faces of a mesh
+# (random numbers, vertices of its face, the point, its weight, cell and
+# temporaries), used to size the chunks of faces in compute_traversibility.
+SAMPLE_BYTES_PER_POINT = 320
+MAX_SAMPLE_BYTES = 512*1024*1024
+
+# Occupancy of the map cells is either estimated from points sampled on the
+# faces ('sample') or computed exactly by clipping the faces to the cells
+# ('exact'). Both give the area (in sc units) of the faces over every cell.
+OCCUPANCY_MODES = ['sample', 'exact']
+# Upper bound on the memory used per piece of a face clipped to a map cell
+POLYGON_BYTES = 2048
+
+# Number of crops get_map_to_predict_batched samples at once, and the fixed
+# point precision (in bits of pixels) cv2.warpAffine computes sampling points
+# with (AB_BITS) and rounds them to (INTER_BITS)
+CROP_CHUNK_SIZE = 256
+AB_BITS = 10
+AB_SCALE = 1 << AB_BITS
+INTER_BITS = 5
+INTER_TAB_SIZE = 1 << INTER_BITS
+# Faces whose map bounding boxes are computed at once when splitting a mesh
+# into chunks for the exact occupancy
+FACE_BLOCK_SIZE = 65536
 
 def _get_xy_bounding_box(vertex, padding):
   """Returns the xy bounding box of the environment."""
@@ -46,13 +74,173 @@ def _project_to_map(map, vertex, wt=None, ignore_points_outside_map=False):
     if wt is not None:
       wt = wt[good_ind, :]
   if wt is None:
-    np.add.at(num_points, (vertex_[:, 1], vertex_[:, 0]), 1)
+    wt = np.ones(vertex_.shape[0])
   else:
     assert(wt.shape[0] == vertex.shape[0]), \
       'number of weights should be same as vertices.'
+  in_map = (np.all(vertex_ >= 0) and np.all(vertex_[:, 1] < map.size[1]) and
+            np.all(vertex_[:, 0] < map.size[0]))
+  if in_map:
+    # np.bincount sums in the same order as np.add.at, and is much faster
+    cells = vertex_[:, 1]*map.size[0] + vertex_[:, 0]
+    num_points = np.bincount(cells, weights=wt, minlength=num_points.size)
+    num_points = np.reshape(num_points, (map.size[1], map.size[0]))
+  else:
     np.add.at(num_points, (vertex_[:, 1], vertex_[:, 0]), wt)
   return num_points
 
+def _get_map_cells(map, vertex):
+  """Returns the (flat) map cells of points vertex, which must be inside
+  the map."""
+  vertex_ = vertex[:, :2] - map.origin
+  vertex_ = np.round(vertex_ / map.resolution).astype(np.int)
+  return vertex_[:, 1]*map.size[0] + vertex_[:, 0]
+
+def _accumulate(grid, cells, wt):
+  """Adds wt at the cells of the flat grid in order. Bit identical to
+  np.add.at(grid, cells, wt): the current values of the cells are prepended
+  to the weights so that np.bincount continues their sums."""
+  cells, inverse = np.unique(cells, return_inverse=True)
+  n = cells.shape[0]
+  grid[cells] = np.bincount(np.concatenate([np.arange(n), np.reshape(inverse, (-1))]),
+                            weights=np.concatenate([grid[cells], wt]), minlength=n)
+
+def _sample_chunk_cells(map, sampler, n_samples_per_face, z_ranges):
+  """Samples points on a chunk of faces (see Shape.iter_point_samplers) and
+  returns the map cells and weights of the points within each z range."""
+  p, face_areas, face_idx = sampler()
+  wt = face_areas[face_idx]/n_samples_per_face
+  cells_wts = []
+  for z_min, z_max in z_ranges:
+    ind = np.all(np.concatenate(
+      (p[:, [2]] > z_min, p[:, [2]] < z_max), axis=1),axis=1)
+    cells_wts.append((_get_map_cells(map, p[ind, :]), wt[ind]))
+  return cells_wts
+
+def _clip_polygons(pts, n, axis, offset, sign, strict):
+  """Clips the convex polygons pts (N x K x 3, the first n of every row are
+  vertices) to the half space sign*(pts[..., axis] - offset) > 0 (>= 0 if not
+  strict), with a vectorized Sutherland-Hodgman step on the polygons that
+  cross the plane. Returns the clipped polygons and their number of
+  vertices, trimmed to the largest polygon."""
+  k = pts.shape[1]
+  ks = np.arange(k)[np.newaxis, :]
+  valid = ks < n[:, np.newaxis]
+  d = sign*(pts[:, :, axis] - offset[:, np.newaxis])
+  inside = d > 0 if strict else d >= 0
+  num_inside = np.sum(np.logical_and(valid, inside), axis=1)
+  n = np.where(num_inside == 0, 0, n)
+  crossing_rows = np.where(np.logical_and(num_inside > 0, num_inside < n))[0]
+
+  if crossing_rows.shape[0] > 0:
+    pts_, n_, d, inside = pts[crossing_rows], n[crossing_rows], d[crossing_rows], inside[crossing_rows]
+    rows = np.arange(crossing_rows.shape[0])[:, np.newaxis]
+    valid = ks < n_[:, np.newaxis]
+    nxt = np.where(ks + 1 < n_[:, np.newaxis], ks + 1, 0)
+    pts_nxt, d_nxt, inside_nxt = pts_[rows, nxt], d[rows, nxt], inside[rows, nxt]
+
+    # Every edge adds its intersection with the plane if it crosses it and
+    # its end point if that is inside
+    crossing = np.logical_and(valid, inside != inside_nxt)
+    with np.errstate(divide='ignore', invalid='ignore'):
+      t = np.where(crossing, d / (d - d_nxt), 0.)
+    keep = np.stack([crossing, np.logical_and(valid, inside_nxt)], axis=2).reshape(-1, 2*k)
+    r, c = np.nonzero(keep)
+    out = np.stack([pts_ + t[..., np.newaxis]*(pts_nxt - pts_), pts_nxt], axis=2)
+    out = out.reshape(-1, 2*k, 3)[r, c]
+
+    pts = np.concatenate([pts, np.zeros_like(pts[:, :1])], axis=1)
+    pts[crossing_rows[r], (np.cumsum(keep, axis=1) - 1)[r, c]] = out
+    n = n.copy()
+    n[crossing_rows] = np.sum(keep, axis=1)
+  return pts[:, :max(3, n.max() if n.size > 0 else 0)], n
+
+def _polygon_areas(pts, n):
+  """Returns the areas of the planar convex polygons pts (see _clip_polygons)."""
+  e1 = pts[:, 1:-1, :] - pts[:, :1, :]
+  e2 = pts[:, 2:, :] - pts[:, :1, :]
+  valid = np.arange(2, pts.shape[1])[np.newaxis, :] < n[:, np.newaxis]
+  c = np.cross(e1, e2)*valid[..., np.newaxis]
+  return 0.5*np.linalg.norm(np.sum(c, axis=1), axis=1)
+
+def _clip_triangles_to_z_range(tri, z_min, z_max):
+  """Clips the triangles tri (N x 3 x 3) to z_min < z < z_max. Returns the
+  non empty polygons (see _clip_polygons)."""
+  pts, n = tri, np.full(tri.shape[0], 3)
+  for offset, sign in [(z_min, 1.), (z_max, -1.)]:
+    pts, n = _clip_polygons(pts, n, 2, np.full(n.shape[0], offset, dtype=np.float64), sign, True)
+    pts, n = pts[n >= 3], n[n >= 3]
+  return pts, n
+
+def _rasterize_polygons(map, pts, n):
+  """Clips the polygons (see _clip_polygons) to the map cells. Returns the
+  (flat) cells and areas of the pieces. Cell c covers [c-0.5, c+0.5) in
+  units of map.resolution from map.origin (the cell points are rounded to in
+  _get_map_cells), pieces outside the map are dropped."""
+  cells = []
+  for axis in [0, 1]:
+    u = (pts[:, :, axis] - map.origin[axis]) / map.resolution + 0.5
+    valid = np.arange(pts.shape[1])[np.newaxis, :] < n[:, np.newaxis]
+    c_min = np.floor(np.min(np.where(valid, u, np.inf), axis=1)).astype(np.int64)
+    c_max = np.floor(np.max(np.where(valid, u, -np.inf), axis=1)).astype(np.int64)
+    c_min = np.maximum(c_min, 0)
+    c_max = np.minimum(c_max, map.size[axis]-1)
+    count = np.maximum(c_max - c_min + 1, 0)
+
+    # One copy of every polygon per column (row) of cells it overlaps
+    idx = np.repeat(np.arange(n.shape[0]), count)
+    c = np.arange(idx.shape[0]) - np.repeat(np.cumsum(count) - count, count) + c_min[idx]
+    pts, n = pts[idx], n[idx]
+    cells = [x[idx] for x in cells] + [c]
+    lo = map.origin[axis] + (c - 0.5)*map.resolution
+    hi = map.origin[axis] + (c + 0.5)*map.resolution
+    pts, n = _clip_polygons(pts, n, axis, lo, 1., False)
+    pts, n = _clip_polygons(pts, n, axis, hi, -1., True)
+    ind = n >= 3
+    pts, n, cells = pts[ind], n[ind], [x[ind] for x in cells]
+  return cells[1]*map.size[0] + cells[0], _polygon_areas(pts, n)
+
+def _rasterize_chunk_cells(map, tri, z_ranges):
+  """Returns the map cells and areas (as _sample_chunk_cells) of the pieces
+  of the triangles tri within each z range."""
+  return [_rasterize_polygons(map, *_clip_triangles_to_z_range(tri, z_min, z_max))
+          for z_min, z_max in z_ranges]
+
+def _iter_face_chunks(map, v, f, max_cells):
+  """Splits the faces f into chunks whose triangles overlap (by their
+  bounding boxes) at most about max_cells map cells. Yields the triangles of
+  every chunk."""
+  for start in range(0, f.shape[0], FACE_BLOCK_SIZE):
+    tri = v[f[start:start+FACE_BLOCK_SIZE]]
+    u = np.floor((tri[:, :, :2] - map.origin) / map.resolution + 0.5)
+    num_cells = np.prod(np.max(u, axis=1) - np.min(u, axis=1) + 1, axis=1)
+    ends = np.cumsum(num_cells)
+    s = 0
+    while s < tri.shape[0]:
+      e = np.searchsorted(ends, (ends[s-1] if s > 0 else 0) + max_cells, side='right')
+      e = max(e, s+1)
+      yield tri[s:e]
+      s = e
+
+def _iter_chunk_cells(tasks, num_threads):
+  """Yields (key, cells_wts) for the (key, function) tasks, in order,
+  running the functions on num_threads threads with at most 2*num_threads
+  in flight."""
+  futures = collections.deque()
+  with ThreadPoolExecutor(max_workers=num_threads) as pool:
+    def _submit():
+      # Tasks (and the random numbers of samplers) are drawn here, in order
+      for key, fn in tasks:
+        futures.append((key, pool.submit(fn)))
+        if len(futures) >= 2*num_threads:
+          break
+    _submit()
+    while len(futures) > 0:
+      key, future = futures.popleft()
+      cells_wts = future.result()
+      _submit()
+      yield key, cells_wts
+
 def make_map(padding, resolution, vertex=None, sc=1.):
   """Returns a map structure."""
   min_, max_ = _get_xy_bounding_box(vertex*sc, padding=padding)
@@ -62,30 +250,42 @@ def make_map(padding, resolution, vertex=None, sc=1.):
     padding=padding)
   return map
 
+def flip_map(map):
+  """Returns the map of the building mirrored in y (y -> -y, as done by
+  Shape.flip_shape). The grids of the returned map are row flipped views of
+  the grids of map, cell k of map is cell size[1]-1-k of the flipped map.
+  The traversible buffers patched in place by update_traversible_window are
+  not shared, the flipped map allocates its own on its first update."""
+  map_out = utils.Foo(**dict([(k, v) for k, v in vars(map).items()
+                              if k != '_traversible_buffers']))
+  origin = np.array(map.origin)*1
+  origin[1] = -(map.origin[1] + (map.size[1]-1)*map.resolution)
+  map_out.origin = origin
+  map_out.max = origin + map.size*map.resolution - 1
+  for k, v in vars(map).items():
+    if isinstance(v, np.ndarray) and v.shape == (map.size[1], map.size[0]):
+      setattr(map_out, k, v[::-1, :])
+  return map_out
+
 def _fill_holes(img, thresh):
   """Fills holes less than thresh area (assumes 4 connectivity when computing
   hole area."""
-  l, n = scipy.ndimage.label(np.logical_not(img))
-  img_ = img == True
-  cnts = np.bincount(l.reshape(-1))
-  for i, cnt in enumerate(cnts):
-    if cnt < thresh:
-      l[l == i] = -1
-  img_[l == -1] = True
-  return img_
+  return map_postprocess.fill_holes(img, thresh)
 
 def add_human_to_traversible(map, robot_base, robot_height, robot_radius,
   valid_min, valid_max, num_point_threshold, shapess, sc=100.,
-  n_samples_per_face=200, human_xy_center_2=None):
+  n_samples_per_face=200, human_xy_center_2=None, occupancy_mode='sample'):
   
   """
   Update map.traversible to include the space occupied by the human(s)
-  whose meshes are held in shapess.
+  whose meshes are held in shapess. The space occupied by the human is only
+  computed in a window (a pair of row and column slices) around it, stored
+  with the free space in it as map._human_window and
+  map._human_obstacle_free, and patched into the traversible (see
+  update_traversible_window).
   """
-
-  # Compute the space occupied by the human only
-  num_obstcale_points = np.zeros((map.size[1], map.size[0]))
-  num_points = np.zeros((map.size[1], map.size[0]))
+  assert(occupancy_mode in OCCUPANCY_MODES), \
+    'Unknown occupancy mode {:s}.'.format(occupancy_mode)
 
   # One Shape
   assert(len(shapess) == 1)
@@ -95,70 +295,212 @@ def add_human_to_traversible(map, robot_base, robot_height, robot_radius,
   assert(shapes.get_number_of_meshes() == 1)
   j = 0
 
-  p, face_areas, face_idx = shapes.sample_points_on_face_of_shape(
-      j, n_samples_per_face, sc)
-  wt = face_areas[face_idx]/n_samples_per_face
-
-  ind = np.all(np.concatenate(
-    (p[:, [2]] > robot_base,
-     p[:, [2]] < robot_base + robot_height), axis=1),axis=1)
-  num_obstcale_points += _project_to_map(map, p[ind, :], wt[ind])
+  # Compute the (flat) map cells and weights of the space occupied by the human
+  if occupancy_mode == 'exact':
+    tri = (shapes.meshes[j].vertices*sc)[shapes.meshes[j].faces]
+    pts, n = _clip_triangles_to_z_range(tri, robot_base, robot_base + robot_height)
+    cells, wt = _rasterize_polygons(map, pts, n)
 
-  ind = np.all(np.concatenate(
-    (p[:, [2]] > valid_min,
-     p[:, [2]] < valid_max), axis=1),axis=1)
-  num_points += _project_to_map(map, p[ind, :], wt[ind])
+    pts, n = _clip_triangles_to_z_range(tri, valid_min, valid_max)
+    # The farthest points of the clipped faces are their vertices
+    p = pts[np.arange(pts.shape[1])[np.newaxis, :] < n[:, np.newaxis]]
+  else:
+    p, face_areas, face_idx = shapes.sample_points_on_face_of_shape(
+        j, n_samples_per_face, sc)
+    wt = face_areas[face_idx]/n_samples_per_face
+
+    ind = np.all(np.concatenate(
+      (p[:, [2]] > robot_base,
+       p[:, [2]] < robot_base + robot_height), axis=1),axis=1)
+    vertex_ = np.round((p[ind, :2] - map.origin) / map.resolution).astype(np.int)
+    inside = np.all(np.logical_and(vertex_ >= 0, vertex_ < map.size), axis=1)
+    cells, wt = vertex_[inside, 1]*map.size[0] + vertex_[inside, 0], wt[ind][inside]
+
+    ind = np.all(np.concatenate(
+      (p[:, [2]] > valid_min,
+       p[:, [2]] < valid_max), axis=1),axis=1)
+    p = p[ind, :]
 
   # Compute the radius of the human footprint (without augmenting by the robot base)
-  human_footprint_coordinates_n3 = p[ind, :]/sc
+  human_footprint_coordinates_n3 = p/sc
   human_xy_footprint_coordinates_n2 = (human_footprint_coordinates_n3[:, :2] -  human_xy_center_2[None])
   human_radius = np.linalg.norm(human_xy_footprint_coordinates_n2, axis=1).max()
 
-  # Expand the occupied space to account for the robot base
-  selem = morphology.disk(robot_radius / map.resolution)
-  obstacle_free = morphology.binary_dilation(
-      _fill_holes(num_obstcale_points > num_point_threshold, 20), selem) != True
+  _add_human_cells_to_traversible(map, cells, wt, robot_radius, num_point_threshold)
+  map._human_radius = human_radius
+  map.human_xy_footprint_coordinates_n2 = human_xy_footprint_coordinates_n2
+  return map
+
+def _add_human_cells_to_traversible(map, cells, wt, robot_radius, num_point_threshold):
+  """Adds the space occupied by a human, weights wt at the (flat) map cells,
+  to the traversible in a window around it (see add_human_to_traversible)."""
+  # The window around the occupied cells is padded so that the holes filled
+  # and the dilation by the robot radius in it are those over the whole map
+  radius = robot_radius / map.resolution
+  pad = int(np.ceil(radius)) + 2
+  rows, cols = cells // map.size[0], cells % map.size[0]
+  if cells.shape[0] == 0:
+    window = (slice(0, 0), slice(0, 0))
+  else:
+    window = (slice(max(np.min(rows) - pad, 0), min(np.max(rows) + pad + 1, map.size[1])),
+              slice(max(np.min(cols) - pad, 0), min(np.max(cols) + pad + 1, map.size[0])))
+  shape = (window[0].stop - window[0].start, window[1].stop - window[1].start)
+  obstacle_free = np.ones(shape, dtype=bool)
+  if cells.shape[0] > 0:
+    num_obstcale_points = np.bincount(
+      (rows - window[0].start)*shape[1] + cols - window[1].start, weights=wt,
+      minlength=shape[0]*shape[1])
+    num_obstcale_points = np.reshape(num_obstcale_points, shape)
+
+    # Expand the occupied space to account for the robot base
+    obstacle_free = map_postprocess.dilate_disk(
+        _fill_holes(num_obstcale_points > num_point_threshold, 20), radius) != True
 
   # Combine the occupancy information from the static map
   # and the human
-  traversible = np.stack([map._traversible, obstacle_free], axis=2)
-  traversible = np.all(traversible, axis=2)
-
-  map.traversible = traversible
-  map._human_traversible = obstacle_free*1.
-  map._human_radius = human_radius
-  map.human_xy_footprint_coordinates_n2 = human_xy_footprint_coordinates_n2
+  update_traversible_window(map, window, [(window, obstacle_free)])
+  map._human_window = window
+  map._human_obstacle_free = obstacle_free
+
+def compute_human_footprint(shapess, robot_base, robot_height, valid_min, valid_max,
+  resolution, sc=100., n_samples_per_face=200, occupancy_mode='sample', supersample=4):
+  """Returns the footprint of the human mesh shapess (in its ego frame) that
+  add_human_footprint_to_traversible stamps into a map of resolution: the
+  centers (in sc units) and weights of the cells, of a grid supersample
+  times finer than the map, occupied between robot_base and robot_base +
+  robot_height, and the radius of the human (in meters, as
+  map._human_radius). The occupancy is computed as in
+  add_human_to_traversible."""
+  assert(occupancy_mode in OCCUPANCY_MODES), \
+    'Unknown occupancy mode {:s}.'.format(occupancy_mode)
+  assert(len(shapess) == 1 and shapess[0].get_number_of_meshes() == 1)
+  shapes = shapess[0]
+  vs = shapes.meshes[0].vertices*sc
+  stamp = make_map(resolution, resolution / supersample, vertex=vs)
+
+  if occupancy_mode == 'exact':
+    tri = vs[shapes.meshes[0].faces]
+    cells, wt = _rasterize_polygons(stamp, *_clip_triangles_to_z_range(
+      tri, robot_base, robot_base + robot_height))
+    pts, n = _clip_triangles_to_z_range(tri, valid_min, valid_max)
+    p = pts[np.arange(pts.shape[1])[np.newaxis, :] < n[:, np.newaxis]]
+  else:
+    p, face_areas, face_idx = shapes.sample_points_on_face_of_shape(0, n_samples_per_face, sc)
+    wt = face_areas[face_idx]/n_samples_per_face
+    ind = np.logical_and(p[:, 2] > robot_base, p[:, 2] < robot_base + robot_height)
+    cells, wt = _get_map_cells(stamp, p[ind, :]), wt[ind]
+    p = p[np.logical_and(p[:, 2] > valid_min, p[:, 2] < valid_max), :]
+
+  wt = np.bincount(cells, weights=wt, minlength=stamp.size[0]*stamp.size[1])
+  cells = np.where(wt > 0)[0]
+  xy = np.stack([cells % stamp.size[0], cells // stamp.size[0]], axis=1)*stamp.resolution
+  return utils.Foo(xy=xy + stamp.origin, wt=wt[cells],
+                   radius=np.linalg.norm(p[:, :2]/sc, axis=1).max())
+
+def add_human_footprint_to_traversible(map, footprint, robot_radius, num_point_threshold,
+  human_pos_3, sc=100.):
+  """
+  Update map.traversible to include the space occupied by a human, given
+  by its footprint (see compute_human_footprint), at human_pos_3 ([x, y,
+  theta] in meters, in the frame of the building meshes). The footprint is
+  rotated and stamped into the map cells, then handled as in
+  add_human_to_traversible.
+  """
+  c, s = np.cos(human_pos_3[2]), np.sin(human_pos_3[2])
+  # As in Building._transform_to_world
+  xy = footprint.xy.dot(np.array([[c, s], [-s, c]])) + np.asarray(human_pos_3[:2])*sc
+  vertex_ = np.round((xy - map.origin) / map.resolution).astype(np.int)
+  inside = np.all(np.logical_and(vertex_ >= 0, vertex_ < map.size), axis=1)
+  cells = vertex_[inside, 1]*map.size[0] + vertex_[inside, 0]
+  _add_human_cells_to_traversible(map, cells, footprint.wt[inside], robot_radius,
+                                  num_point_threshold)
+  map._human_radius = footprint.radius
+  map.human_xy_footprint_coordinates_n2 = (xy/sc - np.asarray(human_pos_3[:2])[np.newaxis])
   return map
 
+def update_traversible_window(map, window, humans):
+  """Recomputes map.traversible and map._human_traversible in window (a pair
+  of row and column slices) from map._traversible and the (window,
+  obstacle_free) of the humans. Both are kept in buffers, allocated on the
+  first update, that are patched in place."""
+  if not getattr(map, '_traversible_buffers', False):
+    map.traversible = np.asarray(map._traversible) > 0
+    map._human_traversible = np.ones((map.size[1], map.size[0]))
+    map._traversible_buffers = True
+
+  human_traversible = np.ones((window[0].stop - window[0].start,
+                               window[1].stop - window[1].start), dtype=bool)
+  for human_window, obstacle_free in humans:
+    overlap = [slice(max(w.start, hw.start), min(w.stop, hw.stop))
+               for w, hw in zip(window, human_window)]
+    if any([o.start >= o.stop for o in overlap]):
+      continue
+    dst = tuple([slice(o.start - w.start, o.stop - w.start) for o, w in zip(overlap, window)])
+    src = tuple([slice(o.start - hw.start, o.stop - hw.start) for o, hw in zip(overlap, human_window)])
+    human_traversible[dst] = np.logical_and(human_traversible[dst], obstacle_free[src])
+  map._human_traversible[window] = human_traversible
+  map.traversible[window] = np.logical_and(map._traversible[window], human_traversible)
+
 def compute_traversibility(map, robot_base, robot_height, robot_radius,
   valid_min, valid_max, num_point_threshold, shapess, sc=100.,
-  n_samples_per_face=200):
+  n_samples_per_face=200, max_sample_bytes=None, num_threads=None,
+  occupancy_mode='sample'):
   """Returns a bit map with pixels that are traversible or not as long as the
   robot center is inside this volume we are good colisions can be detected by
   doing a line search on things, or walking from current location to final
-  location in the bitmap, or doing bwlabel on the traversibility map."""
+  location in the bitmap, or doing bwlabel on the traversibility map.
+
+  Chunks of faces are processed on num_threads threads (default the number
+  of cpus), using at most about max_sample_bytes (default MAX_SAMPLE_BYTES)
+  for the sampled points (or clipped faces). The result does not depend on
+  either. With occupancy_mode 'exact' the area of the faces over every map
+  cell is computed by clipping them, instead of sampling n_samples_per_face
+  points on every face."""
+  assert(occupancy_mode in OCCUPANCY_MODES), \
+    'Unknown occupancy mode {:s}.'.format(occupancy_mode)
+  if max_sample_bytes is None:
+    max_sample_bytes = MAX_SAMPLE_BYTES
+  if num_threads is None:
+    num_threads = multiprocessing.cpu_count()
+
   num_obstcale_points = np.zeros((map.size[1], map.size[0]))
   num_points = np.zeros((map.size[1], map.size[0]))
-
-  for i, shapes in enumerate(shapess):
-    for j in range(shapes.get_number_of_meshes()):
-      p, face_areas, face_idx = shapes.sample_points_on_face_of_shape(
-          j, n_samples_per_face, sc)
-      wt = face_areas[face_idx]/n_samples_per_face
-
-      ind = np.all(np.concatenate(
-        (p[:, [2]] > robot_base,
-         p[:, [2]] < robot_base + robot_height), axis=1),axis=1)
-      num_obstcale_points += _project_to_map(map, p[ind, :], wt[ind])
-
-      ind = np.all(np.concatenate(
-        (p[:, [2]] > valid_min,
-         p[:, [2]] < valid_max), axis=1),axis=1)
-      num_points += _project_to_map(map, p[ind, :], wt[ind])
-
-  selem = morphology.disk(robot_radius / map.resolution)
-  obstacle_free = morphology.binary_dilation(
-      _fill_holes(num_obstcale_points > num_point_threshold, 20), selem) != True
+  z_ranges = [(robot_base, robot_base + robot_height), (valid_min, valid_max)]
+
+  def _tasks():
+    for i, shapes in enumerate(shapess):
+      for j in range(shapes.get_number_of_meshes()):
+        if occupancy_mode == 'exact':
+          max_cells = max(1, max_sample_bytes // (POLYGON_BYTES*2*num_threads))
+          for tri in _iter_face_chunks(map, shapes.meshes[j].vertices*sc, shapes.meshes[j].faces,
+                                       max_cells):
+            yield (i, j), functools.partial(_rasterize_chunk_cells, map, tri, z_ranges)
+        else:
+          faces_per_chunk = max(1, int(max_sample_bytes //
+            (SAMPLE_BYTES_PER_POINT*n_samples_per_face*2*num_threads)))
+          for sampler in shapes.iter_point_samplers(j, n_samples_per_face, sc, faces_per_chunk):
+            yield (i, j), functools.partial(_sample_chunk_cells, map, sampler,
+                                            n_samples_per_face, z_ranges)
+
+  # The counts of every mesh are summed in order of its points, as before
+  # it was split into chunks, and then added to the totals.
+  def _add_mesh(mesh_counts):
+    num_obstcale_points.reshape(-1)[:] += mesh_counts[0]
+    num_points.reshape(-1)[:] += mesh_counts[1]
+  mesh_key, mesh_counts = None, None
+  for key, cells_wts in _iter_chunk_cells(_tasks(), num_threads):
+    if key != mesh_key:
+      if mesh_counts is not None:
+        _add_mesh(mesh_counts)
+      mesh_key, mesh_counts = key, [np.zeros(map.size[1]*map.size[0]) for _ in z_ranges]
+    for counts, (cells, wt) in zip(mesh_counts, cells_wts):
+      _accumulate(counts, cells, wt)
+  if mesh_counts is not None:
+    _add_mesh(mesh_counts)
+
+  obstacle_free = map_postprocess.dilate_disk(
+      _fill_holes(num_obstcale_points > num_point_threshold, 20),
+      robot_radius / map.resolution) != True
   valid_space = _fill_holes(num_points > num_point_threshold, 20)
   traversible = np.concatenate((obstacle_free[...,np.newaxis],
     valid_space[...,np.newaxis]), axis=2)
@@ -204,9 +546,7 @@ def resize_maps(map, map_scales, resize_method):
   return scaled_maps
 
 def pick_largest_cc(traversible):
-  out = scipy.ndimage.label(traversible)[0]
-  cnt = np.bincount(out.reshape(-1))[1:]
-  return out == np.argmax(cnt) + 1
+  return map_postprocess.largest_component(traversible)
 
 def get_graph_origin_loc(rng, traversible):
   """Erode the traversibility mask so that we get points in the bulk of the
@@ -224,9 +564,17 @@ def get_graph_origin_loc(rng, traversible):
 
 
 def generate_egocentric_maps(scaled_maps, map_scales, map_crop_sizes, loc,
-                             x_axis, y_axis, dst_theta=np.pi/2.0, dst_loc=None):
+                             x_axis, y_axis, dst_theta=np.pi/2.0, dst_loc=None,
+                             batched=False):
+  """Returns the egocentric crops of every scaled map (0 outside the map).
+  With batched the crops of all locations are computed at once (see
+  get_map_to_predict_batched)."""
   maps = []
   for i, (map_, sc, map_crop_size) in enumerate(zip(scaled_maps, map_scales, map_crop_sizes)):
+    if batched:
+      maps.append(get_map_to_predict_batched(loc*sc, x_axis, y_axis, map_, map_crop_size,
+                                             dst_theta=dst_theta, dst_loc=dst_loc))
+      continue
     maps_i = np.array(get_map_to_predict(loc*sc, x_axis, y_axis, map_,
       map_crop_size, interpolation=cv2.INTER_LINEAR, dst_theta=dst_theta, dst_loc=dst_loc)[0])
     if maps_i.size == 0:
@@ -268,11 +616,9 @@ def generate_goal_images(map_scales, map_crop_sizes, n_ori, goal_dist,
     goals.append(goal_i)
   return goals
 
-def get_map_to_predict(src_locs, src_x_axiss, src_y_axiss, map, map_size,
-                       interpolation=cv2.INTER_LINEAR, dst_theta=None, dst_loc=None):
-  fss = []
-  valids = []
-
+def _get_crop_transforms(src_locs, src_x_axiss, src_y_axiss, map_size, dst_theta, dst_loc):
+  """Returns the affine transforms (2 x 3, from the map to the crop) of the
+  crops at src_locs."""
   # The robot location defaults to the the center of the map
   if dst_loc is None:
       center = (map_size-1.0)/2.0
@@ -289,13 +635,21 @@ def get_map_to_predict(src_locs, src_x_axiss, src_y_axiss, map, map_size,
     return points
 
   dst_points = compute_points(dst_loc, dst_x_axis, dst_y_axis)
+  Ms = []
   for i in range(src_locs.shape[0]):
     src_loc = src_locs[i,:]
     src_x_axis = src_x_axiss[i,:]
     src_y_axis = src_y_axiss[i,:]
     src_points = compute_points(src_loc, src_x_axis, src_y_axis)
-    M = cv2.getAffineTransform(src_points, dst_points)
+    Ms.append(cv2.getAffineTransform(src_points, dst_points))
+  return Ms
 
+def get_map_to_predict(src_locs, src_x_axiss, src_y_axiss, map, map_size,
+                       interpolation=cv2.INTER_LINEAR, dst_theta=None, dst_loc=None):
+  fss = []
+  valids = []
+  for M in _get_crop_transforms(src_locs, src_x_axiss, src_y_axiss, map_size, dst_theta,
+                                dst_loc):
     fs = cv2.warpAffine(map, M, (map_size, map_size), None, flags=interpolation,
                         borderValue=np.NaN)
     valid = np.invert(np.isnan(fs))
@@ -303,6 +657,76 @@ def get_map_to_predict(src_locs, src_x_axiss, src_y_axiss, map, map_size,
     fss.append(fs)
   return fss, valids
 
+def _get_sampling_points(transforms, map_size):
+  """Returns the x and y (chunk x map_size x map_size) sampling points of
+  the crops with the (chunk x 2 x 3) inverse transforms, in 1/INTER_TAB_SIZE
+  pixels, rounded as cv2.warpAffine does: the row and column terms are
+  rounded to 1/AB_SCALE pixels and their sum to 1/INTER_TAB_SIZE pixels."""
+  r = np.arange(map_size)
+  # Points far outside the map are only clipped, they are not sampled
+  limit = np.iinfo(np.int32).max // 4
+  points = []
+  for k in range(2):
+    rows = np.rint((transforms[:, k, 1, np.newaxis]*r + transforms[:, k, 2, np.newaxis])*AB_SCALE)
+    cols = np.rint(transforms[:, k, 0, np.newaxis]*r*AB_SCALE)
+    rows = np.clip(rows + AB_SCALE//INTER_TAB_SIZE//2, -limit, limit).astype(np.int32)
+    cols = np.clip(cols, -limit, limit).astype(np.int32)
+    points.append(np.right_shift(rows[:, :, np.newaxis] + cols[:, np.newaxis, :],
+                                 AB_BITS - INTER_BITS))
+  return points
+
+def get_map_to_predict_batched(src_locs, src_x_axiss, src_y_axiss, map, map_size,
+                               dst_theta=None, dst_loc=None, fill_value=0.,
+                               num_threads=None):
+  """Returns the (N x map_size x map_size, with the channels of map) crops of
+  get_map_to_predict with linear interpolation for all N locations at once,
+  with fill_value where get_map_to_predict gives NaN. The sampling points
+  of all crops are computed in fixed point as in cv2.warpAffine and the map
+  is sampled with one cv2.remap call (per chunk of CROP_CHUNK_SIZE
+  locations, run on num_threads threads, default the number of cpus). For
+  multichannel maps every channel is fill_value outside the map (warpAffine
+  only sets the first channel to NaN)."""
+  map = np.asarray(map)
+  h, w = map.shape[:2]
+  n = src_locs.shape[0]
+  if n == 0:
+    return np.zeros((0, map_size, map_size) + map.shape[2:], dtype=map.dtype)
+  transforms = np.array([cv2.invertAffineTransform(M) for M in _get_crop_transforms(
+    src_locs, src_x_axiss, src_y_axiss, map_size, dst_theta, dst_loc)])
+
+  def _crop(s):
+    xs, ys = _get_sampling_points(transforms[s], map_size)
+    # Fixed point maps (interpolation table index and integer pixel) of the
+    # crops stacked into one remap grid
+    fractions = np.bitwise_and(ys, INTER_TAB_SIZE-1)
+    fractions <<= INTER_BITS
+    fractions |= np.bitwise_and(xs, INTER_TAB_SIZE-1)
+    for points in [xs, ys]:
+      np.right_shift(points, INTER_BITS, out=points)
+      np.clip(points, -1, np.iinfo(np.int16).max, out=points)
+    pixels = cv2.merge([np.reshape(points.astype(np.int16), (-1, map_size))
+                        for points in [xs, ys]])
+    crops = cv2.remap(map, pixels, np.reshape(fractions.astype(np.uint16), (-1, map_size)),
+                      interpolation=cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT,
+                      borderValue=fill_value)
+    crops = np.reshape(crops, (-1, map_size, map_size) + map.shape[2:])
+    # Points with a neighbour outside the map
+    valid = cv2.inRange(pixels, (0, 0), (w-2, h-2))
+    crops[np.reshape(valid, xs.shape) == 0] = fill_value
+    return crops
+
+  # remap needs less than SHRT_MAX rows in the stacked grid
+  chunk_size = max(1, min(CROP_CHUNK_SIZE, (np.iinfo(np.int16).max - 1) // map_size))
+  if n <= chunk_size:
+    return _crop(slice(0, n))
+  if num_threads is None:
+    num_threads = multiprocessing.cpu_count()
+  chunks = [slice(i, min(i + chunk_size, n)) for i in range(0, n, chunk_size)]
+  if num_threads <= 1:
+    return np.concatenate([_crop(x) for x in chunks], axis=0)
+  with ThreadPoolExecutor(max_workers=num_threads) as pool:
+    return np.concatenate(list(pool.map(_crop, chunks)), axis=0)
+
 def walk_on_map(traversable, start, end):
   l = np.linalg.norm(start-end)
   r = np.linspace(0, 1, 2*int(np.ceil(l)))
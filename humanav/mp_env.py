@@ -1,20 +1,32 @@
 from __future__ import print_function
 import logging
+import collections
 import numpy as np
 import sys
 if sys.version_info[0] == 2:
     from . import map_utils as mu
+    from . import tile_streamer
+    from . import map_cache
+    from . import utils
+    from render import swiftshader_renderer as renderer
 else:
     from humanav import map_utils as mu #py3
+    from humanav import tile_streamer
+    from humanav import map_cache
+    from humanav import utils
+    from humanav.render import swiftshader_renderer as renderer
 
 make_map = mu.make_map
 resize_maps = mu.resize_maps
 compute_traversibility = mu.compute_traversibility
 add_human_to_traversible = mu.add_human_to_traversible
+add_human_footprint_to_traversible = mu.add_human_footprint_to_traversible
+update_traversible_window = mu.update_traversible_window
 pick_largest_cc = mu.pick_largest_cc
+flip_map = mu.flip_map
 
 class Building():
-  def __init__(self, dataset, name, robot, env, flip=False):
+  def __init__(self, dataset, name, robot, env, flip=False, tile_size=None, use_map_cache=True):
     self.restrict_to_largest_cc = True
     self.robot = robot
     self.env = env
@@ -24,53 +36,135 @@ class Building():
     materials_scale = 1.0
     self.materials_scale = materials_scale
     
+    # With tile_size the building is loaded as XY tiles that can be
+    # streamed into the renderer (see load_building_into_scene). The
+    # meshes are always loaded unflipped, see set_flip.
     shapess = dataset.load_building_meshes(env_paths, 
-      materials_scale=materials_scale)
-
-    if flip: 
-      for shapes in shapess: 
-        shapes.flip_shape()
-    
-    vs = []
-    for shapes in shapess:
-      vs.append(shapes.get_vertices()[0])
-    vs = np.concatenate(vs, axis=0)
-    
-    map = make_map(env.padding, env.resolution, vertex=vs, sc=100.)
-    map = compute_traversibility(
-      map, robot.base, robot.height, robot.radius, env.valid_min,
-      env.valid_max, env.num_point_threshold, shapess=shapess, sc=100.,
-      n_samples_per_face=env.n_samples_per_face)
+      materials_scale=materials_scale, flip=False, tile_size=tile_size)
+    self.tile_size = tile_size
+    self.tile_streamer = None
+
+    # The map only depends on the params below, it is loaded from the map
+    # cache (memory mapped) if it has been computed before.
+    map_key = map_cache.get_map_key(robot, env, False, dataset.get_building_mesh_file(env_paths),
+                                    self.restrict_to_largest_cc)
+    map_cache_dir = map_cache.get_cache_dir(env_paths, map_key)
+    map = map_cache.load_map(map_cache_dir) if use_map_cache else None
+    if map is not None:
+      logging.error('Loading map from cache: %s', map_cache_dir)
+    else:
+      map = self._compute_map(shapess, robot, env)
+      if use_map_cache:
+        try:
+          map_cache.save_map(map, map_cache_dir)
+        except (IOError, OSError) as e:
+          logging.warning('Could not save map cache %s (%s).', map_cache_dir, e)
 
     self.env_paths = env_paths 
     self.shapess = shapess
     self.map = map
+    self.maps = {False: map}
 
     # The map object has _traversible (only the SBPD building)
     # and traversible (the current traversible which may include
     # space occupied by any humans in the environment)
-    self.traversible = map.traversible*1
+    self.traversible = map.traversible
 
     self.name = name 
-    self.flipped = flip
+    self.flipped = False
     self.renderer_entitiy_ids = []
-    if self.restrict_to_largest_cc:
-      self.traversible = pick_largest_cc(self.traversible)
-      self.map._traversible = self.traversible
-      self.map.traversible = self.traversible
 
-    # Instance variable for storing human information
+    # Humans in the scene keyed by human id. human_mesh_info,
+    # human_pos_3 and human refer to the most recently loaded human.
+    self.humans = collections.OrderedDict()
     self.human_mesh_info = None
     self.human_pos_3 = None
     self.human = None
+    # Windows of the traversible to recompute (see _update_human_traversible)
+    self.traversible_windows = []
+    # Footprints of human meshes (see _get_human_footprint)
+    self.human_footprints = None
+
+    if flip:
+      self.set_flip(True)
+
+  def set_flip(self, flip):
+    """
+    Switches between the building and its mirror image (y -> -y)
+    without reloading it. The loaded meshes stay unflipped: flipped
+    buildings are rendered with a mirrored camera and projection
+    (SwiftshaderRenderer.set_mirrored) and their map is a row flipped
+    view of the unflipped map. All humans have to be removed first.
+    """
+    assert len(self.humans) == 0, 'Remove all humans before flipping the building.'
+    if flip not in self.maps:
+      self.maps[flip] = flip_map(self.maps[False])
+    self.flipped = flip
+    self.map = self.maps[flip]
+    self.traversible = self.map.traversible
+
+  def _to_scene_shapes(self, shapess):
+    """
+    Returns human shapess placed in the (possibly flipped) building
+    in the frame of the loaded, unflipped, building meshes. The faces
+    are not reordered as back faces are not culled.
+    """
+    if not self.flipped:
+      return shapess
+    scene_shapess = []
+    for shapes in shapess:
+      meshes = [renderer.ArrayShape.make_mesh(m.name, m.vertices*np.array([1., -1., 1.]),
+                                              m.faces, m.texturecoords[0,:,:2])
+                for m in shapes.meshes]
+      scene_shapess.append(renderer.ArrayShape(meshes, shapes.materials))
+    return scene_shapess
+
+  def _compute_map(self, shapess, robot, env):
+    """Computes the map (and traversible) of the building meshes shapess."""
+    vs = []
+    for shapes in shapess:
+      vs.append(shapes.get_vertices()[0])
+    vs = np.concatenate(vs, axis=0)
+    
+    map = make_map(env.padding, env.resolution, vertex=vs, sc=100.)
+    map = compute_traversibility(
+      map, robot.base, robot.height, robot.radius, env.valid_min,
+      env.valid_max, env.num_point_threshold, shapess=shapess, sc=100.,
+      n_samples_per_face=env.n_samples_per_face,
+      max_sample_bytes=getattr(env, 'max_sample_bytes', None),
+      occupancy_mode=getattr(env, 'occupancy_mode', 'sample'))
+
+    if self.restrict_to_largest_cc:
+      traversible = pick_largest_cc(map.traversible*1)
+      map._traversible = traversible
+      map.traversible = traversible
+    return map
 
   def set_r_obj(self, r_obj):
     self.r_obj = r_obj
 
-  def load_building_into_scene(self, dedup_tbo=False):
+  def load_building_into_scene(self, dedup_tbo=False, compile_static=False, stream_radius=None,
+                               unload_radius=None):
+    """Loads the building meshes into the renderer. If compile_static is True
+    the building is loaded as a single compiled static scene (one vertex
+    buffer, one draw call per texture) instead of one buffer per mesh. If
+    the building was loaded as tiles and stream_radius is given, only the
+    tiles within stream_radius (meters) of the cameras rendered from are
+    loaded, and tiles further than unload_radius are removed again (see
+    tile_streamer.TileStreamer)."""
     assert(self.shapess is not None)
     # Loads the scene.
-    self.renderer_entitiy_ids += self.r_obj.load_shapes(self.shapess, dedup_tbo)
+    if stream_radius is not None:
+      assert self.tile_size is not None, 'Streaming needs a building loaded as tiles.'
+      if compile_static:
+        logging.warning('Streamed tiles can not be compiled into a static scene.')
+      self.tile_streamer = tile_streamer.TileStreamer(self.r_obj, self.shapess, self.tile_size,
+                                                      stream_radius, unload_radius)
+    elif compile_static:
+      # The static scene always shares the textures of its meshes
+      self.renderer_entitiy_ids += self.r_obj.load_static_shapes(self.shapess)
+    else:
+      self.renderer_entitiy_ids += self.r_obj.load_shapes(self.shapess, dedup_tbo)
     # Free up memory, we dont need the mesh or the materials anymore.
     self.shapess = None
 
@@ -135,18 +229,126 @@ class Building():
   
   def load_human_into_scene(self, dataset, pos_3, speed, gender,
                             human_materials, body_shape, rng, dedup_tbo=False,
-                            allow_repeat_humans=False):
+                            allow_repeat_humans=False, human_id=0):
     """
     Load a 'gendered' human mesh with 'body shape' and texture, 'human_materials',
-    into a building at 'pos_3' with 'speed' in the static building.
+    into a building at 'pos_3' with 'speed' in the static building. Several
+    humans can be in the scene at once, each with its own human_id. Human
+    textures are always shared between humans (dedup_tbo is ignored).
+    With surreal_params.gpu_pose_library the whole pose sequence of the
+    human is loaded into the renderer (see _load_human_pose_library).
+    """
+    if human_id in self.humans:
+      assert allow_repeat_humans, 'Human {:d} already exists.'.format(human_id)
+      self._remove_human(human_id)
+    if dataset.surreal_params.gpu_pose_library:
+      self._load_human_pose_library(dataset, pos_3, speed, gender, human_materials, body_shape,
+                                    rng, human_id)
+    else:
+      self._load_human(dataset, pos_3, speed, gender, human_materials, body_shape, rng, human_id)
+    self._update_human_traversible()
+
+  def _load_human(self, dataset, pos_3, speed, gender, human_materials, body_shape, rng,
+                  human_id):
+    shapess, human_ego_vertices, human_mesh_info = self._place_human(
+        dataset, pos_3, speed, gender, human_materials, body_shape, rng, human_id)
+    entity_ids = self.r_obj.load_human_shapes(self._to_scene_shapes(shapess), human_id)
+    self.renderer_entitiy_ids += entity_ids
+    self._set_human(dataset, human_id, pos_3, speed, gender, human_materials, body_shape,
+                    shapess, human_ego_vertices, human_mesh_info, entity_ids)
+
+  def _load_human_pose_library(self, dataset, pos_3, speed, gender, human_materials, body_shape,
+                               rng, human_id):
+    """
+    Samples a human like _load_human, but loads all frames of its pose
+    sequence (in the canonical ego frame) into the pose library of the
+    renderer. The human is then posed and moved by selecting a frame and a
+    model matrix, without uploading any vertices.
+    """
+    human_mesh_info, _ = dataset.sample_random_human(speed, gender, body_shape, rng)
+    sequence = dataset.load_human_sequence(human_materials, human_mesh_info['mesh_dir'], gender,
+                                           human_id=human_id)
+    sequence['mesh_dir'] = human_mesh_info['mesh_dir']
+
+    # Same canonical position as in _place_human, for every frame
+    ego_vertices = []
+    for vertices_n3, center_pos_3 in zip(sequence['vertices'], sequence['centering']):
+      vertices_n3 = vertices_n3 - np.array([0., 0., vertices_n3[:, 2].min()])
+      ego_vertices.append(self._transform_to_ego(vertices_n3, center_pos_3))
+    sequence['ego_vertices'] = np.array(ego_vertices)
+    sequence.pop('vertices')
+
+    entity_ids = self.r_obj.load_human_pose_library(sequence['name'], sequence['ego_vertices'],
+                                                    sequence['faces'], sequence['uvs'],
+                                                    human_materials[0], human_id)
+    self.renderer_entitiy_ids += entity_ids
+    frame_idx = int(np.searchsorted(sequence['frames'], human_mesh_info['frame']))
+    self._set_human_pose(dataset, human_id, pos_3, speed, gender, human_materials, body_shape,
+                         sequence, frame_idx, entity_ids)
+
+  def _set_human_pose(self, dataset, human_id, pos_3, speed, gender, human_materials, body_shape,
+                      sequence, frame_idx, entity_ids):
+    """
+    Draws frame frame_idx of the pose library of human human_id at pos_3
+    (on the traversible map).
+    """
+    vertex_pos_3 = self._traversible_world_to_vertex_world(pos_3)
+
+    # The transform of _transform_to_world as a model matrix
+    c, s = np.cos(vertex_pos_3[2]), np.sin(vertex_pos_3[2])
+    model_matrix = np.array([[c, -s, 0., vertex_pos_3[0]],
+                             [s, c, 0., vertex_pos_3[1]],
+                             [0., 0., 1., 0.],
+                             [0., 0., 0., 1.]])
+    if self.flipped:
+      # See _to_scene_shapes
+      model_matrix = np.dot(np.diag([1., -1., 1., 1.]), model_matrix)
+    self.r_obj.set_human_pose(human_id, frame_idx, model_matrix)
+
+    # The world vertices are only needed on the CPU (i.e. for the traversible)
+    human_ego_vertices = sequence['ego_vertices'][frame_idx]
+    mesh = renderer.ArrayShape.make_mesh(sequence['name'],
+                                         self._transform_to_world(human_ego_vertices, vertex_pos_3),
+                                         sequence['faces'], sequence['uvs'])
+    shapess = [renderer.ArrayShape([mesh], human_materials)]
+    human_mesh_info = {'mesh_dir': sequence['mesh_dir'], 'frame': sequence['frames'][frame_idx],
+                       'gender': gender}
+    self._set_human(dataset, human_id, pos_3, speed, gender, human_materials, body_shape,
+                    shapess, human_ego_vertices, human_mesh_info, entity_ids, sequence=sequence)
+
+  def _move_human(self, dataset, pos_3, speed, rng, human_id):
+    """
+    Moves human human_id to pos_3 with speed, keeping its vertex buffer
+    and texture in the renderer. Only the vertices of the newly sampled
+    frame are uploaded. Pose library humans keep their pose sequence, only
+    a new frame of it is sampled.
+    """
+    human = self.humans[human_id]
+    if human['sequence'] is not None:
+      sequence = human['sequence']
+      frame_idx = rng.choice(len(sequence['frames']))
+      self._set_human_pose(dataset, human_id, pos_3, speed, human['gender'], human['materials'],
+                           human['body_shape'], sequence, frame_idx, human['entity_ids'])
+      return
+    shapess, human_ego_vertices, human_mesh_info = self._place_human(
+        dataset, pos_3, speed, human['gender'], human['materials'], human['body_shape'], rng,
+        human_id)
+    self.r_obj.update_human_mesh(self._to_scene_shapes(shapess)[0].meshes[0], human_id)
+    self._set_human(dataset, human_id, pos_3, speed, human['gender'], human['materials'],
+                    human['body_shape'], shapess, human_ego_vertices, human_mesh_info,
+                    human['entity_ids'])
+
+  def _place_human(self, dataset, pos_3, speed, gender, human_materials, body_shape, rng,
+                   human_id):
+    """
+    Samples a human mesh and moves it to pos_3 (on the traversible map).
+    Returns the shapes, the vertices of the human in its ego frame and the
+    mesh info.
     """
-    self.human_pos_3 = pos_3*1.
-
     # Load the human mesh
     shapess, center_pos_3, human_mesh_info = \
-            dataset.load_random_human(speed, gender, human_materials, body_shape, rng)
-
-    self.human_mesh_info = human_mesh_info
+            dataset.load_random_human(speed, gender, human_materials, body_shape, rng,
+                                      human_id=human_id)
 
     # Make sure the human's feet are actually on the ground in SBPD
     # (i.e. the minimum z coordinate is 0)
@@ -165,56 +367,147 @@ class Building():
     # Move the human to the desired location
     pos_3 = self._traversible_world_to_vertex_world(pos_3)
     shapess[0].meshes[0].vertices = self._transform_to_world(shapess[0].meshes[0].vertices, pos_3)
+    return shapess, human_ego_vertices, human_mesh_info
+
+  def _set_human(self, dataset, human_id, pos_3, speed, gender, human_materials, body_shape,
+                 shapess, human_ego_vertices, human_mesh_info, entity_ids, sequence=None):
+    human_pos_3 = pos_3*1.
+    pos_3 = self._traversible_world_to_vertex_world(pos_3)
 
-    self.renderer_entitiy_ids += self.r_obj.load_shapes(shapess, dedup_tbo, allow_repeat_humans=allow_repeat_humans)
+    # The window of the traversible around the previous position of the
+    # human has to be recomputed
+    if human_id in self.humans and self.humans[human_id]['obstacle_free'] is not None:
+      self.traversible_windows.append(self.humans[human_id]['traversible_window'])
 
-    # Update The Traversible
+    # Compute the space occupied by this human
+    obstacle_free, traversible_window = None, None
     if dataset.surreal_params.compute_human_traversible:
-        map = self.map
         env = self.env
         robot= self.robot
-        map = add_human_to_traversible(
-          map, robot.base, robot.height, robot.radius, env.valid_min,
-          env.valid_max, env.num_point_threshold, shapess=shapess, sc=100.,
-            n_samples_per_face=env.n_samples_per_face, human_xy_center_2=pos_3[:2])
-
-        self.traversible = map.traversible
+        footprint = self._get_human_footprint(dataset, shapess, human_ego_vertices,
+                                              human_mesh_info)
+        map = add_human_footprint_to_traversible(
+          self.map, footprint, robot.radius, env.num_point_threshold, pos_3, sc=100.)
+        obstacle_free, traversible_window = map._human_obstacle_free, map._human_window
+        self.traversible_windows.append(traversible_window)
         self.map = map
+
+    self.humans[human_id] = {'pos_3': human_pos_3, 'speed': speed, 'gender': gender,
+                             'materials': human_materials, 'body_shape': body_shape,
+                             'mesh_info': human_mesh_info, 'shape': shapess[0],
+                             'ego_vertices': human_ego_vertices,
+                             'entity_ids': entity_ids, 'obstacle_free': obstacle_free,
+                             'traversible_window': traversible_window,
+                             'sequence': sequence}
+    self.human_pos_3 = human_pos_3
+    self.human_mesh_info = human_mesh_info
     self.human = shapess[0]
     self.human_ego_vertices = human_ego_vertices
 
-  def remove_human(self):
+  def _get_human_footprint(self, dataset, shapess, human_ego_vertices, human_mesh_info):
+    """
+    Returns the footprint (see map_utils.compute_human_footprint) of the
+    human mesh of human_mesh_info. The ego frame mesh of a frame never
+    changes, so footprints are computed once and kept in an LRU cache
+    keyed by mesh directory and frame (bounded by
+    surreal_params.human_footprint_cache_entries).
+    """
+    if self.human_footprints is None:
+      self.human_footprints = utils.LRUCache(
+        max_entries=dataset.surreal_params.human_footprint_cache_entries)
+    key = (human_mesh_info['mesh_dir'], int(human_mesh_info['frame']))
+    footprint = self.human_footprints.get(key)
+    if footprint is None:
+      env, robot = self.env, self.robot
+      mesh = shapess[0].meshes[0]
+      ego_mesh = renderer.ArrayShape.make_mesh(mesh.name, human_ego_vertices, mesh.faces,
+                                               mesh.texturecoords[0,:,:2])
+      footprint = mu.compute_human_footprint(
+        [renderer.ArrayShape([ego_mesh], shapess[0].materials)], robot.base, robot.height,
+        env.valid_min, env.valid_max, env.resolution, sc=100.,
+        n_samples_per_face=env.n_samples_per_face,
+        occupancy_mode=getattr(env, 'occupancy_mode', 'sample'),
+        supersample=dataset.surreal_params.human_footprint_supersample)
+      self.human_footprints.put(key, footprint)
+    return footprint
+
+  def _update_human_traversible(self):
+    """
+    Recomputes the traversible as the space that is free in the
+    static building and not occupied by any human. Only the windows
+    around the humans added, moved or removed since the last update
+    are recomputed, in place.
+    """
+    humans = [(h['traversible_window'], h['obstacle_free']) for h in self.humans.values()
+              if h['obstacle_free'] is not None]
+    for window in self.traversible_windows:
+      update_traversible_window(self.map, window, humans)
+    self.traversible_windows = []
+    self.traversible = self.map.traversible
+
+  def remove_human(self, human_id=None):
       """
-      Remove a human that has been loaded into the SBPD environment
+      Remove the human human_id (all humans if human_id is None) that has
+      been loaded into the SBPD environment
       """
-      # Delete the human mesh from memory
-      self.r_obj.remove_human()
+      human_ids = list(self.humans.keys()) if human_id is None else [human_id]
+      for human_id in human_ids:
+          self._remove_human(human_id)
 
-      # Remove the human from the list of loaded entities
-      human_entitiy_ids = list(filter(lambda x: 'human' in x, self.renderer_entitiy_ids))
+      # Update the traversible to be free of the removed humans
+      self._update_human_traversible()
 
-      # Only one human supported currently
-      assert (len(human_entitiy_ids) <= 1)
+  def _remove_human(self, human_id):
+      # Delete the human mesh from memory
+      self.r_obj.remove_human(human_id)
 
-      for human_entity_id in human_entitiy_ids:
+      # Remove the human from the list of loaded entities
+      human = self.humans.pop(human_id)
+      if human['obstacle_free'] is not None:
+          self.traversible_windows.append(human['traversible_window'])
+      for human_entity_id in human['entity_ids']:
           self.renderer_entitiy_ids.remove(human_entity_id)
 
-      # Update the traversible to be human free
-      self.map.traversible = self.map._traversible
-      self.traversible = self.map._traversible
-
   def move_human_to_position_with_speed(self, dataset, pos_3, speed, gender,
-                                        human_materials, body_shape, rng):
+                                        human_materials, body_shape, rng, human_id=0):
       """
-      Removes the previously loaded human mesh,
-      and loads a new one with the same gender, texture
-      and body shape at pos_3 with speed_3.
+      Loads a new mesh of the human human_id with the same gender, texture
+      and body shape at pos_3 with speed_3. If the human is already in the
+      scene with this identity only its vertices are updated in place,
+      otherwise the previously loaded human mesh is removed first.
       """
+      if human_id in self.humans and self._has_identity(self.humans[human_id], gender,
+                                                         human_materials, body_shape):
+          self._move_human(dataset, pos_3, speed, rng, human_id)
+          self._update_human_traversible()
+          return
+
       # Remove the previous human
-      self.remove_human()
+      self.remove_human(human_id)
 
       # Load a new human with the same speed, gender, texture, body shape
-      self.load_human_into_scene(dataset, pos_3, speed, gender, human_materials, body_shape, rng)
+      self.load_human_into_scene(dataset, pos_3, speed, gender, human_materials, body_shape, rng,
+                                 human_id=human_id)
+
+  def _has_identity(self, human, gender, human_materials, body_shape):
+      """
+      Returns whether human has the given gender, texture (compared by
+      texture file) and body shape.
+      """
+      texture_files = [m[0] for m in human['materials']]
+      return (human['gender'] == gender and human['body_shape'] == body_shape and
+              texture_files == [m[0] for m in human_materials])
+
+  def move_humans(self, dataset, human_ids, poses_n3, speeds_n, rng):
+      """
+      Moves the humans human_ids to poses_n3 ([x, y, theta]) with speeds_n,
+      keeping the gender, texture and body shape of each human. All humans
+      are updated before the traversible is recomputed once.
+      """
+      assert(len(human_ids) == len(poses_n3) == len(speeds_n))
+      for human_id, pos_3, speed in zip(human_ids, poses_n3, speeds_n):
+          self._move_human(dataset, np.asarray(pos_3), speed, rng, human_id)
+      self._update_human_traversible()
  
   def to_actual_xyt(self, pqr):
     """Converts from node array to location array on the map."""
@@ -225,42 +518,114 @@ class Building():
 
   def set_building_visibility(self, visibility):
     self.r_obj.set_entity_visible(self.renderer_entitiy_ids, visibility)
+    if self.tile_streamer is not None:
+      self.tile_streamer.set_visible(visibility)
 
   def set_human_visibility(self, visibility):
     human_entity_ids = list(filter(lambda x: 'human' in x, self.renderer_entitiy_ids))
     self.r_obj.set_entity_visible(human_entity_ids, visibility)
 
-  def render_nodes(self, nodes, modality, perturb=None, aux_delta_theta=0., human_visible=True):
+  def _nodes_to_cameras(self, nodes, perturb, aux_delta_theta):
+    """Returns the N x 3 camera and lookat positions (in meters, in the frame
+    of the meshes) for N nodes [x, y, theta] on the map."""
+    r = 2
+    elevation_z = r * np.tan(np.deg2rad(self.robot.camera_elevation_degree))
+    xyt = self.to_actual_xyt(np.reshape(nodes, (-1, 3))*1.)
+    lookat_theta = 3.0 * np.pi / 2.0 - (xyt[:,2]+perturb[:,2]+aux_delta_theta) * (self.robot.delta_theta)
+    nxy = xyt[:,:2] + perturb[:,:2]
+    nxy = nxy * self.map.resolution
+    nxy = nxy + self.map.origin
+    camera_xyz = np.zeros((nxy.shape[0], 3))
+    camera_xyz[:,:2] = nxy
+    camera_xyz[:,2] = self.robot.sensor_height
+    camera_xyz = camera_xyz / 100.
+    lookat_xyz = np.stack([-r * np.sin(lookat_theta), -r * np.cos(lookat_theta),
+                           elevation_z + 0.*lookat_theta], axis=1)
+    lookat_xyz = lookat_xyz + camera_xyz
+    if self.flipped:
+      # The mirror image of the camera in the unflipped meshes, rendered
+      # with a mirrored projection (see set_flip)
+      camera_xyz[:,1] = -camera_xyz[:,1]
+      lookat_xyz[:,1] = -lookat_xyz[:,1]
+    return camera_xyz, lookat_xyz
+
+  def _nodes_to_view_matrices(self, nodes, perturb, aux_delta_theta):
+    camera_xyz, lookat_xyz = self._nodes_to_cameras(nodes, perturb, aux_delta_theta)
+    if self.tile_streamer is not None:
+      # Make the tiles around all cameras resident before rendering
+      self.tile_streamer.update(camera_xyz[:, :2])
+    return self.r_obj.get_view_matrices(camera_xyz, lookat_xyz, [0.0, 0.0, 1.0])
+
+  def render_nodes(self, nodes, modality, perturb=None, aux_delta_theta=0., human_visible=True,
+                   batched=False):
+    """Renders an image at each of nodes. If batched is True all nodes are
+    rendered into one tiled framebuffer and read back together. modality may
+    be a list of modalities (e.g. ['rgb', 'disparity']) rendered from one
+    traversal of the scene per node, in which case a dict mapping each
+    modality to its list of images is returned."""
+    if not batched and not isinstance(modality, (list, tuple)):
+      return list(self.iter_render_nodes(nodes, modality, perturb=perturb,
+                                         aux_delta_theta=aux_delta_theta,
+                                         human_visible=human_visible))
+
     # List of nodes to render.
+    self.r_obj.set_mirrored(self.flipped)
     self.set_building_visibility(True)
     self.set_human_visibility(human_visible)
     if perturb is None:
       perturb = np.zeros((len(nodes), 4))
 
-    imgs = []
-    r = 2
-    elevation_z = r * np.tan(np.deg2rad(self.robot.camera_elevation_degree))
-
-    for i in range(len(nodes)):
-      xyt = self.to_actual_xyt(nodes[i][np.newaxis,:]*1.)[0,:]
-      lookat_theta = 3.0 * np.pi / 2.0 - (xyt[2]+perturb[i,2]+aux_delta_theta) * (self.robot.delta_theta)
-      nxy = np.array([xyt[0]+perturb[i,0], xyt[1]+perturb[i,1]]).reshape(1, -1)
-      nxy = nxy * self.map.resolution
-      nxy = nxy + self.map.origin
-      camera_xyz = np.zeros((1, 3))
-      camera_xyz[...] = [nxy[0, 0], nxy[0, 1], self.robot.sensor_height]
-      camera_xyz = camera_xyz / 100.
-      lookat_xyz = np.array([-r * np.sin(lookat_theta),
-                             -r * np.cos(lookat_theta), elevation_z])
-      lookat_xyz = lookat_xyz + camera_xyz[0, :]
-      self.r_obj.position_camera(camera_xyz[0, :].tolist(), lookat_xyz.tolist(), 
-        [0.0, 0.0, 1.0])
-      img = self.r_obj.render(modality, take_screenshot=True, output_type=0)
-      img = [x for x in img if x is not None]
-      img = np.concatenate(img, axis=2).astype(np.float32)
-      if perturb[i,3]>0:
-        img = img[:,::-1,:]
-      imgs.append(img)
+    view_matrices = self._nodes_to_view_matrices(nodes, perturb, aux_delta_theta)
+    if batched:
+      renders = self.r_obj.render_batch(modality, view_matrices)
+    else:
+      renders = []
+      for view_matrix in view_matrices:
+        self.r_obj._set_view_matrix(view_matrix)
+        renders.append(self.r_obj.render(modality, take_screenshot=True, output_type=0))
+
+    modalities = modality if isinstance(modality, (list, tuple)) else [modality]
+    imgs = dict([(m, []) for m in modalities])
+    for i, render in enumerate(renders):
+      for m, img in self._render_to_images(render, perturb[i]):
+        if m in imgs:
+          imgs[m].append(img)
 
     self.set_building_visibility(False)
+    if isinstance(modality, (list, tuple)):
+      return imgs
+    return imgs[modality]
+
+  def iter_render_nodes(self, nodes, modality, perturb=None, aux_delta_theta=0., human_visible=True,
+                        ring_size=2):
+    """Generator version of render_nodes for a single modality. Yields the
+    image for each node as soon as it has been read back, while the next
+    node is already being drawn."""
+    self.r_obj.set_mirrored(self.flipped)
+    self.set_building_visibility(True)
+    self.set_human_visibility(human_visible)
+    if perturb is None:
+      perturb = np.zeros((len(nodes), 4))
+
+    view_matrices = self._nodes_to_view_matrices(nodes, perturb, aux_delta_theta)
+    try:
+      renders = self.r_obj.render_pipelined(modality, view_matrices, ring_size=ring_size)
+      for i, render in enumerate(renders):
+        for m, img in self._render_to_images(render, perturb[i]):
+          if m == modality:
+            yield img
+    finally:
+      self.set_building_visibility(False)
+
+  def _render_to_images(self, render, perturb):
+    """Converts a (np_rgb_img, np_d_img) tuple from the renderer into a list
+    of (modality, image) pairs, mirroring the images if perturb[3] > 0."""
+    imgs = []
+    for m, img in zip(['rgb', 'disparity'], render):
+      if img is None:
+        continue
+      img = img.astype(np.float32)
+      if perturb[3]>0:
+        img = img[:,::-1,:]
+      imgs.append((m, img))
     return imgs
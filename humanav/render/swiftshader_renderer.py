@@ -26,6 +26,8 @@ r"""Implements loading and rendering of meshes. Contains 2 classes:
 
 import numpy as np, os
 import cv2, ctypes, logging, os, numpy as np
+import collections, functools, multiprocessing
+from concurrent.futures import ThreadPoolExecutor
 import pyassimp as assimp
 from OpenGL.GLES2 import *
 from OpenGL.EGL import *
@@ -34,15 +36,23 @@ from humanav import utils
 
 __version__ = 'swiftshader_renderer'
 
+IDENTITY_MATRIX = np.reshape(np.eye(4, dtype=np.float32), (-1))
+
 def get_shaders(modalities):
   rgb_shader = 'rgb_flat_color' if 'rgb' in modalities else None
   d_shader = 'depth_rgb_encoded' if 'disparity' in modalities else None
   return rgb_shader, d_shader
 
 def sample_points_on_faces(vs, fs, rng, n_samples_per_face):
+  r = rng.rand(fs.shape[0]*n_samples_per_face, 2)
+  return sample_points_on_faces_from_random(vs, fs, r, n_samples_per_face)
+
+def sample_points_on_faces_from_random(vs, fs, r, n_samples_per_face):
+  """sample_points_on_faces with the random numbers r (faces x
+  n_samples_per_face rows) given. Sampling the faces of a mesh in chunks
+  with consecutive rows of rng.rand gives the same points."""
   idx = np.repeat(np.arange(fs.shape[0]), n_samples_per_face)
   
-  r = rng.rand(idx.size, 2)
   r1 = r[:,:1]; r2 = r[:,1:]; sqrt_r1 = np.sqrt(r1);
   
   v1 = vs[fs[idx, 0], :]; v2 = vs[fs[idx, 1], :]; v3 = vs[fs[idx, 2], :];
@@ -54,6 +64,65 @@ def sample_points_on_faces(vs, fs, rng, n_samples_per_face):
   return pts, ar, idx
 
 
+def iter_decoded_materials(file_names, materials_scale, dedup=False, num_threads=None,
+                           max_in_flight=None):
+  """Decodes (and resizes) the textures in file_names on a thread pool and
+  yields (file_name, img) in the order of file_names. At most max_in_flight
+  decoded textures are held at once, so textures can be uploaded as they
+  arrive without decoding all of them first. With dedup, files that were
+  already yielded are not decoded again and yielded as (file_name, None)."""
+  if num_threads is None:
+    num_threads = multiprocessing.cpu_count()
+  if max_in_flight is None:
+    max_in_flight = 2*num_threads
+  decode, seen = [], set()
+  for file_name in file_names:
+    decode.append(not (dedup and file_name in seen))
+    seen.add(file_name)
+  to_submit = iter([f for f, d in zip(file_names, decode) if d])
+
+  futures = collections.deque()
+  with ThreadPoolExecutor(max_workers=num_threads) as pool:
+    def _fill():
+      for file_name in to_submit:
+        futures.append(pool.submit(Shape._load_materials_from_file, file_name, materials_scale))
+        if len(futures) >= max_in_flight:
+          break
+    _fill()
+    for file_name, d in zip(file_names, decode):
+      if not d:
+        yield (file_name, None)
+        continue
+      material = futures.popleft().result()
+      _fill()
+      yield material
+
+def get_view_matrices(camera_xyz_n3, lookat_xyz_n3, up):
+  """Returns the N x 16 flattened view matrices (as uploaded to the shaders)
+  for N cameras at camera_xyz_n3 looking at lookat_xyz_n3, computed in one
+  vectorized pass. The camera looks along -z with y pointing up (along up)
+  in the view frame."""
+  camera_xyz_n3 = np.asarray(camera_xyz_n3, dtype=np.float64)
+  lookat_xyz_n3 = np.asarray(lookat_xyz_n3, dtype=np.float64)
+  up = np.asarray(up, dtype=np.float64).reshape((1, 3))
+
+  def _normalize(v):
+    return v / np.linalg.norm(v, axis=1, keepdims=True)
+  forward = _normalize(lookat_xyz_n3 - camera_xyz_n3)
+  side = _normalize(np.cross(forward, up))
+  true_up = np.cross(side, forward)
+
+  n = camera_xyz_n3.shape[0]
+  view_matrix = np.zeros((n, 4, 4), dtype=np.float32)
+  view_matrix[:, 0, :3] = side
+  view_matrix[:, 1, :3] = true_up
+  view_matrix[:, 2, :3] = -forward
+  view_matrix[:, :3, 3] = -np.einsum('nij,nj->ni', view_matrix[:, :3, :3], camera_xyz_n3)
+  view_matrix[:, 3, 3] = 1.
+  view_matrix = np.transpose(view_matrix, (0, 2, 1))
+  return np.reshape(view_matrix, (n, 16))
+
+
 class Shape():
   def get_pyassimp_load_options(self):
     load_flags = assimp.postprocess.aiProcess_Triangulate;
@@ -70,7 +139,10 @@ class Shape():
     return load_flags
 
   def __init__(self, obj_file, material_file=None, load_materials=True,
-               name_prefix='', name_suffix='', materials_scale=1.0):
+               name_prefix='', name_suffix='', materials_scale=1.0, defer_materials=False):
+    """If defer_materials, the textures are only decoded (on a thread pool)
+    when they are consumed through iter_materials, i.e. by the renderer
+    while loading the shape."""
     if material_file is not None:
       logging.error('Ignoring material file input, reading them off obj file.')
     load_flags = self.get_pyassimp_load_options()
@@ -83,16 +155,27 @@ class Shape():
 
     dir_name = os.path.dirname(obj_file)
     # Load materials
-    materials = None
+    self.scene = scene
+    self.materials = None
+    self.material_files = None
+    self.materials_scale = materials_scale
     if load_materials:
-      materials = []
+      self.material_files = []
       for m in self.meshes:
         file_name = os.path.join(dir_name, m.material.properties[('file', 1)])
         assert(os.path.exists(file_name)), \
             'Texture file {:s} foes not exist.'.format(file_name)
-        materials.append(self._load_materials_from_file(file_name, materials_scale))
-    self.scene = scene
-    self.materials = materials
+        self.material_files.append(file_name)
+      if not defer_materials:
+        self.materials = list(self.iter_materials())
+
+  def iter_materials(self, dedup=False):
+    """Yields the (file_name, img) material of every mesh. Textures that are
+    not loaded yet are decoded on a thread pool while being consumed. With
+    dedup, img may be None for a file_name that was already yielded."""
+    if self.materials is not None:
+      return iter(self.materials)
+    return iter_decoded_materials(self.material_files, self.materials_scale, dedup=dedup)
 
   @staticmethod
   def _load_materials_from_file(file_name, materials_scale):
@@ -156,11 +239,49 @@ class Shape():
     p, face_areas, face_idx = sample_points_on_faces(
         v, f, np.random.RandomState(0), n_samples_per_face)
     return p, face_areas, face_idx
+
+  def iter_point_samplers(self, i, n_samples_per_face, sc, faces_per_chunk):
+    """Splits sample_points_on_face_of_shape into chunks of faces_per_chunk
+    faces. Yields, in order, functions returning (p, face_areas, face_idx) of
+    a chunk (face_idx indexes the faces of the chunk). The random numbers of
+    a chunk are drawn when it is yielded, so the functions can be run in any
+    order (i.e. on a thread pool) and the chunks together are the same as
+    sample_points_on_face_of_shape."""
+    v = self.meshes[i].vertices*sc
+    f = self.meshes[i].faces
+    rng = np.random.RandomState(0)
+    for start in range(0, f.shape[0], faces_per_chunk):
+      fs = f[start:start+faces_per_chunk]
+      r = rng.rand(fs.shape[0]*n_samples_per_face, 2)
+      yield functools.partial(sample_points_on_faces_from_random, v, fs, r, n_samples_per_face)
   
   def __del__(self):
     scene = self.scene
     assimp.release(scene)
 
+class ArrayShape(Shape):
+  """A Shape whose meshes (vertices, faces and texture coordinates) and
+  materials are given as numpy arrays, i.e. memory mapped from the building
+  cache, instead of being loaded from an .obj file with pyassimp."""
+  def __init__(self, meshes, materials):
+    self.meshes = meshes
+    self.materials = materials
+    self.scene = None
+
+  @staticmethod
+  def make_mesh(name, vertices, faces, uvs):
+    return utils.Foo(name=name, vertices=vertices, faces=faces,
+                     texturecoords=uvs[np.newaxis], primitivetypes=4)
+
+  def flip_shape(self):
+    # The arrays may be read only, replace them instead of modifying them.
+    for m in self.meshes:
+      m.vertices = m.vertices*np.array([1., -1., 1.], dtype=m.vertices.dtype)
+      m.faces = np.ascontiguousarray(m.faces[:,[0,2,1]])
+
+  def __del__(self):
+    pass
+
 class HumanShape(Shape):
     def __init__(self, obj_file, human_materials, name_prefix='', name_suffix=''):
 
@@ -176,11 +297,13 @@ class HumanShape(Shape):
         self.scene = scene
  
     @staticmethod
-    def get_random_materials(texture_dir, dataset_mode, gender, rng, materials_scale=1.0, load_materials=True):
+    def get_random_materials(texture_dir, dataset_mode, gender, rng, materials_scale=1.0, load_materials=True,
+                             file_names=None):
         """
         For a fixed gender, sample a random set of human materials (i.e. skin and
         clothing.). This is useful upstream as it allows for fixing a human look (texture)
-        regardless of pose.
+        regardless of pose. file_names (the sorted texture files, i.e. from the
+        human manifest) are listed from texture_dir if not given.
         """
         if dataset_mode == 'train':
             texture_dir = os.path.join(texture_dir, 'train')
@@ -190,11 +313,12 @@ class HumanShape(Shape):
             raise NotImplementedError
 
         gender_dir = os.path.join(texture_dir, gender)
-        file_names = os.listdir(gender_dir)
-        # Remove extraneous files (hidden system files mostly)
-        file_names = list(filter(lambda x: 'jpg' in x and not x.startswith('.'), file_names))
-        file_names.sort()
-        file_name = os.path.join(gender_dir, rng.choice(file_names))
+        if file_names is None:
+            file_names = os.listdir(gender_dir)
+            # Remove extraneous files (hidden system files mostly)
+            file_names = list(filter(lambda x: 'jpg' in x and not x.startswith('.'), file_names))
+            file_names.sort()
+        file_name = os.path.join(gender_dir, file_names[rng.choice(len(file_names))])
 
         if load_materials:
             materials = [HumanShape._load_materials_from_file(file_name, materials_scale)]
@@ -205,10 +329,22 @@ class HumanShape(Shape):
 class SwiftshaderRenderer():
   def __init__(self):
     self.entities = {}
+    self.shared_textures = {}
+    self.mirrored = False
+    self.static_batches = []
+    self.tiled_fb = None
+    self.frustum_culling = False
+    self.indexed_geometry = False
+    self.cull_index = None
+    self.reset_culling_stats()
 
   def init_display(self, width, height, fov_horizontal, fov_vertical, z_near,
-    z_far, rgb_shader, d_shader, im_resize):
+    z_far, rgb_shader, d_shader, im_resize, frustum_culling=True,
+    indexed_geometry=False):
     self.init_renderer_egl(width, height)
+    self.frustum_culling = frustum_culling
+    self.indexed_geometry = indexed_geometry
+    self.index_dtype, self.index_gl_type = self._get_index_type()
     dir_path = os.path.dirname(os.path.realpath(__file__))
     #if d_shader is not None and rgb_shader is not None:
     #  logging.fatal('Does not support setting both rgb_shader and d_shader.')
@@ -238,6 +374,16 @@ class SwiftshaderRenderer():
     self.fov_horizontal = fov_horizontal
     self.fov_vertical = fov_vertical
     self.viewport = np.array([0, 0, self.width, self.height], dtype=np.int32)
+    self.modelview_matrix = np.reshape(np.eye(4), (-1))
+
+  def _get_index_type(self):
+    """Returns the numpy and GL types of index buffers. GLES2 only has 16
+    bit indices, 32 bit indices need the OES_element_index_uint extension."""
+    extensions = glGetString(GL_EXTENSIONS)
+    if extensions is not None and b'GL_OES_element_index_uint' in extensions:
+      return np.uint32, GL_UNSIGNED_INT
+    logging.warning('OES_element_index_uint not supported, using 16 bit indices.')
+    return np.uint16, GL_UNSIGNED_SHORT
 
   def get_salt_string(self):
     """Returns a string that uniquely identifies the camera properties."""
@@ -291,6 +437,7 @@ class SwiftshaderRenderer():
     self.egl_surface = egl_surface
     self.egl_config =  egl_config
     self.egl_mapping = {}
+    self.egl_uniforms = {}
     self.render_timer = utils.Timer()
     self.load_timer = None
     self.height = height
@@ -329,10 +476,19 @@ class SwiftshaderRenderer():
     self.egl_mapping['vertexs'] = 0
     self.egl_mapping['vertexs_tc'] = 1
 
+    # Look up uniform locations once instead of on every frame.
+    uniforms = {}
+    for name in ['uModelMatrix', 'uViewMatrix', 'uProjectionMatrix']:
+      uniforms[name] = glGetUniformLocation(egl_program, name)
+    # Everything but pose library humans is stored in world coordinates.
+    glUniformMatrix4fv(uniforms['uModelMatrix'], 1, GL_FALSE, IDENTITY_MATRIX)
+
     if shader == 'rgb_flat_color':
       self.egl_program['rgb'] = egl_program
+      self.egl_uniforms['rgb'] = uniforms
     elif shader == 'depth_rgb_encoded':
       self.egl_program['disparity'] = egl_program
+      self.egl_uniforms['disparity'] = uniforms
     else:
       assert(False)
 
@@ -345,6 +501,8 @@ class SwiftshaderRenderer():
     glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
 
   def set_camera(self, fov_vertical, fov_horizontal, z_near, z_far, aspect):
+    self.camera_args = dict(fov_vertical=fov_vertical, fov_horizontal=fov_horizontal,
+                            z_near=z_near, z_far=z_far, aspect=aspect)
     width = 2*np.tan(np.deg2rad(fov_horizontal)/2.0)*z_near*aspect;
     height = 2*np.tan(np.deg2rad(fov_vertical)/2.0)*z_near;
     c = np.eye(4, dtype=np.float32)
@@ -354,24 +512,28 @@ class SwiftshaderRenderer():
     c[2,3] = -2.0*(z_near*z_far)/(z_far-z_near)
     c[0,0] = 2.0*z_near/width
     c[1,1] = 2.0*z_near/height
+    if self.mirrored:
+      c[0,0] = -c[0,0]
     c = c.T
    
     projection_matrix = np.eye(4, dtype=np.float32)
     projection_matrix[...] = c
     projection_matrix = np.reshape(projection_matrix, (-1))
-    
-    if self.egl_program['rgb'] is not None:
-      glUseProgram(self.egl_program['rgb'])
-      projection_matrix_o = glGetUniformLocation(self.egl_program['rgb'], 'uProjectionMatrix')
-      glUniformMatrix4fv(projection_matrix_o, 1, GL_FALSE, projection_matrix)
-    
-    if self.egl_program['disparity'] is not None:
-      glUseProgram(self.egl_program['disparity'])
-      projection_matrix_o = glGetUniformLocation(self.egl_program['disparity'], 'uProjectionMatrix')
-      glUniformMatrix4fv(projection_matrix_o, 1, GL_FALSE, projection_matrix)
-    
+    self._set_uniform_matrix('uProjectionMatrix', projection_matrix)
     self.projection_matrix = projection_matrix.astype(np.double)
 
+  def set_mirrored(self, mirrored):
+    """Mirrors the rendered images horizontally, by negating the x axis of
+    the projection (which reverses the winding of all triangles). Rendering
+    a scene mirrored from the mirrored camera is the same as rendering the
+    mirrored scene, i.e. a flipped building is rendered from the loaded
+    unflipped one."""
+    if mirrored == self.mirrored:
+      return
+    self.mirrored = mirrored
+    self.set_camera(**self.camera_args)
+    glFrontFace(GL_CW if mirrored else GL_CCW)
+
   def load_default_object(self):
     v = np.array([[0.0, 0.5, 0.0, 1.0, 1.0, 0.0, 1.0],
                   [-0.5, -0.5, 0.0, 1.0, 0.0, 1.0, 1.0],
@@ -389,84 +551,285 @@ class SwiftshaderRenderer():
 
     self.num_to_render = 6;
 
-  def _actual_render(self, mode):
-    assert(mode in self.egl_program.keys())
-    glUseProgram(self.egl_program[mode])
-
-    for entity in self.entities.values():
-      if entity['visible']:
-        vbo = entity['vbo']
-        tbo = entity['tbo']
-        num = entity['num']
-
-
-        glBindBuffer(GL_ARRAY_BUFFER, vbo)
-        glVertexAttribPointer(self.egl_mapping['vertexs'], 3, GL_FLOAT, GL_FALSE, 20, ctypes.c_void_p(0))
-        glVertexAttribPointer(self.egl_mapping['vertexs_tc'], 2, GL_FLOAT, GL_FALSE, 20, ctypes.c_void_p(12))
+  def _actual_render(self, modes, viewports=None):
+    """Draws all visible entities. modes is a modality or a list of
+    modalities. The vertex buffer and texture of each draw call are bound
+    once and the draw call is then issued with the program of every modality
+    in modes, into viewports[i] for modes[i] if viewports is given."""
+    if not isinstance(modes, (list, tuple)):
+      modes = [modes]
+    for mode in modes:
+      assert(self.egl_program.get(mode, None) is not None)
+    single_pass = len(modes) == 1 and viewports is None
+    if single_pass:
+      glUseProgram(self.egl_program[modes[0]])
+
+    bound_vbo, bound_base, bound_tbo, bound_model = None, None, None, None
+    for vbo, uv_vbo, ibo, tbo, first, num, base, model in self._get_draw_calls():
+      if vbo != bound_vbo or base != bound_base:
+        # base selects the frame of a pose library, GLES2 has no base vertex
+        # argument for glDrawElements so the attributes are offset instead.
+        if uv_vbo is None:
+          offset = base*20
+          glBindBuffer(GL_ARRAY_BUFFER, vbo)
+          glVertexAttribPointer(self.egl_mapping['vertexs'], 3, GL_FLOAT, GL_FALSE, 20, ctypes.c_void_p(offset))
+          glVertexAttribPointer(self.egl_mapping['vertexs_tc'], 2, GL_FLOAT, GL_FALSE, 20, ctypes.c_void_p(offset+12))
+        else:
+          # Positions and uvs in separate buffers (humans moved in place)
+          glBindBuffer(GL_ARRAY_BUFFER, vbo)
+          glVertexAttribPointer(self.egl_mapping['vertexs'], 3, GL_FLOAT, GL_FALSE, 12, ctypes.c_void_p(base*12))
+          glBindBuffer(GL_ARRAY_BUFFER, uv_vbo)
+          glVertexAttribPointer(self.egl_mapping['vertexs_tc'], 2, GL_FLOAT, GL_FALSE, 8, ctypes.c_void_p(base*8))
         glEnableVertexAttribArray(self.egl_mapping['vertexs'])
         glEnableVertexAttribArray(self.egl_mapping['vertexs_tc'])
-        
+        # An index buffer always belongs to a single vertex buffer
+        if ibo is not None:
+          glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, ibo)
+        bound_vbo, bound_base = vbo, base
+
+      if model is not bound_model:
+        self._set_model_matrix(modes, model)
+        bound_model = model
+
+      if tbo != bound_tbo:
         glBindTexture(GL_TEXTURE_2D, tbo)
         # glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR);
         # glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR);
-        glDrawArrays(GL_TRIANGLES, 0, num)
+        bound_tbo = tbo
+
+      if single_pass:
+        self._draw(ibo, first, num)
+      else:
+        for k, mode in enumerate(modes):
+          glUseProgram(self.egl_program[mode])
+          if viewports is not None:
+            glViewport(*viewports[k])
+          self._draw(ibo, first, num)
+
+    if bound_model is not None:
+      self._set_model_matrix(modes, None)
+
+  def _set_model_matrix(self, modes, model):
+    """Sets the (flattened) model matrix of the programs of modes, the
+    identity if model is None."""
+    model = IDENTITY_MATRIX if model is None else model
+    for mode in modes:
+      glUseProgram(self.egl_program[mode])
+      glUniformMatrix4fv(self.egl_uniforms[mode]['uModelMatrix'], 1, GL_FALSE, model)
+
+  def _draw(self, ibo, first, num):
+    """Draws num vertices (indices if ibo is not None) starting at first
+    from the bound buffers."""
+    if ibo is None:
+      glDrawArrays(GL_TRIANGLES, first, num)
+    else:
+      offset = first*np.dtype(self.index_dtype).itemsize
+      glDrawElements(GL_TRIANGLES, num, self.index_gl_type, ctypes.c_void_p(offset))
 
   def render(self, modality, take_screenshot=False, output_type=0):
+    if isinstance(modality, (list, tuple)):
+      # Several modalities at once need one tile per modality.
+      assert(take_screenshot)
+      return self.render_batch(modality, [self.modelview_matrix])[0]
+
     with self.render_timer.record():
       self._actual_render(modality)
     self.render_timer.display(log_at=100, log_str='render timer: ', type='time')
 
     np_rgb_img = None
     np_d_img = None
-    c = 1000.
     if take_screenshot:
-      if modality == 'rgb':
-        # Even though we dont want the alpha channel, opengl crashes if you
-        # dont read it. Bad OpenGL.
-        screenshot_rgba = np.zeros((self.height, self.width, 4), dtype=np.uint8)
-        
-        glReadPixels(0, 0, self.width, self.height, GL_RGBA, GL_UNSIGNED_BYTE, screenshot_rgba)
-        np_rgb_img = screenshot_rgba[::-1,:,:3]
-        
-        # Resize here if necessary.
-        if self.im_resize < 1.:
-          np_rgb_img = cv2.resize(np_rgb_img, None, None, fx=self.im_resize,
-            fy=self.im_resize, interpolation=cv2.INTER_LINEAR)
-        elif self.im_resize > 1.:
-          np_rgb_img = cv2.resize(np_rgb_img, None, None, fx=self.im_resize, 
-            fy=self.im_resize, interpolation=cv2.INTER_AREA)
-
-      if modality == 'disparity': 
-        screenshot_d = np.zeros((self.height, self.width, 4), dtype=np.uint8)
-        glReadPixels(0, 0, self.width, self.height, GL_RGBA, GL_UNSIGNED_BYTE, screenshot_d)
-        np_d_img = screenshot_d[::-1,:,:3];
-        np_d_img = np_d_img[:,:,2]*(255.*255./c) + np_d_img[:,:,1]*(255./c) + np_d_img[:,:,0]*(1./c)
-        np_d_img = np_d_img.astype(np.float32)
-        # np_d_img[np_d_img == 0] = np.NaN
-        np_d_img = np_d_img[:,:,np.newaxis]
-        d = np_d_img
-        d[d < 0.01] = np.NaN; isnan = np.isnan(d);
-        d = 100./d; d[isnan] = 0.;
-        d = np.concatenate((d, isnan), axis=2)
-        np_d_img = d
-        
-        # Resize here if necessary.
-        if self.im_resize < 1.:
-          np_d_img_0 = cv2.resize(np_d_img[...,0], None, None,
-            fx=self.im_resize, fy=self.im_resize, interpolation=cv2.INTER_AREA)
-        elif self.im_resize > 1.:
-          np_d_img_0 = cv2.resize(np_d_img[...,0], None, None, fx=self.im_resize,
-            fy=self.im_resize, interpolation=cv2.INTER_AREA)
-        if self.im_resize != 1.:
-          np_d_img_1 = cv2.resize(np_d_img[...,1], None, None,
-            fx=self.im_resize, fy=self.im_resize,
-            interpolation=cv2.INTER_NEAREST)
-          np_d_img = np.concatenate((np_d_img_0[:,:,np.newaxis],
-            np_d_img_1[:,:,np.newaxis]), axis=2)
+      # Even though we dont want the alpha channel, opengl crashes if you
+      # dont read it. Bad OpenGL.
+      screenshot_rgba = np.zeros((self.height, self.width, 4), dtype=np.uint8)
+      glReadPixels(0, 0, self.width, self.height, GL_RGBA, GL_UNSIGNED_BYTE, screenshot_rgba)
+      np_rgb_img, np_d_img = self._postprocess_screenshot(modality, screenshot_rgba)
 
     glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
     return np_rgb_img, np_d_img
 
+  def _postprocess_screenshot(self, modality, screenshot_rgba):
+    """Converts a (bottom up) RGBA readback of a height x width viewport into
+    the rgb or disparity image for modality. Returns (np_rgb_img, np_d_img)
+    with the entry for the other modality set to None."""
+    np_rgb_img = None
+    np_d_img = None
+    c = 1000.
+    if modality == 'rgb':
+      np_rgb_img = screenshot_rgba[::-1,:,:3]
+
+      # Resize here if necessary.
+      if self.im_resize < 1.:
+        np_rgb_img = cv2.resize(np_rgb_img, None, None, fx=self.im_resize,
+          fy=self.im_resize, interpolation=cv2.INTER_LINEAR)
+      elif self.im_resize > 1.:
+        np_rgb_img = cv2.resize(np_rgb_img, None, None, fx=self.im_resize, 
+          fy=self.im_resize, interpolation=cv2.INTER_AREA)
+
+    if modality == 'disparity': 
+      np_d_img = screenshot_rgba[::-1,:,:3];
+      np_d_img = np_d_img[:,:,2]*(255.*255./c) + np_d_img[:,:,1]*(255./c) + np_d_img[:,:,0]*(1./c)
+      np_d_img = np_d_img.astype(np.float32)
+      # np_d_img[np_d_img == 0] = np.NaN
+      np_d_img = np_d_img[:,:,np.newaxis]
+      d = np_d_img
+      d[d < 0.01] = np.NaN; isnan = np.isnan(d);
+      d = 100./d; d[isnan] = 0.;
+      d = np.concatenate((d, isnan), axis=2)
+      np_d_img = d
+      
+      # Resize here if necessary.
+      if self.im_resize < 1.:
+        np_d_img_0 = cv2.resize(np_d_img[...,0], None, None,
+          fx=self.im_resize, fy=self.im_resize, interpolation=cv2.INTER_AREA)
+      elif self.im_resize > 1.:
+        np_d_img_0 = cv2.resize(np_d_img[...,0], None, None, fx=self.im_resize,
+          fy=self.im_resize, interpolation=cv2.INTER_AREA)
+      if self.im_resize != 1.:
+        np_d_img_1 = cv2.resize(np_d_img[...,1], None, None,
+          fx=self.im_resize, fy=self.im_resize,
+          interpolation=cv2.INTER_NEAREST)
+        np_d_img = np.concatenate((np_d_img_0[:,:,np.newaxis],
+          np_d_img_1[:,:,np.newaxis]), axis=2)
+    return np_rgb_img, np_d_img
+
+  def render_pipelined(self, modality, view_matrices, ring_size=2):
+    """Generator that renders the scene from each (flattened) view matrix in
+    view_matrices and yields (np_rgb_img, np_d_img) tuples in order, same as
+    render(modality, take_screenshot=True). Frames are read back into a ring
+    of ring_size preallocated buffers and post-processed (flip, decode,
+    resize) on a worker thread, so that the draw for frame i+1 overlaps the
+    copy-out of frame i. Pixel buffer objects are not used as they are not
+    part of the OpenGL ES 2.0 contexts created by init_renderer_egl."""
+    assert(ring_size >= 1)
+    ring = [np.zeros((self.height, self.width, 4), dtype=np.uint8) for _ in range(ring_size)]
+    pending = collections.deque()
+
+    def _copy_out(modality, screenshot_rgba):
+      np_rgb_img, np_d_img = self._postprocess_screenshot(modality, screenshot_rgba)
+      if np_rgb_img is not None:
+        # The ring buffer is reused, do not hand out views into it.
+        np_rgb_img = np.array(np_rgb_img)
+      return np_rgb_img, np_d_img
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+      for i, view_matrix in enumerate(view_matrices):
+        if len(pending) == ring_size:
+          yield pending.popleft().result()
+        screenshot_rgba = ring[i % ring_size]
+        self._set_view_matrix(np.asarray(view_matrix, dtype=np.float32))
+        with self.render_timer.record():
+          self._actual_render(modality)
+        glReadPixels(0, 0, self.width, self.height, GL_RGBA, GL_UNSIGNED_BYTE, screenshot_rgba)
+        glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+        pending.append(executor.submit(_copy_out, modality, screenshot_rgba))
+        self.render_timer.display(log_at=100, log_str='render timer: ', type='time')
+      while len(pending) > 0:
+        yield pending.popleft().result()
+
+  def _get_tiled_framebuffer(self, n):
+    """Returns an offscreen framebuffer laid out as a grid of height x width
+    tiles that holds up to n views (fewer if n tiles exceed the maximum
+    texture size). The framebuffer is reused across calls and only
+    reallocated when a larger one is needed."""
+    max_size = min(int(glGetIntegerv(GL_MAX_TEXTURE_SIZE)),
+                   int(glGetIntegerv(GL_MAX_RENDERBUFFER_SIZE)))
+    max_cols = max(1, max_size // self.width)
+    max_rows = max(1, max_size // self.height)
+    n = int(min(n, max_cols*max_rows))
+
+    fb = self.tiled_fb
+    if fb is not None and fb.cols*fb.rows >= n:
+      return fb
+
+    cols = int(min(max_cols, np.ceil(np.sqrt(n))))
+    rows = int(np.ceil(n*1./cols))
+    self._delete_tiled_framebuffer()
+
+    tex = glGenTextures(1)
+    glBindTexture(GL_TEXTURE_2D, tex)
+    glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA, cols*self.width, rows*self.height,
+                 0, GL_RGBA, GL_UNSIGNED_BYTE, None)
+    glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST);
+    glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST);
+
+    rbo = glGenRenderbuffers(1)
+    glBindRenderbuffer(GL_RENDERBUFFER, rbo)
+    glRenderbufferStorage(GL_RENDERBUFFER, GL_DEPTH_COMPONENT16,
+                          cols*self.width, rows*self.height)
+
+    fbo = glGenFramebuffers(1)
+    glBindFramebuffer(GL_FRAMEBUFFER, fbo)
+    glFramebufferTexture2D(GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0, GL_TEXTURE_2D, tex, 0)
+    glFramebufferRenderbuffer(GL_FRAMEBUFFER, GL_DEPTH_ATTACHMENT, GL_RENDERBUFFER, rbo)
+    assert(glCheckFramebufferStatus(GL_FRAMEBUFFER) == GL_FRAMEBUFFER_COMPLETE)
+    glBindFramebuffer(GL_FRAMEBUFFER, 0)
+    assert(glGetError() == GL_NO_ERROR)
+
+    self.tiled_fb = utils.Foo(fbo=fbo, tex=tex, rbo=rbo, cols=cols, rows=rows)
+    return self.tiled_fb
+
+  def _delete_tiled_framebuffer(self):
+    fb = self.tiled_fb
+    if fb is not None:
+      glDeleteFramebuffers(1, [fb.fbo])
+      glDeleteRenderbuffers(1, [fb.rbo])
+      glDeleteTextures(1, [fb.tex])
+    self.tiled_fb = None
+
+  def _get_tile_viewport(self, fb, i):
+    return ((i % fb.cols)*self.width, (i // fb.cols)*self.height,
+            self.width, self.height)
+
+  def render_batch(self, modality, view_matrices):
+    """Renders the scene once for each (flattened) view matrix in
+    view_matrices. The views are drawn into the tiles of one offscreen
+    framebuffer and copied out with a single glReadPixels per framebuffer
+    full of tiles. modality may be a list (e.g. ['rgb', 'disparity']), in
+    which case every view takes one tile per modality and the scene is
+    traversed only once per view. Returns a list with one
+    (np_rgb_img, np_d_img) tuple per view, same as
+    render(modality, take_screenshot=True)."""
+    modalities = list(modality) if isinstance(modality, (list, tuple)) else [modality]
+    m = len(modalities)
+    view_matrices = np.reshape(np.asarray(view_matrices, dtype=np.float32), (-1, 16))
+    fb = self._get_tiled_framebuffer(len(view_matrices)*m)
+    n_views = (fb.cols*fb.rows) // m
+    assert(n_views > 0), 'Framebuffer can not hold {:d} tiles.'.format(m)
+    outs = []
+
+    glBindFramebuffer(GL_FRAMEBUFFER, fb.fbo)
+    try:
+      for i in range(0, len(view_matrices), n_views):
+        batch = view_matrices[i:i+n_views]
+        rows = int(np.ceil(len(batch)*m*1./fb.cols))
+        glViewport(0, 0, fb.cols*self.width, fb.rows*self.height)
+        glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+        with self.render_timer.record():
+          for j, view_matrix in enumerate(batch):
+            self._set_view_matrix(view_matrix)
+            viewports = [self._get_tile_viewport(fb, j*m+k) for k in range(m)]
+            self._actual_render(modalities, viewports)
+
+        screenshot_rgba = np.zeros((rows*self.height, fb.cols*self.width, 4), dtype=np.uint8)
+        glReadPixels(0, 0, fb.cols*self.width, rows*self.height, GL_RGBA,
+                     GL_UNSIGNED_BYTE, screenshot_rgba)
+        tiles = np.reshape(screenshot_rgba, (rows, self.height, fb.cols, self.width, 4))
+        tiles = np.reshape(np.transpose(tiles, (0, 2, 1, 3, 4)), (-1, self.height, self.width, 4))
+        for j in range(len(batch)):
+          np_rgb_img, np_d_img = None, None
+          for k, mode in enumerate(modalities):
+            rgb, d = self._postprocess_screenshot(mode, tiles[j*m+k])
+            np_rgb_img = rgb if rgb is not None else np_rgb_img
+            np_d_img = d if d is not None else np_d_img
+          outs.append((np_rgb_img, np_d_img))
+    finally:
+      glBindFramebuffer(GL_FRAMEBUFFER, 0)
+      glViewport(0, 0, self.width, self.height)
+
+    self.render_timer.display(log_at=100, log_str='render timer: ', type='time')
+    return outs
+
   def _mesh_to_vvt(self, mesh):
     vvt = np.concatenate((mesh.vertices, mesh.texturecoords[0,:,:2]), axis=1)
     vvt = np.ascontiguousarray(vvt[mesh.faces.reshape((-1)),:], dtype=np.float32)
@@ -474,27 +837,79 @@ class SwiftshaderRenderer():
     vvt = np.reshape(vvt, (-1))
     return vvt, num
 
-  def update_human_mesh(self, mesh):
+  def _mesh_to_indexed_vvt(self, mesh):
+    """Returns the unique [x, y, z, u, v] vertices of mesh and the indices of
+    the vertices of its faces into them. Vertices that only differ in
+    attributes that are not uploaded (i.e. normals) are merged."""
+    vvt = np.concatenate((mesh.vertices, mesh.texturecoords[0,:,:2]), axis=1)
+    vvt = np.asarray(vvt, dtype=np.float32)
+    vvt, inverse = np.unique(vvt, axis=0, return_inverse=True)
+    indices = np.reshape(inverse, (-1))[mesh.faces.reshape((-1))]
+    return np.ascontiguousarray(vvt), indices
+
+  def _fits_index_type(self, num_vertices):
+    return num_vertices - 1 <= np.iinfo(self.index_dtype).max
+
+  def _load_indices_into_gl(self, indices):
+    indices = np.ascontiguousarray(indices, dtype=self.index_dtype)
+    ibo = glGenBuffers(1)
+    glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, ibo)
+    glBufferData(GL_ELEMENT_ARRAY_BUFFER, indices.nbytes, indices, GL_STATIC_DRAW)
+    assert(glGetError() == GL_NO_ERROR)
+    return ibo
+
+  def _get_human_keys(self, human_id=None):
+    """Returns the entity ids of the meshes of human human_id (of all humans
+    if human_id is None)."""
+    return [k for k, e in self.entities.items()
+            if 'human_id' in e and (human_id is None or e['human_id'] == human_id)]
+
+  def update_human_mesh(self, mesh, human_id=None):
     """
-    Update the human mesh used by OpenGL.
+    Update the mesh of human human_id used by OpenGL. human_id may only be
+    None if there is at most one human in the scene. The vertex buffers and
+    texture of the human are kept. If the topology (faces) of mesh is the
+    same as that of the loaded mesh only its position buffer is
+    overwritten, from the persistent staging buffer of the human, and its
+    uv buffer is left untouched.
     """
-    human_keys = list(filter(lambda x: 'human' in x, self.entities.keys()))
+    human_keys = self._get_human_keys(human_id)
 
-    # Currently only 1 human is supported
+    # A human consists of a single mesh
     assert(len(human_keys) <= 1)
 
     if len(human_keys) == 1:
-        # Get the Vertex Buffer Object Index for the Human (vbo)
-        vbo = self.entities[human_keys[0]]['vbo']
-
-        # Bind the new vertex, texture, and face data (vvt) to the old memory location
-        vvt, num = self._mesh_to_vvt(mesh)
-        glBindBuffer(GL_ARRAY_BUFFER, vbo)
-        glBufferData(GL_ARRAY_BUFFER, vvt.dtype.itemsize*vvt.size, vvt, GL_STATIC_DRAW)
+        entity = self.entities[human_keys[0]]
+        assert 'library' not in entity, 'Use set_human_pose to move pose library humans.'
+        if np.array_equal(entity['faces'], mesh.faces):
+            staging = entity['staging']
+            staging[...] = mesh.vertices[entity['faces'].reshape((-1))]
+            glBindBuffer(GL_ARRAY_BUFFER, entity['vbo'])
+            glBufferSubData(GL_ARRAY_BUFFER, 0, staging.nbytes, staging)
+        else:
+            # Bind the new vertex and uv data to the old buffers
+            entity['num'], entity['staging'] = self._load_human_mesh_into_gl(
+                mesh, entity['vbo'], entity['uv_vbo'])
+            entity['faces'] = mesh.faces*1
         assert(glGetError() == GL_NO_ERROR)
-
-  def _load_mesh_into_gl(self, mesh, material=None, tbo=None):
-    vvt, num = self._mesh_to_vvt(mesh)
+        entity['bbox'] = self._get_mesh_bbox(mesh)
+        self.cull_index = None
+
+  def _load_mesh_into_gl(self, mesh, material=None, tbo=None, indexed=False):
+    """Loads mesh into a vertex buffer (and with indexed into an index
+    buffer over its unique vertices, if the index type is large enough).
+    Returns the number of vertices (indices) to draw, the vertex buffer, the
+    texture and the index buffer (None if not indexed)."""
+    ibo = None
+    if indexed:
+      vvt, indices = self._mesh_to_indexed_vvt(mesh)
+      indexed = self._fits_index_type(vvt.shape[0])
+    if indexed:
+      vvt = np.reshape(vvt, (-1))
+      num = indices.size
+      ibo = self._load_indices_into_gl(indices)
+    else:
+      vvt, num = self._mesh_to_vvt(mesh)
 
     vbo = glGenBuffers(1)
     glBindBuffer(GL_ARRAY_BUFFER, vbo)
@@ -507,119 +922,440 @@ class SwiftshaderRenderer():
     
     if tbo is None:
       assert(material is not None)
-      tbo = glGenTextures(1)
-      glBindTexture(GL_TEXTURE_2D, tbo)
-      glTexImage2D(GL_TEXTURE_2D, 0, GL_RGB, material.shape[1],
-                   material.shape[0], 0, GL_RGB, GL_UNSIGNED_BYTE,
-                   np.reshape(material, (-1)))
-      # glPixelStorei(GL_UNPACK_ALIGNMENT,1)
-      # m = np.zeros([material.shape[0], material.shape[1], 4], dtype=material.dtype)
-      # m[...,:3] = material
-      # m[...,3] = 255
-      # glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA, m.shape[1],
-      #              m.shape[0], 0, GL_RGBA, GL_UNSIGNED_BYTE,
-      #              np.reshape(m, (-1)))
-      glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR);
-      glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR_MIPMAP_LINEAR);
-      glGenerateMipmap(GL_TEXTURE_2D);
-      assert(glGetError() == GL_NO_ERROR)
-    
+      tbo = self._load_texture_into_gl(material)
     else:
       assert(material is None)
     
-    return num, vbo, tbo
-
-  def load_shapes(self, shapes, dedup_tbo=False, allow_repeat_humans=False):
+    return num, vbo, tbo, ibo
+
+  def _load_human_mesh_into_gl(self, mesh, vbo, uv_vbo):
+    """Loads the vertex positions of the faces of mesh into vbo and their uvs
+    into uv_vbo. Returns the number of vertices and the (num x 3) positions,
+    which update_human_mesh reuses as staging buffer."""
+    faces = mesh.faces.reshape((-1))
+    positions = np.ascontiguousarray(mesh.vertices[faces], dtype=np.float32)
+    uvs = np.ascontiguousarray(mesh.texturecoords[0,faces,:2], dtype=np.float32)
+    glBindBuffer(GL_ARRAY_BUFFER, vbo)
+    glBufferData(GL_ARRAY_BUFFER, positions.nbytes, positions, GL_DYNAMIC_DRAW)
+    glBindBuffer(GL_ARRAY_BUFFER, uv_vbo)
+    glBufferData(GL_ARRAY_BUFFER, uvs.nbytes, uvs, GL_STATIC_DRAW)
+    assert(glGetError() == GL_NO_ERROR)
+    return positions.shape[0], positions
+
+  def _load_texture_into_gl(self, material):
+    tbo = glGenTextures(1)
+    glBindTexture(GL_TEXTURE_2D, tbo)
+    glTexImage2D(GL_TEXTURE_2D, 0, GL_RGB, material.shape[1],
+                 material.shape[0], 0, GL_RGB, GL_UNSIGNED_BYTE,
+                 np.reshape(material, (-1)))
+    # glPixelStorei(GL_UNPACK_ALIGNMENT,1)
+    # m = np.zeros([material.shape[0], material.shape[1], 4], dtype=material.dtype)
+    # m[...,:3] = material
+    # m[...,3] = 255
+    # glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA, m.shape[1],
+    #              m.shape[0], 0, GL_RGBA, GL_UNSIGNED_BYTE,
+    #              np.reshape(m, (-1)))
+    glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR);
+    glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR_MIPMAP_LINEAR);
+    glGenerateMipmap(GL_TEXTURE_2D);
+    assert(glGetError() == GL_NO_ERROR)
+    return tbo
+
+  def _get_mesh_bbox(self, mesh):
+    """Returns the 2 x 3 axis aligned bounding box [min_xyz, max_xyz] of mesh."""
+    return np.array([np.min(mesh.vertices, axis=0), np.max(mesh.vertices, axis=0)])
+
+  def load_shapes(self, shapes, dedup_tbo=False, allow_repeat_humans=False,
+                  shared_textures=False):
+    """Loads shapes with one vertex buffer per mesh. With shared_textures
+    textures are shared by file name with all entities loaded the same way
+    (i.e. streamed building tiles) and deleted by remove_entities once no
+    entity uses them anymore."""
+    self.cull_index = None
     entities = self.entities
     entity_ids = []
     dedup_dict = {}
     for i, shape in enumerate(shapes):
-      for j in range(len(shape.meshes)):
+      # Textures are uploaded as they are decoded
+      for j, (file_name, img) in enumerate(shape.iter_materials(dedup=dedup_tbo)):
         name = shape.meshes[j].name
         if not (allow_repeat_humans and 'human' in name):
             assert name not in entities, '{:s} entity already exists.'.format(name)
-        if shape.materials[j][0] in dedup_dict and dedup_tbo:
-          tbo = dedup_dict[shape.materials[j][0]]
-          # logging.error('dedup: %s', shape.materials[j][0])
-          num, vbo, tbo = self._load_mesh_into_gl(shape.meshes[j], material=None, tbo=tbo)
+        if shared_textures:
+          tbo = self._acquire_shared_texture(file_name, img)
+          num, vbo, tbo, ibo = self._load_mesh_into_gl(shape.meshes[j], material=None, tbo=tbo,
+                                                       indexed=self.indexed_geometry)
+          entities[name] = {'num': num, 'vbo': vbo, 'tbo': tbo, 'ibo': ibo, 'visible': False,
+                            'bbox': self._get_mesh_bbox(shape.meshes[j]),
+                            'texture_key': file_name}
+          entity_ids.append(name)
+          continue
+        if file_name in dedup_dict and dedup_tbo:
+          tbo = dedup_dict[file_name]
+          # logging.error('dedup: %s', file_name)
+          num, vbo, tbo, ibo = self._load_mesh_into_gl(shape.meshes[j], material=None, tbo=tbo,
+                                                       indexed=self.indexed_geometry)
         else:
-          num, vbo, tbo = self._load_mesh_into_gl(shape.meshes[j], shape.materials[j][1])
-          dedup_dict[shape.materials[j][0]] = tbo
-        entities[name] = {'num': num, 'vbo': vbo, 'tbo': tbo, 'visible': False}
+          num, vbo, tbo, ibo = self._load_mesh_into_gl(shape.meshes[j], img,
+                                                       indexed=self.indexed_geometry)
+          dedup_dict[file_name] = tbo
+        entities[name] = {'num': num, 'vbo': vbo, 'tbo': tbo, 'ibo': ibo, 'visible': False,
+                          'bbox': self._get_mesh_bbox(shape.meshes[j])}
+        entity_ids.append(name)
+    return entity_ids
+
+  def remove_entities(self, entity_ids):
+    """Deletes the entities entity_ids loaded with load_shapes. Shared
+    textures are released, other textures are deleted unless another
+    entity still uses them."""
+    tbos = []
+    for entity_id in entity_ids:
+      entity = self.entities.pop(entity_id)
+      assert not entity.get('static', False), \
+          'Entities of the compiled static scene can not be removed.'
+      glDeleteBuffers(1, [entity['vbo']])
+      if entity['ibo'] is not None:
+        glDeleteBuffers(1, [entity['ibo']])
+      if 'texture_key' in entity:
+        self._release_shared_texture(entity['texture_key'])
+      elif entity['tbo'] not in tbos:
+        tbos.append(entity['tbo'])
+    in_use = set([e['tbo'] for e in self.entities.values()])
+    for tbo in tbos:
+      if tbo not in in_use:
+        glDeleteTextures(1, [tbo])
+    if len(entity_ids) > 0:
+      self.cull_index = None
+
+  def load_human_shapes(self, shapes, human_id=0):
+    """Loads the meshes of human human_id. Every human has its own vertex
+    buffer, textures are shared between humans with the same texture file
+    and deleted once the last human using them is removed. (GLES2 has no
+    instanced drawing, and every human has its own pose anyway.)"""
+    self.cull_index = None
+    entities = self.entities
+    entity_ids = []
+    for shape in shapes:
+      for j in range(len(shape.meshes)):
+        name = shape.meshes[j].name
+        assert name not in entities, '{:s} entity already exists.'.format(name)
+        texture_key = shape.materials[j][0]
+        tbo = self._acquire_shared_texture(texture_key, shape.materials[j][1])
+        # Humans are moved in place (update_human_mesh), they are never
+        # indexed. Their positions and uvs are in separate buffers so that
+        # only the positions are uploaded when they move, from a host copy
+        # of the positions (kept with the faces they were built from).
+        vbo, uv_vbo = glGenBuffers(1), glGenBuffers(1)
+        num, staging = self._load_human_mesh_into_gl(shape.meshes[j], vbo, uv_vbo)
+        entities[name] = {'num': num, 'vbo': vbo, 'uv_vbo': uv_vbo, 'tbo': tbo, 'ibo': None,
+                          'visible': False, 'bbox': self._get_mesh_bbox(shape.meshes[j]),
+                          'human_id': human_id, 'texture_key': texture_key,
+                          'staging': staging, 'faces': shape.meshes[j].faces*1}
         entity_ids.append(name)
     return entity_ids
 
+  def load_human_pose_library(self, name, vertices_fv3, faces, uvs, material, human_id=0):
+    """Loads all frames (vertices_fv3, in the ego frame of the human) of a
+    pose sequence of human human_id, which share faces and uvs, into a single
+    vertex buffer. Frames are then switched with set_human_pose, by drawing
+    another range of the buffer with another model matrix, without
+    uploading any vertices. material is a (texture_key, image) tuple.
+    Returns the entity ids of the human."""
+    self.cull_index = None
+    assert name not in self.entities, '{:s} entity already exists.'.format(name)
+    num_frames, num_vertices = vertices_fv3.shape[:2]
+    vvt = np.zeros((num_frames, num_vertices, 5), dtype=np.float32)
+    vvt[:,:,:3] = vertices_fv3
+    vvt[:,:,3:] = uvs[np.newaxis,:,:2]
+    faces = np.reshape(faces, (-1))
+    if self._fits_index_type(num_vertices):
+      # The indices of a single frame, frames are selected by the base vertex
+      ibo = self._load_indices_into_gl(faces)
+      frame_stride = num_vertices
+    else:
+      ibo = None
+      vvt = vvt[:, faces, :]
+      frame_stride = faces.size
+    vvt = np.reshape(vvt, (-1))
+    vbo = glGenBuffers(1)
+    glBindBuffer(GL_ARRAY_BUFFER, vbo)
+    glBufferData(GL_ARRAY_BUFFER, vvt.dtype.itemsize*vvt.size, vvt, GL_STATIC_DRAW)
+    assert(glGetError() == GL_NO_ERROR)
+
+    texture_key = material[0]
+    tbo = self._acquire_shared_texture(texture_key, material[1])
+    bboxes = np.stack([np.min(vertices_fv3, axis=1), np.max(vertices_fv3, axis=1)], axis=1)
+    self.entities[name] = {'num': faces.size, 'vbo': vbo, 'tbo': tbo, 'ibo': ibo,
+                           'visible': False, 'first': 0, 'base': 0, 'model': None,
+                           'bbox': bboxes[0], 'human_id': human_id,
+                           'texture_key': texture_key,
+                           'library': utils.Foo(num_frames=num_frames, bboxes=bboxes,
+                                                frame_stride=frame_stride)}
+    return [name]
+
+  def set_human_pose(self, human_id, frame, model_matrix):
+    """Draws frame of the pose library of human human_id transformed by the
+    4 x 4 model_matrix (ego to world coordinates)."""
+    human_keys = self._get_human_keys(human_id)
+    assert(len(human_keys) == 1)
+    entity = self.entities[human_keys[0]]
+    library = entity['library']
+    assert(0 <= frame < library.num_frames)
+    if entity['ibo'] is None:
+      entity['first'], entity['base'] = frame*library.frame_stride, 0
+    else:
+      entity['first'], entity['base'] = 0, frame*library.frame_stride
+    entity['model'] = np.ascontiguousarray(np.asarray(model_matrix, dtype=np.float32).T.reshape(-1))
+
+    # Axis aligned world bounding box of the transformed ego bounding box
+    bbox = library.bboxes[frame]
+    corners = np.array([[bbox[i,0], bbox[j,1], bbox[k,2], 1.] for i in range(2)
+                        for j in range(2) for k in range(2)])
+    corners = np.dot(corners, np.asarray(model_matrix, dtype=np.float64).T)[:,:3]
+    entity['bbox'] = np.array([np.min(corners, axis=0), np.max(corners, axis=0)])
+    self.cull_index = None
+
+  def _acquire_shared_texture(self, texture_key, material):
+    if texture_key not in self.shared_textures:
+      self.shared_textures[texture_key] = {'tbo': self._load_texture_into_gl(material),
+                                          'refs': 0}
+    self.shared_textures[texture_key]['refs'] += 1
+    return self.shared_textures[texture_key]['tbo']
+
+  def _release_shared_texture(self, texture_key):
+    texture = self.shared_textures[texture_key]
+    texture['refs'] -= 1
+    if texture['refs'] == 0:
+      glDeleteTextures(1, [texture['tbo']])
+      self.shared_textures.pop(texture_key)
+
+  def load_static_shapes(self, shapes):
+    """Loads shapes that do not change after loading (i.e. the building) as
+    a compiled static scene. The vertices of all meshes are concatenated
+    into a single vertex buffer, ordered by texture, so that _actual_render
+    binds the buffer once and issues one draw call per texture (per run of
+    visible entities). Meshes with the same texture file always share one
+    texture object, otherwise every mesh would be its own batch. Every mesh
+    is still an entity whose visibility can be toggled with
+    set_entity_visible. With indexed_geometry the buffer only holds the
+    unique vertices of every mesh, drawn through a single index buffer
+    (ordered the same way)."""
+    self.cull_index = None
+    entities = self.entities
+    entity_ids = []
+    dedup_dict = {}
+    meshes_by_tbo = collections.OrderedDict()
+    for i, shape in enumerate(shapes):
+      # Textures are uploaded as they are decoded
+      for j, (file_name, img) in enumerate(shape.iter_materials(dedup=True)):
+        name = shape.meshes[j].name
+        assert name not in entities, '{:s} entity already exists.'.format(name)
+        if file_name in dedup_dict:
+          tbo = dedup_dict[file_name]
+        else:
+          tbo = self._load_texture_into_gl(img)
+          dedup_dict[file_name] = tbo
+        meshes_by_tbo.setdefault(tbo, []).append(shape.meshes[j])
+
+    indexed = self.indexed_geometry
+    vvts, indicess = [], []
+    first = 0
+    num_vertices = 0
+    batches = []
+    for tbo, meshes in meshes_by_tbo.items():
+      batch_entity_ids = []
+      for mesh in meshes:
+        if indexed:
+          vvt, indices = self._mesh_to_indexed_vvt(mesh)
+          # Rebase the indices of the mesh into the merged vertex buffer
+          indicess.append(indices + num_vertices)
+          num_vertices += vvt.shape[0]
+          vvt, num = np.reshape(vvt, (-1)), indices.size
+        else:
+          vvt, num = self._mesh_to_vvt(mesh)
+        vvts.append(vvt)
+        entities[mesh.name] = {'num': num, 'vbo': None, 'tbo': tbo, 'ibo': None,
+                               'visible': False, 'first': first, 'static': True,
+                               'bbox': self._get_mesh_bbox(mesh)}
+        batch_entity_ids.append(mesh.name)
+        first += num
+      batches.append((tbo, batch_entity_ids))
+      entity_ids += batch_entity_ids
+    if len(vvts) == 0:
+      return entity_ids
+
+    vvt = np.concatenate(vvts)
+    ibo = None
+    if indexed:
+      indices = np.concatenate(indicess)
+      if self._fits_index_type(num_vertices):
+        ibo = self._load_indices_into_gl(indices)
+      else:
+        # Expanding the indexed vertices keeps first and num of every entity.
+        logging.warning('Static scene has too many vertices for %s indices, not indexing it.',
+                        np.dtype(self.index_dtype).name)
+        vvt = np.reshape(np.reshape(vvt, (-1, 5))[indices], (-1))
+    vbo = glGenBuffers(1)
+    glBindBuffer(GL_ARRAY_BUFFER, vbo)
+    glBufferData(GL_ARRAY_BUFFER, vvt.dtype.itemsize*vvt.size, vvt, GL_STATIC_DRAW)
+    assert(glGetError() == GL_NO_ERROR)
+    for entity_id in entity_ids:
+      entities[entity_id]['vbo'] = vbo
+      entities[entity_id]['ibo'] = ibo
+    self.static_batches += [(vbo, ibo, tbo, batch_entity_ids) for tbo, batch_entity_ids in batches]
+    return entity_ids
+
+  def _get_draw_calls(self):
+    """Returns the list of (vbo, uv_vbo, ibo, tbo, first, num, base, model)
+    draw calls needed to draw all visible entities (uv_vbo is None for
+    entities with interleaved positions and uvs in vbo, ibo is None for
+    entities that are not indexed, base is the first vertex and model the flattened model
+    matrix, None for the identity, of pose library humans). Visible entities of the compiled static scene that
+    are adjacent in its vertex buffer are merged into a single draw call.
+    With frustum_culling, entities outside the view frustum of the current
+    camera are skipped."""
+    culled = self._get_culled_entities() if self.frustum_culling else set()
+    draw_calls = []
+    for vbo, ibo, tbo, entity_ids in self.static_batches:
+      first, num = 0, 0
+      for entity_id in entity_ids:
+        entity = self.entities[entity_id]
+        if not entity['visible'] or entity_id in culled:
+          continue
+        if num > 0 and first + num == entity['first']:
+          num += entity['num']
+        else:
+          if num > 0:
+            draw_calls.append((vbo, None, ibo, tbo, first, num, 0, None))
+          first, num = entity['first'], entity['num']
+      if num > 0:
+        draw_calls.append((vbo, None, ibo, tbo, first, num, 0, None))
+
+    for entity_id, entity in self.entities.items():
+      if entity['visible'] and not entity.get('static', False) and entity_id not in culled:
+        draw_calls.append((entity['vbo'], entity.get('uv_vbo', None), entity.get('ibo', None),
+                           entity['tbo'],
+                           entity.get('first', 0), entity['num'], entity.get('base', 0),
+                           entity.get('model', None)))
+    return draw_calls
+
+  def _get_cull_index(self):
+    """Returns the entity ids and the stacked bounding boxes of all entities,
+    rebuilt only after entities have been added, removed or changed."""
+    if self.cull_index is None:
+      entity_ids = list(self.entities.keys())
+      bboxes = np.array([self.entities[x]['bbox'] for x in entity_ids]).reshape((-1, 2, 3))
+      self.cull_index = utils.Foo(entity_ids=entity_ids, bbox_min=bboxes[:,0,:],
+                                  bbox_max=bboxes[:,1,:])
+    return self.cull_index
+
+  def get_frustum_planes(self):
+    """Returns the 6 x 4 planes [a, b, c, d] of the current view frustum,
+    with a*x + b*y + c*z + d >= 0 for points inside the frustum."""
+    view_matrix = np.reshape(self.modelview_matrix, (4, 4)).T
+    projection_matrix = np.reshape(self.projection_matrix, (4, 4)).T
+    m = np.dot(projection_matrix, view_matrix)
+    planes = np.array([m[3] + m[0], m[3] - m[0], m[3] + m[1],
+                       m[3] - m[1], m[3] + m[2], m[3] - m[2]])
+    return planes
+
+  def _get_culled_entities(self):
+    """Returns the set of visible entities whose bounding box lies completely
+    outside the current view frustum and updates the culling statistics."""
+    index = self._get_cull_index()
+    if len(index.entity_ids) == 0:
+      return set()
+    planes = self.get_frustum_planes()
+    # For each plane test the corner of the box furthest along its normal.
+    normals = planes[:, :3]
+    corners = np.where(normals[np.newaxis,:,:] >= 0, index.bbox_max[:,np.newaxis,:],
+                       index.bbox_min[:,np.newaxis,:])
+    dist = np.sum(corners*normals[np.newaxis,:,:], axis=2) + planes[np.newaxis,:,3]
+    outside = np.any(dist < 0, axis=1)
+    visible = np.array([self.entities[x]['visible'] for x in index.entity_ids])
+
+    self.culling_stats['frames'] += 1
+    self.culling_stats['tested'] += int(np.sum(visible))
+    self.culling_stats['culled'] += int(np.sum(np.logical_and(visible, outside)))
+    return set([x for x, o in zip(index.entity_ids, outside) if o])
+
+  def get_culling_stats(self):
+    """Returns the number of frames, tested entities and culled entities since
+    the last reset_culling_stats, and the fraction of entities culled."""
+    stats = dict(self.culling_stats)
+    stats['culled_fraction'] = stats['culled'] / max(1., stats['tested'])
+    return stats
+
+  def reset_culling_stats(self):
+    self.culling_stats = {'frames': 0, 'tested': 0, 'culled': 0}
+
   def set_entity_visible(self, entity_ids, visibility):
     for entity_id in entity_ids:
       self.entities[entity_id]['visible'] = visibility
 
-  def position_camera(self, camera_xyz, lookat_xyz, up):
-    camera_xyz = np.array(camera_xyz)
-    lookat_xyz = np.array(lookat_xyz)
-    up = np.array(up)
-    lookat_to = lookat_xyz - camera_xyz
-    lookat_from = np.array([0, 1., 0.])
-    up_from = np.array([0, 0., 1.])
-    up_to = up * 1.
-    # np.set_printoptions(precision=2, suppress=True)
-    # print up_from, lookat_from, up_to, lookat_to
-    r = rotation_utils.rotate_camera_to_point_at(up_from, lookat_from, up_to, lookat_to)
-    R = np.eye(4, dtype=np.float32)
-    R[:3,:3] = r
-
-    t = np.eye(4, dtype=np.float32)
-    t[:3,3] = -camera_xyz
-
-    view_matrix = np.dot(R.T, t)
-    flip_yz = np.eye(4, dtype=np.float32)
-    flip_yz[1,1] = 0; flip_yz[2,2] = 0; flip_yz[1,2] = 1; flip_yz[2,1] = -1;
-    view_matrix = np.dot(flip_yz, view_matrix)
-    view_matrix = view_matrix.T
-    # print np.concatenate((R, t, view_matrix), axis=1)
-    view_matrix = np.reshape(view_matrix, (-1))
-    
-    if self.egl_program['rgb'] is not None:
-      glUseProgram(self.egl_program['rgb'])
-      view_matrix_o = glGetUniformLocation(self.egl_program['rgb'], 'uViewMatrix')
-      glUniformMatrix4fv(view_matrix_o, 1, GL_FALSE, view_matrix)
+  def get_view_matrix(self, camera_xyz, lookat_xyz, up):
+    """Returns the flattened view matrix (as uploaded to the shaders) for a
+    camera at camera_xyz looking at lookat_xyz."""
+    return self.get_view_matrices(np.reshape(camera_xyz, (1, 3)),
+                                  np.reshape(lookat_xyz, (1, 3)), up)[0]
+
+  def get_view_matrices(self, camera_xyz_n3, lookat_xyz_n3, up):
+    return get_view_matrices(camera_xyz_n3, lookat_xyz_n3, up)
 
-    if self.egl_program['disparity'] is not None:
-      glUseProgram(self.egl_program['disparity'])
-      view_matrix_o = glGetUniformLocation(self.egl_program['disparity'], 'uViewMatrix')
-      glUniformMatrix4fv(view_matrix_o, 1, GL_FALSE, view_matrix)
+  def _set_uniform_matrix(self, name, matrix):
+    for mode in ['rgb', 'disparity']:
+      if self.egl_program[mode] is not None:
+        glUseProgram(self.egl_program[mode])
+        glUniformMatrix4fv(self.egl_uniforms[mode][name], 1, GL_FALSE, matrix)
 
+  def _set_view_matrix(self, view_matrix):
     self.modelview_matrix = view_matrix.astype(np.double)
+    self._set_uniform_matrix('uViewMatrix', view_matrix)
+
+  def position_camera(self, camera_xyz, lookat_xyz, up):
+    view_matrix = self.get_view_matrix(camera_xyz, lookat_xyz, up)
+    self._set_view_matrix(view_matrix)
     return None, None #camera_xyz, q
 
   def clear_scene(self):
+    # Buffers and textures may be shared between entities (compiled static
+    # scene, dedup_tbo), delete each of them only once.
+    vbos, tbos = [], []
     keys = list(self.entities.keys())
     for entity_id in keys:
       entity = self.entities.pop(entity_id, None)
-      vbo = entity['vbo']
-      tbo = entity['tbo']
-      num = entity['num']
+      for buffer in [entity['vbo'], entity.get('uv_vbo', None), entity.get('ibo', None)]:
+        if buffer is not None and buffer not in vbos:
+          vbos.append(buffer)
+      if entity['tbo'] not in tbos:
+        tbos.append(entity['tbo'])
+    for vbo in vbos:
       glDeleteBuffers(1, [vbo])
+    for tbo in tbos:
       glDeleteTextures(1, [tbo])
+    self.static_batches = []
+    self.shared_textures = {}
+    self.cull_index = None
 
-  def remove_human(self):
+  def remove_human(self, human_id=None):
       """
-      Delete the mesh information for the loaded human (vertices, faces, textures)
+      Delete the mesh information (vertices, faces) of human human_id (of all
+      humans if human_id is None). Its texture is deleted once no other
+      human uses it.
       """
-      human_keys = list(filter(lambda x: 'human' in x, self.entities.keys()))
-
-      # Only one human supported currently
-      if len(human_keys) == 1:
-          entity = self.entities.pop(human_keys[0], None)
-          vbo = entity['vbo']
-          tbo = entity['tbo']
-          num = entity['num']
-          glDeleteBuffers(1, [vbo])
-          glDeleteTextures(1, [tbo])
-      else:
-          assert (len(human_keys) == 0)
+      human_keys = self._get_human_keys(human_id)
+      for human_key in human_keys:
+          entity = self.entities.pop(human_key, None)
+          for buffer in [entity['vbo'], entity.get('uv_vbo', None), entity['ibo']]:
+              if buffer is not None:
+                  glDeleteBuffers(1, [buffer])
+          self._release_shared_texture(entity['texture_key'])
+      if len(human_keys) > 0:
+          self.cull_index = None
 
   def __del__(self):
     self.clear_scene()
+    self._delete_tiled_framebuffer()
     eglMakeCurrent(self.egl_display, EGL_NO_SURFACE, EGL_NO_SURFACE, EGL_NO_CONTEXT)
     eglDestroySurface(self.egl_display, self.egl_surface)
     eglTerminate(self.egl_display)
@@ -632,7 +1368,9 @@ def get_r_obj(camera_param):
   r_obj.init_display(width=cp.width, height=cp.height,
     fov_vertical=fov_vertical, fov_horizontal=cp.fov_horizontal,
     z_near=cp.z_near, z_far=cp.z_far,
-    rgb_shader=rgb_shader, d_shader=d_shader, im_resize=cp.im_resize)
+    rgb_shader=rgb_shader, d_shader=d_shader, im_resize=cp.im_resize,
+    frustum_culling=getattr(cp, 'frustum_culling', True),
+    indexed_geometry=getattr(cp, 'indexed_geometry', False))
   r_obj.clear_scene()
   return r_obj
 
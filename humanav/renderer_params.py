@@ -11,6 +11,20 @@ def create_params():
     p.load_meshes = True
     p.load_traversible_from_pickle_file = True
 
+    # Load the building into one vertex buffer with one
+    # draw call per texture (fewer GL state changes per frame)
+    p.compile_static_scene = False
+
+    # Split the building into XY tiles of building_tile_size meters
+    # and only keep the tiles within z_far of the camera loaded
+    p.stream_building_tiles = False
+    p.building_tile_size = 5.0
+
+    # Occupancy of the map cells from points sampled on the building
+    # (and human) faces ('sample') or from the exact area of the faces
+    # over every cell ('exact', deterministic and faster)
+    p.occupancy_mode = 'sample'
+
     p.camera_params = DotMap(modalities=['rgb'],  # rgb or disparity
                              width=64,
                              height=64,
@@ -20,7 +34,9 @@ def create_params():
                              fov_vertical=90.,
                              img_channels=3,
                              im_resize=1.,
-                             max_depth_meters=np.inf)
+                             max_depth_meters=np.inf,
+                             frustum_culling=True, # skip meshes outside the view frustum
+                             indexed_geometry=False) # upload unique vertices + index buffers
 
     # The robot is modeled as a solid cylinder
     # of height, 'height', with radius, 'radius',
@@ -49,7 +65,21 @@ def create_params():
                        body_shapes_train=[519, 1320, 521, 523, 779, 365, 1198, 368],
                        body_shapes_test=[337, 944, 1333, 502, 344, 538, 413],
                        compute_human_traversible=False,
-                       render_humans_in_gray_only=False
+                       render_humans_in_gray_only=False,
+                       # Keep all frames of a human's pose sequence on the GPU
+                       # and move humans by switching frames (fixes the pose
+                       # sequence sampled when the human is added)
+                       gpu_pose_library=False,
+                       # Bounds of the LRU cache of parsed human meshes
+                       # (None for no bound)
+                       human_mesh_cache_entries=None,
+                       human_mesh_cache_bytes=256*1024*1024,
+                       # Bound of the LRU cache of human footprints (the
+                       # space a human mesh occupies, placed on the
+                       # traversible by rotating and stamping it) and how
+                       # much finer than the map their grid is
+                       human_footprint_cache_entries=4096,
+                       human_footprint_supersample=4
                       )
 
     return p
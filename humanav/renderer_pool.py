@@ -0,0 +1,179 @@
+import multiprocessing as mp
+import numpy as np
+import traceback
+
+
+def _worker_loop(params, conn, get_renderer=None):
+    """
+    Entry point of a pool worker. Builds its own HumANavRenderer (and with it
+    its own EGL context and loaded copy of the building) with
+    get_renderer(params), HumANavRenderer.get_renderer by default, and then
+    serves commands sent over conn until it receives 'close'.
+    """
+    try:
+        if get_renderer is None:
+            # Only the workers load the renderer (and OpenGL)
+            from humanav.humanav_renderer import HumANavRenderer
+            get_renderer = HumANavRenderer.get_renderer
+        renderer = get_renderer(params)
+        conn.send(('ok', None))
+    except Exception:
+        conn.send(('error', traceback.format_exc()))
+        conn.close()
+        return
+
+    while True:
+        cmd, args, kwargs = conn.recv()
+        if cmd == 'close':
+            break
+        try:
+            if cmd == 'render_images':
+                out = renderer.render_images(*args, **kwargs)
+            elif cmd == 'call':
+                # Generic method call, args[0] is the method name. Any
+                # RandomState passed in is sent back so that the caller
+                # can advance its own copy.
+                name, args = args[0], args[1:]
+                out = getattr(renderer, name)(*args, **kwargs)
+                rngs = [x for x in list(args) + list(kwargs.values())
+                        if isinstance(x, np.random.RandomState)]
+                out = (out, [rng.get_state() for rng in rngs])
+            else:
+                raise ValueError('Unknown command {:s}'.format(cmd))
+            conn.send(('ok', out))
+        except Exception:
+            conn.send(('error', traceback.format_exc()))
+    conn.close()
+
+
+class RendererPool():
+    """
+    A pool of K worker processes, each with its own HumANavRenderer. Since
+    SwiftShader rendering within one process is effectively single threaded,
+    render_images shards a batch of poses across the workers and gathers the
+    images back in order.
+
+    Workers are started with the 'spawn' start method so that no EGL or
+    OpenGL state is inherited from the parent process. get_renderer (a
+    picklable function of params) replaces HumANavRenderer.get_renderer
+    to build the renderer of every worker.
+    """
+
+    def __init__(self, params, num_workers=None, get_renderer=None):
+        if num_workers is None:
+            num_workers = mp.cpu_count()
+        assert(num_workers > 0)
+        self.p = params
+        self.num_workers = num_workers
+
+        ctx = mp.get_context('spawn')
+        self.conns = []
+        self.processes = []
+        for _ in range(num_workers):
+            parent_conn, child_conn = ctx.Pipe()
+            process = ctx.Process(target=_worker_loop, args=(params, child_conn, get_renderer))
+            process.daemon = True
+            process.start()
+            child_conn.close()
+            self.conns.append(parent_conn)
+            self.processes.append(process)
+
+        # Wait for every worker to finish loading the building
+        try:
+            self._gather(self.conns)
+        except Exception:
+            self.close()
+            raise
+
+    def _gather(self, conns):
+        outs = []
+        errors = []
+        for conn in conns:
+            status, out = conn.recv()
+            if status == 'error':
+                errors.append(out)
+            outs.append(out)
+        if len(errors) > 0:
+            raise RuntimeError('RendererPool worker failed:\n{:s}'.format(errors[0]))
+        return outs
+
+    def render_images(self, starts_n2, thetas_n1, crop_size=None, human_visible=True):
+        """
+        Render the images at starts_n2, thetas_n1 (see
+        HumANavRenderer.render_images), split across the workers. Like
+        HumANavRenderer.render_images, returns None for modalities that are
+        not rendered (disparity).
+        """
+        starts_n2 = np.asarray(starts_n2)
+        thetas_n1 = np.asarray(thetas_n1)
+        chunks = np.array_split(np.arange(len(starts_n2)), self.num_workers)
+
+        conns = []
+        for i, (conn, idx) in enumerate(zip(self.conns, chunks)):
+            # Without poses the first worker still renders the (empty) batch
+            # so that the output has the shape of HumANavRenderer's
+            if len(idx) == 0 and i > 0:
+                continue
+            conn.send(('render_images', (starts_n2[idx], thetas_n1[idx]),
+                       {'crop_size': crop_size, 'human_visible': human_visible}))
+            conns.append(conn)
+        imgs = self._gather(conns)
+        if any([x is None for x in imgs]):
+            return None
+        return np.concatenate(imgs, axis=0)
+
+    def broadcast(self, name, *args, **kwargs):
+        """
+        Calls HumANavRenderer.name(*args, **kwargs) on every worker so that
+        all workers see the same scene (i.e. for adding, moving or removing
+        humans). Every worker receives the same copy of any RandomState
+        argument and so makes the same random choices; the caller's RandomState
+        objects are then advanced to match. Returns the output of the
+        first worker.
+        """
+        for conn in self.conns:
+            conn.send(('call', (name,) + args, kwargs))
+        outs = self._gather(self.conns)
+        out, rng_states = outs[0]
+
+        rngs = [x for x in list(args) + list(kwargs.values())
+                if isinstance(x, np.random.RandomState)]
+        for rng, state in zip(rngs, rng_states):
+            rng.set_state(state)
+        return out
+
+    def add_human_at_position_with_speed(self, *args, **kwargs):
+        return self.broadcast('add_human_at_position_with_speed', *args, **kwargs)
+
+    def add_human_with_known_identity_at_position_with_speed(self, *args, **kwargs):
+        return self.broadcast('add_human_with_known_identity_at_position_with_speed', *args, **kwargs)
+
+    def move_human_to_position_with_speed(self, *args, **kwargs):
+        return self.broadcast('move_human_to_position_with_speed', *args, **kwargs)
+
+    def move_humans(self, *args, **kwargs):
+        return self.broadcast('move_humans', *args, **kwargs)
+
+    def remove_human(self, *args, **kwargs):
+        return self.broadcast('remove_human', *args, **kwargs)
+
+    def close(self):
+        for conn in self.conns:
+            try:
+                conn.send(('close', (), {}))
+            except (BrokenPipeError, EOFError, OSError):
+                pass
+        for process in self.processes:
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
+        for conn in self.conns:
+            conn.close()
+        self.conns = []
+        self.processes = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
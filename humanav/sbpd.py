@@ -26,10 +26,16 @@ if sys.version_info[0] == 2:
     from render import swiftshader_renderer as renderer
     import utils
     import mp_env
+    import building_cache
+    import human_manifest
+    import human_pack
 else:
     from humanav.render import swiftshader_renderer as renderer 
     from humanav import utils
     from humanav import mp_env
+    from humanav import building_cache
+    from humanav import human_manifest
+    from humanav import human_pack
 
 def get_dataset(dataset_name, imset, data_dir, surreal_params):
   if dataset_name == 'sbpd':
@@ -51,78 +57,227 @@ class Loader():
     out['data_dir'] = data_dir
     return out
 
-  def load_building_meshes(self, building, materials_scale=1.0):
+  def get_building_mesh_file(self, building):
+    """Returns the obj file of building, None if there is none."""
     dir_name = os.path.join(building['data_dir'], 'mesh', building['name'])
-    mesh_file_name = glob.glob1(dir_name, '*.obj')[0]
-    mesh_file_name_full = os.path.join(dir_name, mesh_file_name)
+    mesh_file_names = glob.glob1(dir_name, '*.obj')
+    if len(mesh_file_names) == 0:
+      return None
+    return os.path.join(dir_name, mesh_file_names[0])
+
+  def load_building_meshes(self, building, materials_scale=1.0, flip=False, use_cache=True,
+                           tile_size=None):
+    """Returns the (flipped if flip) shapes of building. They are loaded from
+    the building cache (see building_cache.py) if it exists, else from the
+    obj file. With tile_size the building is returned as XY tiles of
+    tile_size meters (see building_cache.split_into_tiles)."""
+    if use_cache:
+      cache_dir = building_cache.get_cache_dir(building, materials_scale, flip, tile_size)
+      shapess = building_cache.load_building_cache(cache_dir, materials_scale, flip, tile_size)
+      if shapess is not None:
+        logging.error('Loading building from cache: %s', cache_dir)
+        return shapess
+
+    if tile_size is not None:
+      logging.error('Splitting building into tiles of %.2fm.', tile_size)
+      shapess = self.load_building_meshes(building, materials_scale, flip, use_cache)
+      return building_cache.split_into_tiles(shapess, tile_size)
+
+    mesh_file_name_full = self.get_building_mesh_file(building)
+    assert mesh_file_name_full is not None, 'No mesh file for building {:s}.'.format(building['name'])
     logging.error('Loading building from obj file: %s', mesh_file_name_full)
+    # Textures are decoded in parallel while the renderer uploads them
     shape = renderer.Shape(mesh_file_name_full, load_materials=True, 
-      name_prefix=building['name']+'_',  materials_scale=materials_scale)
+      name_prefix=building['name']+'_',  materials_scale=materials_scale,
+      defer_materials=True)
+    if flip:
+      shape.flip_shape()
     return [shape]
 
-  def load_data(self, name, robot, flip=False):
+  def load_data(self, name, robot, flip=False, tile_size=None, occupancy_mode='sample'):
     env = utils.Foo(padding=10, resolution=5, num_point_threshold=2,
-      valid_min=-10, valid_max=200, n_samples_per_face=200)
-    building = mp_env.Building(self, name, robot, env, flip=flip)
+      valid_min=-10, valid_max=200, n_samples_per_face=200,
+      max_sample_bytes=None, occupancy_mode=occupancy_mode)
+    building = mp_env.Building(self, name, robot, env, flip=flip, tile_size=tile_size)
     return building
 
-  def load_random_human(self, speed, gender, human_materials, body_shape, rng):
+  def load_random_human(self, speed, gender, human_materials, body_shape, rng, human_id=0):
       """
       Load a human mesh of random pose, shape, gender
       and compute the corresponding center of this human
       mesh. Assumes the human mesh data is stored in this fasion:
           surreal_dir/pose_dir/body_shape_dir/gender/human_mesh_{:d}.obj
+      The meshes are named after human_id.
       """
 
+      human_mesh_info, human_pos_3 = self.sample_random_human(speed, gender, body_shape, rng)
+      shapess, center_pos_3 = self.load_human_mesh(human_materials=human_materials, human_id=human_id,
+                                                   human_pos_3=human_pos_3, **human_mesh_info)
+      return shapess, center_pos_3, human_mesh_info
+
+  def sample_random_human(self, speed, gender, body_shape, rng):
+      """
+      Sample the mesh directory and frame of a human of random
+      pose (see load_random_human) without loading its mesh.
+      Returns the human_mesh_info and the centering info of the
+      frame (None if it is not in the manifest).
+      """
+
+      # The directory structure is looked up in the human manifest.
+      # Random choices are made over the same sorted lists as when
+      # they were listed from disk, so rng draws the same samples.
+      manifest = self.get_human_manifest()
+
       # Find the closest velocity bin
-      velocity_dirs = [x for x in os.listdir(self.surreal_params.data_dir) if os.path.isdir(os.path.join(self.surreal_params.data_dir, x))]
-      velocities_float = [float(velocity_str.split('velocity_')[1].split('_m_s')[0]) for velocity_str in velocity_dirs]
-      idx = np.argmin(np.abs(np.array(velocities_float)-speed))
-      velocity_dir = os.path.join(self.surreal_params.data_dir, velocity_dirs[idx])
+      idx = manifest.get_closest_velocity(speed)
+      velocity_dir = os.path.join(self.surreal_params.data_dir, manifest.velocity_dirs[idx])
 
       # Sample A Random Pose
-      poses = [x for x in os.listdir(velocity_dir) if not x.startswith('.')]
-      poses.sort()
-      pose = rng.choice(poses)
-      pose_dir = os.path.join(velocity_dir, pose)
+      poses = manifest.get_poses(idx)
+      pose_idx = poses[rng.choice(len(poses))]
+      pose_dir = os.path.join(velocity_dir, manifest.pose_names[pose_idx])
 
       # Choose the Body Shape Directory
       body_shape_dir = os.path.join(pose_dir, 'body_shape_{:d}'.format(body_shape))
-      assert os.path.isdir(body_shape_dir)
 
       # Sample Gender
       gender_dir = os.path.join(body_shape_dir, gender)
-      assert os.path.isdir(gender_dir)
 
       # Sample a frame number
-      frames = os.listdir(gender_dir)
-      frames = list(filter(lambda x: 'obj' in x, frames))
-      frame_numbers = [int(x.strip('.obj').split('_')[-1]) for x in frames]
-      frame_numbers.sort()
-      frame = rng.choice(frame_numbers)
+      frame_numbers, centering_n3 = manifest.get_frames(pose_idx, body_shape, gender)
+      frame_idx = rng.choice(len(frame_numbers))
+      frame = frame_numbers[frame_idx]
 
       human_mesh_info = {'mesh_dir': gender_dir, 'frame': frame, 'gender': gender}
-      shapess, center_pos_3 = self.load_human_mesh(human_materials=human_materials, **human_mesh_info)
-      return shapess, center_pos_3, human_mesh_info
+      human_pos_3 = centering_n3[frame_idx]
+      if np.any(np.isnan(human_pos_3)):
+          human_pos_3 = None
+      return human_mesh_info, human_pos_3
+
+  def load_human_sequence(self, human_materials, mesh_dir, gender, human_id=0):
+      """
+      Loads all frames of the pose sequence in mesh_dir (from the
+      packed sequence if there is one). All frames share the faces
+      and texture coordinates of the first frame. Returns a dict
+      with the frame numbers, the frames x V x 3 vertices, the
+      centering info of every frame, the faces, uvs and mesh name.
+      """
+      packed_human_loader = self.get_packed_human_loader()
+      name = 'human_{:d}_'.format(human_id)
+      if packed_human_loader.is_packed(mesh_dir):
+          frames, vertices, centering, faces, uvs, mesh_name = packed_human_loader.load_sequence(mesh_dir)
+          return {'frames': frames, 'vertices': vertices, 'centering': centering,
+                  'faces': faces, 'uvs': uvs, 'name': name + mesh_name + '_{:05d}'.format(0)}
 
-  def load_human_mesh(self, human_materials, mesh_dir, frame, gender):
+      frame_files = list(filter(lambda x: 'obj' in x, os.listdir(mesh_dir)))
+      frames = [int(x.strip('.obj').split('_')[-1]) for x in frame_files]
+      frames.sort()
+      vertices, centering = [], []
+      for frame in frames:
+          shapess, human_pos_3 = self.load_human_mesh(human_materials, mesh_dir, frame, gender,
+                                                      human_id=human_id)
+          mesh = shapess[0].meshes[0]
+          if len(vertices) == 0:
+              faces, uvs, mesh_name = mesh.faces*1, mesh.texturecoords[0,:,:2]*1, mesh.name
+          assert np.array_equal(faces, mesh.faces), \
+              'Frame {:d} of {:s} does not share the faces of the sequence.'.format(frame, mesh_dir)
+          vertices.append(np.array(mesh.vertices, dtype=np.float32))
+          centering.append(np.reshape(human_pos_3, (3)))
+      return {'frames': np.array(frames), 'vertices': np.stack(vertices, axis=0),
+              'centering': np.array(centering), 'faces': faces, 'uvs': uvs, 'name': mesh_name}
+
+  def get_human_manifest(self):
+      """
+      Returns the manifest of the human meshes and textures,
+      loaded (or built) on first use.
+      """
+      if getattr(self, 'human_manifest', None) is None:
+          self.human_manifest = human_manifest.get_human_manifest(self.surreal_params.data_dir,
+                                                                  self.surreal_params.texture_dir)
+      return self.human_manifest
+
+  def get_packed_human_loader(self):
+      if getattr(self, 'packed_human_loader', None) is None:
+          self.packed_human_loader = human_pack.PackedHumanLoader()
+      return self.packed_human_loader
+
+  def get_human_mesh_cache(self):
+      """
+      Returns the LRU cache of parsed human meshes and their
+      centering info, keyed by mesh directory and frame and
+      bounded by surreal_params.human_mesh_cache_entries and
+      human_mesh_cache_bytes. Its hit and miss counters are
+      returned by its get_stats.
+      """
+      if getattr(self, 'human_mesh_cache', None) is None:
+          p = self.surreal_params
+          self.human_mesh_cache = utils.LRUCache(max_entries=p.human_mesh_cache_entries,
+                                                 max_bytes=p.human_mesh_cache_bytes,
+                                                 size_fn=_get_human_mesh_nbytes)
+      return self.human_mesh_cache
+
+  def load_human_mesh(self, human_materials, mesh_dir, frame, gender, human_id=0, human_pos_3=None):
       """
       Loads the human mesh named human_mesh_{:d}.obj
-      in mesh_dir
+      in mesh_dir, from the packed sequence of mesh_dir
+      (see human_pack.py) if there is one. If human_pos_3
+      (its centering info) is given it is not read from disk.
+      Parsed meshes are served from the human mesh cache,
+      the cached arrays are read only and the vertices
+      are copied on every load as callers modify them.
+      """
+      cache = self.get_human_mesh_cache()
+      key = (mesh_dir, int(frame))
+      entry = cache.get(key)
+      if entry is None:
+          entry = self._parse_human_mesh(mesh_dir, frame, human_pos_3)
+          cache.put(key, entry)
+      meshes, cached_pos_3 = entry
+
+      name_prefix = 'human_{:d}_'.format(human_id)
+      meshes = [renderer.ArrayShape.make_mesh(name_prefix + name, vertices*1, faces, uvs)
+                for name, vertices, faces, uvs in meshes]
+      if human_pos_3 is None:
+          human_pos_3 = cached_pos_3*1
+      return [renderer.ArrayShape(meshes, human_materials)], human_pos_3
+
+  def _parse_human_mesh(self, mesh_dir, frame, human_pos_3=None):
+      """
+      Returns the (name, vertices, faces, uvs) of every mesh of
+      human_mesh_{:d}.obj in mesh_dir (as read only arrays) and
+      its centering info.
       """
-      # Load the Human Mesh
-      mesh_file = os.path.join(mesh_dir, 'human_mesh_{:d}.obj'.format(frame))
-      human = renderer.HumanShape(mesh_file, human_materials, name_prefix='human')
+      packed_human_loader = self.get_packed_human_loader()
+      if packed_human_loader.is_packed(mesh_dir):
+          human, centering = packed_human_loader.load_frame(mesh_dir, frame, None)
+      else:
+          # Load the Human Mesh
+          mesh_file = os.path.join(mesh_dir, 'human_mesh_{:d}.obj'.format(frame))
+          human = renderer.HumanShape(mesh_file, None)
+
+          # Load data which tells us the approximate (x, y, theta) configuration
+          # of the human. This is computed as the centerpoint between the humans two
+          # feet assuming they are pointing halfway between the direction of each foot
+          centering = human_pos_3
+          if centering is None:
+              centering_file = os.path.join(mesh_dir, 'human_centering_info_{:d}.pkl'.format(frame))
+              with open(centering_file, 'rb') as f:
+                  centering_data = pickle.load(f)
+              centering = centering_data['human_pos_3']
 
-      # Load data which tells us the approximate (x, y, theta) configuration
-      # of the human. This is computed as the centerpoint between the humans two
-      # feet assuming they are pointing halfway between the direction of each foot
-      centering_file = os.path.join(mesh_dir, 'human_centering_info_{:d}.pkl'.format(frame))
-      with open(centering_file, 'rb') as f:
-          centering_data = pickle.load(f)
-      human_pos_3 = centering_data['human_pos_3']
+      meshes = []
+      for m in human.meshes:
+          arrays = [np.array(m.vertices), np.array(m.faces), np.array(m.texturecoords[0,:,:2])]
+          for a in arrays:
+              a.setflags(write=False)
+          meshes.append(tuple([m.name] + arrays))
+      centering = np.array(np.reshape(centering, (3)), dtype=np.float64)
+      centering.setflags(write=False)
+      return meshes, centering
 
-      return [human], human_pos_3
+def _get_human_mesh_nbytes(entry):
+  meshes, centering = entry
+  return sum([v.nbytes + f.nbytes + t.nbytes for _, v, f, t in meshes]) + centering.nbytes
 
 class StanfordBuildingParserDataset(Loader):
   def __init__(self, imset, data_dir=None, surreal_params=None):
@@ -130,6 +285,8 @@ class StanfordBuildingParserDataset(Loader):
     self.data_dir = data_dir
 
     self.surreal_params = surreal_params
+    self.human_manifest = None
+    self.human_mesh_cache = None
     
   def get_data_dir(self):
     return self.data_dir
@@ -173,9 +330,11 @@ class StanfordBuildingParserDataset(Loader):
         gender = rng.choice(genders)
 
         # Sample a random set of materials for the human (i.e. skin/hair color, clothing, etc.)
+        file_names = self.get_human_manifest().get_texture_files(self.surreal_params.mode, gender)
         human_materials = renderer.HumanShape.get_random_materials(self.surreal_params.texture_dir,
                                                                    self.surreal_params.mode,
-                                                                   gender, rng, load_materials=load_materials)
+                                                                   gender, rng, load_materials=load_materials,
+                                                                   file_names=file_names)
 
         # Sample a random body shape
         if self.surreal_params.mode == 'train':
@@ -0,0 +1,75 @@
+r"""Streams the XY tiles of a building (see building_cache.split_into_tiles)
+in and out of the renderer, so that only the tiles near the camera use GPU
+memory. Tiles within load_radius of a recent camera position are loaded,
+tiles further than unload_radius (> load_radius, the hysteresis that keeps
+tiles on the boundary from being reloaded every frame) from all recent
+camera positions are removed.
+"""
+import collections, logging
+import numpy as np
+
+class TileStreamer():
+  def __init__(self, r_obj, tile_shapess, tile_size, load_radius, unload_radius=None,
+               history=1):
+    """tile_shapess are the tiles of the building, each with its (i, j) tile
+    index as attribute tile. The last history calls to update count as
+    recent camera positions."""
+    if unload_radius is None:
+      unload_radius = load_radius + tile_size
+    assert(unload_radius >= load_radius)
+    self.r_obj = r_obj
+    self.tile_size = tile_size
+    self.load_radius = load_radius
+    self.unload_radius = unload_radius
+    self.tiles = collections.OrderedDict([(shapes.tile, shapes) for shapes in tile_shapess])
+    self.tile_keys = list(self.tiles.keys())
+    self.tile_min_xy = np.array(self.tile_keys, dtype=np.float64).reshape((-1, 2))*tile_size
+    self.resident = collections.OrderedDict()
+    self.recent = collections.deque(maxlen=history)
+    self.visible = False
+    self.num_loads = 0
+    self.num_unloads = 0
+
+  def _get_distances(self, xy_n2):
+    """Returns the distance of every tile (its square) to the closest of
+    the points xy_n2."""
+    d = np.maximum(self.tile_min_xy[:,np.newaxis,:] - xy_n2[np.newaxis,:,:],
+                   xy_n2[np.newaxis,:,:] - (self.tile_min_xy[:,np.newaxis,:] + self.tile_size))
+    d = np.sqrt(np.sum(np.maximum(d, 0.)**2, axis=2))
+    return np.min(d, axis=1)
+
+  def update(self, camera_xy_n2):
+    """Makes the tiles around the cameras at camera_xy_n2 (in meters, in the
+    frame of the meshes) resident. Returns the loaded and removed tiles."""
+    self.recent.append(np.reshape(camera_xy_n2, (-1, 2)))
+    distances = self._get_distances(np.concatenate(list(self.recent), axis=0))
+    loaded, removed = [], []
+    for key, distance in zip(self.tile_keys, distances):
+      if key in self.resident and distance > self.unload_radius:
+        self.r_obj.remove_entities(self.resident.pop(key))
+        removed.append(key)
+      elif key not in self.resident and distance <= self.load_radius:
+        entity_ids = self.r_obj.load_shapes([self.tiles[key]], dedup_tbo=True,
+                                            shared_textures=True)
+        self.r_obj.set_entity_visible(entity_ids, self.visible)
+        self.resident[key] = entity_ids
+        loaded.append(key)
+    self.num_loads += len(loaded)
+    self.num_unloads += len(removed)
+    if len(loaded) > 0 or len(removed) > 0:
+      logging.info('Tiles: %d loaded, %d removed, %d resident.', len(loaded), len(removed),
+                   len(self.resident))
+    return loaded, removed
+
+  def set_visible(self, visibility):
+    self.visible = visibility
+    self.r_obj.set_entity_visible(self.get_entity_ids(), visibility)
+
+  def get_entity_ids(self):
+    return [x for entity_ids in self.resident.values() for x in entity_ids]
+
+  def clear(self):
+    """Removes all resident tiles from the renderer."""
+    for key in list(self.resident.keys()):
+      self.r_obj.remove_entities(self.resident.pop(key))
+    self.recent.clear()
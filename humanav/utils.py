@@ -17,7 +17,7 @@ r"""Generaly Utilities.
 """
 
 import numpy as np, os, time
-import logging, hashlib
+import logging, hashlib, collections
 from contextlib import contextmanager
 
 def mkdir_if_missing(dirname):
@@ -97,6 +97,64 @@ class Foo(object):
       str_ += '\n'
     return str_
 
+class LRUCache():
+  """Least recently used cache bounded by the number of entries
+  (max_entries) and / or the total size of the entries in bytes (max_bytes,
+  as returned by size_fn). A bound of None is no bound. Entries larger than
+  max_bytes are not cached. Counts hits and misses of get."""
+  def __init__(self, max_entries=None, max_bytes=None, size_fn=None):
+    self.max_entries = max_entries
+    self.max_bytes = max_bytes
+    self.size_fn = size_fn
+    self.entries = collections.OrderedDict()
+    self.num_bytes = 0
+    self.hits = 0
+    self.misses = 0
+
+  def _get_size(self, value):
+    return 0 if self.size_fn is None else self.size_fn(value)
+
+  def get(self, key, default=None):
+    if key not in self.entries:
+      self.misses += 1
+      return default
+    self.hits += 1
+    value, size = self.entries.pop(key)
+    self.entries[key] = (value, size)
+    return value
+
+  def put(self, key, value):
+    if key in self.entries:
+      _, size = self.entries.pop(key)
+      self.num_bytes -= size
+    size = self._get_size(value)
+    if ((self.max_entries is not None and self.max_entries <= 0) or
+        (self.max_bytes is not None and size > self.max_bytes)):
+      return
+    self.entries[key] = (value, size)
+    self.num_bytes += size
+    while ((self.max_entries is not None and len(self.entries) > self.max_entries) or
+           (self.max_bytes is not None and self.num_bytes > self.max_bytes)):
+      _, (_, size) = self.entries.popitem(last=False)
+      self.num_bytes -= size
+
+  def __contains__(self, key):
+    return key in self.entries
+
+  def __len__(self):
+    return len(self.entries)
+
+  def clear(self):
+    self.entries.clear()
+    self.num_bytes = 0
+
+  def get_stats(self):
+    """Returns the number of hits, misses, entries and bytes and the hit
+    rate."""
+    return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries),
+            'bytes': self.num_bytes,
+            'hit_rate': self.hits / max(1., self.hits + self.misses)}
+
 class TicTocPrint():
   def __init__(self, interval):
     self.interval = interval
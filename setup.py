@@ -8,5 +8,8 @@ setup(name='humanav',
   description='Human Active Navigation Dataset',
   packages=find_packages(),
   license='UC Berkeley',
-  install_requires=[]
+  install_requires=[],
+  entry_points={
+    'console_scripts': ['humanav-build-cache=humanav.building_cache:main'],
+  }
 )
@@ -0,0 +1,43 @@
+from humanav import renderer_params, sbpd
+from humanav.humanav_renderer import HumANavRenderer
+
+
+class _StubBuilding():
+    """Records the flips of the building, without meshes or a map."""
+
+    def __init__(self, flip):
+        self.flips = [flip]
+        self.humans = {}
+
+    def set_flip(self, flip):
+        self.flips.append(flip)
+
+
+class _StubDataset():
+    def load_data(self, name, robot, flip=False, tile_size=None, occupancy_mode='sample'):
+        return _StubBuilding(flip)
+
+
+def test_get_renderer_switches_flip(monkeypatch):
+    monkeypatch.setattr(sbpd, 'get_dataset', lambda *args, **kwargs: _StubDataset())
+    monkeypatch.setattr(HumANavRenderer, 'renderer', None)
+    monkeypatch.setattr(HumANavRenderer, 'remove_human', lambda self, human_id=None: None)
+    p = renderer_params.create_params()
+    p.camera_params.modalities = ['occupancy_grid']
+
+    r = HumANavRenderer.get_renderer(p)
+    assert r.building.flips == [False]
+
+    # The caller's params are the renderer's params, changing them must
+    # still flip the loaded building
+    p.flip = True
+    assert HumANavRenderer.get_renderer(p) is r
+    assert r.building.flips == [False, True]
+    assert p.flip
+
+    assert HumANavRenderer.get_renderer(p) is r
+    assert r.building.flips == [False, True]
+
+    p.flip = False
+    HumANavRenderer.get_renderer(p)
+    assert r.building.flips == [False, True, False]
@@ -0,0 +1,80 @@
+import numpy as np
+from humanav import map_utils as mu
+from humanav.render import swiftshader_renderer as sr
+
+
+def _get_poses(rng, n, map_shape):
+    # Some crops partly or fully outside the map
+    starts_n2 = rng.rand(n, 2)*np.array([map_shape[1], map_shape[0]])*1.2 - 10
+    thetas_n1 = rng.rand(n, 1)*2*np.pi
+    x_axis_n2 = np.concatenate([np.cos(thetas_n1), np.sin(thetas_n1)], axis=1)
+    y_axis_n2 = -np.concatenate([np.cos(thetas_n1 + np.pi/2.), np.sin(thetas_n1 + np.pi/2.)], axis=1)
+    return starts_n2, x_axis_n2, y_axis_n2
+
+
+def _check_batched_crops(map, n, crop_size, **kwargs):
+    rng = np.random.RandomState(0)
+    starts_n2, x_axis_n2, y_axis_n2 = _get_poses(rng, n, map.shape)
+    crops = mu.generate_egocentric_maps([map], [1.0], [crop_size], starts_n2, x_axis_n2,
+                                        y_axis_n2, **kwargs)[0]
+    batched_crops = mu.generate_egocentric_maps([map], [1.0], [crop_size], starts_n2, x_axis_n2,
+                                                y_axis_n2, batched=True, **kwargs)[0]
+    assert batched_crops.dtype == crops.dtype
+    np.testing.assert_array_equal(batched_crops, crops)
+
+
+def test_batched_crops_match_warp_affine():
+    rng = np.random.RandomState(1)
+    _check_batched_crops(rng.rand(90, 120), 50, 16)
+
+
+def test_batched_topview_crops_match_warp_affine():
+    # As in HumANavRenderer._get_topview, more crops than CROP_CHUNK_SIZE
+    rng = np.random.RandomState(2)
+    traversible = rng.rand(150, 200) > 0.3
+    _check_batched_crops(traversible*1., mu.CROP_CHUNK_SIZE + 30, 32, dst_theta=0.,
+                         dst_loc=np.array([0, 15.5]))
+
+
+def test_batched_crops_without_poses():
+    crops = mu.get_map_to_predict_batched(np.zeros((0, 2)), np.zeros((0, 2)), np.zeros((0, 2)),
+                                          np.ones((10, 10)), 8, dst_theta=0.)
+    assert crops.shape == (0, 8, 8)
+
+
+def _get_room_shapes():
+    # A floor split into a grid of faces and a box standing on it, in meters.
+    xs, ys = np.meshgrid(np.linspace(0., 4., 9), np.linspace(0., 3., 7))
+    floor_vertices = np.stack([xs.ravel(), ys.ravel(), np.zeros(xs.size)], axis=1)
+    k = np.arange(xs.size).reshape(xs.shape)[:-1, :-1].ravel()
+    floor_faces = np.concatenate([np.stack([k, k+1, k+10], axis=1),
+                                  np.stack([k, k+10, k+9], axis=1)], axis=0)
+    box_vertices = np.array([[x, y, z] for z in [0., 1.] for y in [1., 1.5] for x in [1.5, 2.]])
+    box_faces = np.array([[0, 1, 5], [0, 5, 4], [1, 3, 7], [1, 7, 5], [3, 2, 6], [3, 6, 7],
+                          [2, 0, 4], [2, 4, 6], [4, 5, 7], [4, 7, 6]])
+    meshes = [sr.ArrayShape.make_mesh(name, v, f.astype(np.int32), np.zeros((v.shape[0], 2)))
+              for name, v, f in [('floor', floor_vertices, floor_faces),
+                                 ('box', box_vertices, box_faces)]]
+    return [sr.ArrayShape(meshes, [None, None])]
+
+
+def _compute_room_traversibility(**kwargs):
+    shapess = _get_room_shapes()
+    vertices = np.concatenate([s.get_vertices()[0] for s in shapess], axis=0)
+    map = mu.make_map(10, 5, vertex=vertices, sc=100.)
+    return mu.compute_traversibility(map, 10, 100, 18, -10, 200, 2, shapess, sc=100.,
+                                     n_samples_per_face=50, **kwargs)
+
+
+def test_traversibility_does_not_depend_on_chunks_or_threads():
+    for occupancy_mode in mu.OCCUPANCY_MODES:
+        map = _compute_room_traversibility(occupancy_mode=occupancy_mode)
+        assert np.any(map.traversible) and not np.all(map.traversible)
+        for max_sample_bytes in [None, 1]:
+            for num_threads in [1, 2, 4]:
+                map_ = _compute_room_traversibility(occupancy_mode=occupancy_mode,
+                                                    max_sample_bytes=max_sample_bytes,
+                                                    num_threads=num_threads)
+                np.testing.assert_array_equal(map_.num_points, map.num_points)
+                np.testing.assert_array_equal(map_.num_obstcale_points, map.num_obstcale_points)
+                np.testing.assert_array_equal(map_.traversible, map.traversible)
@@ -0,0 +1,95 @@
+import numpy as np
+from humanav import map_postprocess, map_utils as mu, utils
+from humanav.mp_env import Building
+
+NUM_POINT_THRESHOLD = 2
+ROBOT_RADIUS = 18
+
+
+class _StubRenderer():
+    def remove_human(self, human_id):
+        pass
+
+
+def _get_footprint():
+    # An ellipse (in cm, in the ego frame of the human), so that its
+    # orientation matters
+    xy = np.stack(np.meshgrid(np.arange(-40., 41., 2.5), np.arange(-20., 21., 2.5)),
+                  axis=2).reshape(-1, 2)
+    xy = xy[np.sum((xy / [40., 20.])**2, axis=1) <= 1.]
+    return utils.Foo(xy=xy, wt=np.ones(xy.shape[0]), radius=0.4)
+
+
+def _get_building(rng):
+    map = utils.Foo(origin=np.array([-50., -50.]), size=np.array([60, 40]), resolution=5)
+    map._traversible = (rng.rand(map.size[1], map.size[0]) > 0.05)*1.
+    map.traversible = map._traversible > 0
+    map._human_traversible = np.ones_like(map._traversible)
+    building = Building.__new__(Building)
+    building.map = map
+    building.env = utils.Foo(num_point_threshold=NUM_POINT_THRESHOLD)
+    building.robot = utils.Foo(radius=ROBOT_RADIUS)
+    building.r_obj = _StubRenderer()
+    building.renderer_entitiy_ids = []
+    building.humans = {}
+    building.traversible_windows = []
+    return building
+
+
+def _set_human(building, human_id, pos_3):
+    # As Building._load_human and Building._move_human, without the meshes
+    dataset = utils.Foo(surreal_params=utils.Foo(compute_human_traversible=True))
+    building._set_human(dataset, human_id, np.array(pos_3), 0., 'male', [], None, [None],
+                        None, None, [])
+    building._update_human_traversible()
+
+
+def _get_obstacle_free(map, footprint, pos_3):
+    # The space occupied by the human over the whole map
+    c, s = np.cos(pos_3[2]), np.sin(pos_3[2])
+    xy = footprint.xy.dot(np.array([[c, s], [-s, c]])) + (map.origin/100. + pos_3[:2])*100.
+    vertex_ = np.round((xy - map.origin) / map.resolution).astype(np.int64)
+    inside = np.all(np.logical_and(vertex_ >= 0, vertex_ < map.size), axis=1)
+    num_obstcale_points = np.bincount(vertex_[inside, 1]*map.size[0] + vertex_[inside, 0],
+                                      weights=footprint.wt[inside],
+                                      minlength=map.size[0]*map.size[1])
+    num_obstcale_points = num_obstcale_points.reshape(map.size[1], map.size[0])
+    return map_postprocess.dilate_disk(
+        map_postprocess.fill_holes(num_obstcale_points > NUM_POINT_THRESHOLD, 20),
+        ROBOT_RADIUS / map.resolution) != True
+
+
+def _check_traversible(building, footprint):
+    map = building.map
+    human_traversible = np.ones((map.size[1], map.size[0]), dtype=bool)
+    for human in building.humans.values():
+        human_traversible &= _get_obstacle_free(map, footprint, human['pos_3'])
+    np.testing.assert_array_equal(map._human_traversible, human_traversible)
+    np.testing.assert_array_equal(map.traversible,
+                                  np.logical_and(map._traversible > 0, human_traversible))
+    assert building.traversible is map.traversible
+
+
+def test_human_traversible_matches_full_map(monkeypatch):
+    footprint = _get_footprint()
+    monkeypatch.setattr(Building, '_get_human_footprint', lambda self, *args: footprint)
+    building = _get_building(np.random.RandomState(0))
+
+    # Two overlapping humans over the bottom left corner of the map
+    _set_human(building, 0, [0.1, 0.2, 0.])
+    _check_traversible(building, footprint)
+    _set_human(building, 1, [0.4, 0.1, 1.])
+    _check_traversible(building, footprint)
+    assert not np.all(building.map._human_traversible[:, 0])
+
+    # Move the first one over the top edge, and back over the second one
+    _set_human(building, 0, [1.2, 1.9, 0.5])
+    _check_traversible(building, footprint)
+    _set_human(building, 0, [0.5, 0.3, 2.])
+    _check_traversible(building, footprint)
+
+    building.remove_human(1)
+    _check_traversible(building, footprint)
+    building.remove_human(0)
+    _check_traversible(building, footprint)
+    np.testing.assert_array_equal(building.map.traversible, building.map._traversible > 0)
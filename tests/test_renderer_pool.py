@@ -0,0 +1,48 @@
+import numpy as np
+from humanav.renderer_pool import RendererPool
+
+
+class _StubRenderer():
+    """Stands in for HumANavRenderer: renders every pose as a 2 x 2 image
+    filled with its x coordinate, or nothing for the disparity modality."""
+
+    def __init__(self, modality):
+        self.modality = modality
+
+    def render_images(self, starts_n2, thetas_n1, crop_size=None, human_visible=True):
+        if self.modality == 'disparity':
+            return
+        return np.ones((len(starts_n2), 2, 2, 1))*starts_n2[:, :1, None, None]
+
+    def sample(self, rng):
+        return rng.randint(1000)
+
+
+def _get_stub_renderer(modality):
+    return _StubRenderer(modality)
+
+
+def test_render_images_keeps_pose_order():
+    with RendererPool('occupancy_grid', num_workers=3, get_renderer=_get_stub_renderer) as pool:
+        starts_n2 = np.stack([np.arange(7.), np.zeros(7)], axis=1)
+        imgs = pool.render_images(starts_n2, np.zeros((7, 1)))
+        assert imgs.shape == (7, 2, 2, 1)
+        assert np.array_equal(imgs[:, 0, 0, 0], np.arange(7.))
+
+        # Fewer poses than workers, and no poses at all
+        imgs = pool.render_images(starts_n2[:2], np.zeros((2, 1)))
+        assert np.array_equal(imgs[:, 0, 0, 0], np.arange(2.))
+        imgs = pool.render_images(np.zeros((0, 2)), np.zeros((0, 1)))
+        assert imgs.shape == (0, 2, 2, 1)
+
+
+def test_render_images_without_images():
+    with RendererPool('disparity', num_workers=2, get_renderer=_get_stub_renderer) as pool:
+        assert pool.render_images(np.zeros((3, 2)), np.zeros((3, 1))) is None
+
+
+def test_broadcast_advances_rng():
+    with RendererPool('occupancy_grid', num_workers=2, get_renderer=_get_stub_renderer) as pool:
+        rng, expected_rng = np.random.RandomState(0), np.random.RandomState(0)
+        assert pool.broadcast('sample', rng) == expected_rng.randint(1000)
+        assert rng.randint(1000) == expected_rng.randint(1000)
@@ -0,0 +1,62 @@
+import numpy as np
+from humanav.render import swiftshader_renderer as sr
+
+# Bounding boxes [min_xyz, max_xyz] around a camera at CAMERA_XYZ looking
+# along x, with a horizontal field of view of 90 degrees (the visible y - 1
+# is within +-x) and a vertical one of 60 degrees.
+CAMERA_XYZ = [0., 1., 1.]
+BBOXES = {'inside': [[3., 0.5, 0.5], [4., 1.5, 1.5]],
+          'straddling': [[3., 3.5, 0.5], [4., 6., 1.5]],
+          'outside': [[3., 6., 0.5], [4., 7., 1.5]],
+          'below': [[3., 0.5, -4.], [4., 1.5, -3.]],
+          'behind': [[-3., 0.5, 0.5], [-2., 1.5, 1.5]],
+          'beyond_z_far': [[30., 0.5, 0.5], [31., 1.5, 1.5]]}
+CULLED = set(['outside', 'below', 'behind', 'beyond_z_far'])
+
+
+class _Renderer(sr.SwiftshaderRenderer):
+    """Only sets the camera matrices, without a display or GL buffers."""
+
+    def __del__(self):
+        pass
+
+
+def _get_renderer(monkeypatch, mirrored, bboxes):
+    monkeypatch.setattr(sr, 'glFrontFace', lambda mode: None)
+    r = _Renderer()
+    r.egl_program = {'rgb': None, 'disparity': None}
+    r.set_camera(fov_vertical=60., fov_horizontal=90., z_near=0.01, z_far=20., aspect=1.)
+    r.set_mirrored(mirrored)
+    r.entities = dict([(k, {'bbox': np.array(v), 'visible': True}) for k, v in bboxes.items()])
+    return r
+
+
+def _flip(xyz):
+    return [xyz[0], -xyz[1], xyz[2]]
+
+
+def test_frustum_culling(monkeypatch):
+    r = _get_renderer(monkeypatch, False, BBOXES)
+    r.position_camera(CAMERA_XYZ, np.array(CAMERA_XYZ) + [1., 0., 0.], [0., 0., 1.])
+    assert r._get_culled_entities() == CULLED
+    stats = r.get_culling_stats()
+    assert stats['tested'] == len(BBOXES) and stats['culled'] == len(CULLED)
+
+    # Culled entities are not drawn
+    r.static_batches = []
+    for k, entity in r.entities.items():
+        entity.update(vbo=k, tbo=None, num=3)
+    r.frustum_culling = True
+    assert set([x[0] for x in r._get_draw_calls()]) == set(BBOXES.keys()) - CULLED
+
+
+def test_frustum_culling_mirrored(monkeypatch):
+    # The mirrored camera, at the mirror image of the camera, sees the
+    # mirrored boxes as the camera sees the boxes
+    bboxes = dict([(k, [_flip(v[0]), _flip(v[1])]) for k, v in BBOXES.items()])
+    for bbox in bboxes.values():
+        bbox[0][1], bbox[1][1] = bbox[1][1], bbox[0][1]
+    r = _get_renderer(monkeypatch, True, bboxes)
+    camera_xyz = _flip(CAMERA_XYZ)
+    r.position_camera(camera_xyz, np.array(camera_xyz) + [1., 0., 0.], [0., 0., 1.])
+    assert r._get_culled_entities() == CULLED